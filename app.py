@@ -1,14 +1,53 @@
+import time
+
+# 本次 script run 的起點（Streamlit 每次互動都會從頭重跑整支 script）
+_RUN_STARTED = time.perf_counter()
+
 import streamlit as st
-import requests
 import json
-import re
-import google.generativeai as genai
-from googleapiclient.discovery import build
-import concurrent.futures
-import pandas as pd
-from collections import Counter
+import os
+import uuid
 from datetime import datetime
 
+import bulk
+import exports
+import tracing
+from jobs import JobManager
+from videostore import VideoStore
+from checkpoints import RUNS_DIR, STAGE_ARTIFACTS, new_run_id, save_checkpoint, load_run, list_runs, describe_run
+
+from engine import (
+    IMPORT_TIMINGS,
+    SHARED_CACHE_STATS,
+    lazy_import,
+    TRANSCRIPT_MODEL,
+    MAP_REDUCE_THRESHOLD,
+    DEFAULT_USER_GOAL,
+    STRATEGY_MODULES,
+    get_youtube_suggestions_deep,
+    probe_youtube_suggestions,
+    collect_video_tags,
+    batch_translate_keywords,
+    batch_extract_videos,
+    analysis_markdown,
+    search_analyses,
+    generate_keyword_master_table,
+    batch_generate_strategies,
+    iter_all_analyses_md,
+    generate_intent_report_md,
+    iter_full_report_md,
+    run_stage_graph,
+    search_pipeline_stages,
+    combine_intent_layers,
+    anomalies_md,
+    tag_cooccurrence_md,
+    trending_terms_md,
+    stage_timings_md,
+)
+
+# engine 只在 process 第一次執行時真的 import，之後的 rerun 直接取 sys.modules
+IMPORT_TIMINGS.setdefault("engine", time.perf_counter() - _RUN_STARTED)
+
 # ==========================================
 # 1. 系統配置與 API 設定
 # ==========================================
@@ -19,117 +58,6 @@ st.set_page_config(
     layout="wide"
 )
 
-# 固定爬字幕用的模型（低成本）
-TRANSCRIPT_MODEL = "gemini-2.5-flash"
-
-# 修飾詞探針：逼出 autocomplete 平常不會主動給的決策階段／疑慮類長尾詞
-PROBE_WORDS = {
-    "zh": {
-        "suffix": ["教學", "怎麼用", "推薦", "比較", "開箱", "實測", "新手", "免費", "缺點"],
-        "prefix": ["怎麼"],
-    },
-    "en": {
-        "suffix": ["tutorial", "vs", "review", "for beginners", "free"],
-        "prefix": ["how to", "best"],
-    },
-}
-
-# 策略模組定義
-STRATEGY_MODULES = {
-    "related": {
-        "name": "🔗 相關策略 (Related)",
-        "description": "利用現有熱門影片的流量，做關聯內容",
-        "prompt": """
-## 🔗 相關策略 (Related)
-如何利用這些影片的現有熱度？
-
-請提供：
-1. **關聯標題建議** (3個，融合多個關鍵字)
-2. **關鍵字佈局建議**：主關鍵字、長尾關鍵字、標籤建議
-3. **回應影片策略**：如何做「回應影片」或「補充觀點」
-4. **SEO 優化建議**：標題、描述、縮圖的優化方向
-"""
-    },
-    "trending": {
-        "name": "🔥 蹭流量策略 (Trending)",
-        "description": "快速蹭熱門話題的流量",
-        "prompt": """
-## 🔥 蹭流量策略 (Trending)
-如何快速蹭到這些熱門話題的流量？
-
-請提供：
-1. **時效性切入**：目前最熱的議題點是什麼？
-2. **快速製作建議**：如何在 24-48 小時內產出相關內容
-3. **標題公式**：3 個能蹭流量的標題範本
-4. **風險評估**：這個話題的熱度週期預估
-5. **差異化角度**：如何在眾多蹭流量影片中脫穎而出
-"""
-    },
-    "extended": {
-        "name": "📈 延伸策略 (Extended)",
-        "description": "深入探討競品沒講清楚的內容",
-        "prompt": """
-## 📈 延伸策略 (Extended)
-這些影片沒講清楚的是什麼？
-
-請提供：
-1. **深度延伸點** (列舉 3-5 點)：競品影片提到但沒深入的主題
-2. **實作步驟補充**：競品只講概念，你可以補充的實際操作
-3. **數據佐證方向**：可以用什麼數據讓內容更有說服力
-4. **案例補充**：可以新增哪些案例讓內容更豐富
-5. **進階內容**：適合進階觀眾的延伸主題
-"""
-    },
-    "superior": {
-        "name": "🚀 超越策略 (Superior)",
-        "description": "製作品質更高的影片",
-        "prompt": """
-## 🚀 超越策略 (Superior)
-如何製作一支品質更高的影片？
-
-請提供：
-1. **視覺化升級**：如何用更好的視覺呈現（動畫、圖表、實拍）
-2. **獨特觀點**：競品都沒提到的獨特切入角度
-3. **情緒共鳴設計**：如何設計能引發觀眾共鳴的橋段
-4. **權威性建立**：如何展現你比競品更專業
-5. **製作規格建議**：片長、節奏、段落結構
-6. **腳本大綱**：完整的影片腳本結構建議
-"""
-    },
-    "localization": {
-        "name": "🌏 搬運策略 (Localization)",
-        "description": "將英文優質內容本地化",
-        "prompt": """
-## 🌏 搬運策略 (Localization)
-如何將英文市場的優質內容本地化？
-
-請提供：
-1. **可搬運內容**：哪些英文影片的內容值得本地化？
-2. **本地化調整**：需要針對台灣/華語市場做哪些調整？
-3. **在地案例替換**：可以用什麼本地案例替換國外案例？
-4. **文化適配**：有哪些文化差異需要注意？
-5. **合規建議**：如何避免版權問題，做出原創性內容
-6. **加值方向**：如何在搬運基礎上增加獨特價值
-"""
-    },
-    "comprehensive": {
-        "name": "📊 綜合評比 (Comprehensive)",
-        "description": "整合所有競品的優缺點分析",
-        "prompt": """
-## 📊 綜合評比 (Comprehensive)
-整合所有競品影片的優缺點分析
-
-請提供：
-1. **競品矩陣**：用表格列出各影片的優缺點比較
-2. **內容覆蓋度**：哪些主題被多次提到？哪些被忽略？
-3. **觀眾反應分析**：從觀看數推測觀眾偏好
-4. **最佳實踐**：綜合各競品的最佳做法
-5. **市場缺口總結**：整體市場還缺什麼內容？
-6. **優先順序建議**：如果只能做一支影片，應該選什麼主題？
-"""
-    }
-}
-
 # 側邊欄配置
 with st.sidebar:
     st.header("🔑 API 金鑰設定")
@@ -149,6 +77,9 @@ with st.sidebar:
     st.markdown("**搜尋設定**")
     MAX_RESULTS_PER_KEYWORD = st.slider("每個關鍵字抓取影片數", 3, 10, 5)
     MAX_CONCURRENT_AI = st.slider("同時爬取影片數", 1, 5, 3, help="太高可能觸發 API 限制")
+    USE_TRANSCRIPTS = st.checkbox("優先使用影片字幕", value=True, help="先用 youtube-transcript-api 抓字幕給 AI 分析；沒有字幕的影片才請 AI 依網址爬取")
+    USE_ANALYSIS_CACHE = st.checkbox("沿用已爬取過的影片分析", value=True, help="同一支影片、同模型、同 prompt 版本的分析結果會直接從快取載入，不再重新爬取")
+    ANALYSIS_CACHE_TTL_DAYS = st.number_input("影片分析快取有效天數", min_value=0, max_value=365, value=30, help="0 = 永不過期", disabled=not USE_ANALYSIS_CACHE)
     
     st.markdown("---")
     st.markdown("**🌐 英文市場功能**")
@@ -174,903 +105,55 @@ with st.sidebar:
     st.markdown(f"{'✅' if step2_done else '⬜'} STEP 2: AI 爬取影片內容")
     st.markdown(f"{'✅' if step3_done else '⬜'} STEP 3: 策略模組分析")
 
-# ==========================================
-# 2. 核心功能函式庫
-# ==========================================
-
-def get_youtube_suggestions(keyword, lang="zh-TW"):
-    """抓取 YouTube 搜尋下拉選單的自動完成關鍵字"""
-    try:
-        url = "http://suggestqueries.google.com/complete/search"
-        params = {
-            "client": "firefox",
-            "ds": "yt",
-            "q": keyword,
-            "hl": lang
-        }
-        response = requests.get(url, params=params, timeout=2)
-        data = response.json()
-        if data and len(data) > 1:
-            return data[1]
-        return []
-    except Exception:
-        return []
-
-def get_youtube_suggestions_with_scores(keyword, lang="zh-TW"):
-    """抓取 YouTube 自動完成關鍵字與 Google 相關性分數，回傳 [(term, score), ...]，分數越高需求越強"""
-    try:
-        url = "http://suggestqueries.google.com/complete/search"
-        params = {
-            "client": "chrome",
-            "ds": "yt",
-            "q": keyword,
-            "hl": lang
-        }
-        response = requests.get(url, params=params, timeout=2)
-        response.encoding = "utf-8"
-        data = response.json()
-        terms = data[1] if len(data) > 1 else []
-        meta = data[4] if len(data) > 4 and isinstance(data[4], dict) else {}
-        scores = meta.get("google:suggestrelevance", [])
-        if terms:
-            return [(t, scores[i] if i < len(scores) else 0) for i, t in enumerate(terms)]
-    except Exception:
-        pass
-    # chrome client 解析失敗時退回 firefox client（無分數）
-    return [(t, 0) for t in get_youtube_suggestions(keyword, lang)]
-
-def probe_youtube_suggestions(keyword, lang="zh-TW", market="zh"):
-    """用修飾詞探針打 YouTube suggest，挖出決策階段／疑慮類長尾詞。回傳 {probe_query: [(term, score), ...]}"""
-    probes = PROBE_WORDS.get(market, PROBE_WORDS["zh"])
-    queries = [f"{keyword} {p}" for p in probes.get("suffix", [])]
-    queries += [f"{p} {keyword}" for p in probes.get("prefix", [])]
-
-    results = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
-        future_to_q = {
-            executor.submit(get_youtube_suggestions_with_scores, q, lang): q
-            for q in queries
-        }
-        for future in concurrent.futures.as_completed(future_to_q):
-            q = future_to_q[future]
-            try:
-                scored = future.result()
-                if scored:
-                    results[q] = scored[:10]
-            except Exception:
-                pass
-    return results
-
-def collect_video_tags(videos):
-    """收集競品影片的 tags（創作者自填的 SEO 關鍵字），回傳出現頻率 Counter"""
-    counter = Counter()
-    for v in videos or []:
-        for t in v.get('tags', []):
-            t = t.strip().lower()
-            if t:
-                counter[t] += 1
-    return counter
-
-def parse_iso_duration(duration_str):
-    """將 ISO 8601 時長 (PT12M34S) 轉為分鐘數"""
-    m = re.match(r'PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?', duration_str or '')
-    if not m:
-        return 0
-    h, mi, s = (int(g) if g else 0 for g in m.groups())
-    return round(h * 60 + mi + s / 60, 1)
-
-def video_age_days(publish_time):
-    """影片上架至今的天數（最小 1）"""
-    try:
-        dt = datetime.strptime(publish_time[:10], '%Y-%m-%d')
-        return max((datetime.now() - dt).days, 1)
-    except Exception:
-        return 0
-
-def fetch_channel_stats(api_key, channel_ids):
-    """批次查詢頻道訂閱數，回傳 {channel_id: subscriber_count}。訂閱數是偵測「小蝦米打大鯨魚」異常的關鍵訊號"""
-    stats = {}
-    ids = [c for c in set(channel_ids) if c]
-    if not ids:
-        return stats
-    try:
-        youtube = build('youtube', 'v3', developerKey=api_key)
-        for i in range(0, len(ids), 50):
-            resp = youtube.channels().list(
-                part='statistics',
-                id=','.join(ids[i:i + 50])
-            ).execute()
-            for item in resp.get('items', []):
-                stats[item['id']] = int(item['statistics'].get('subscriberCount', 0))
-    except Exception:
-        pass
-    return stats
-
-def get_youtube_suggestions_deep(keyword, lang="zh-TW", depth=2):
-    """遞迴展開 YouTube 自動完成關鍵字，回傳 {depth_level: [suggestions]}"""
-    results = {}
-
-    # 第一層
-    layer1 = get_youtube_suggestions(keyword, lang)
-    results[1] = layer1
-
-    if depth >= 2 and layer1:
-        layer2 = []
-        seen = set(layer1)
-        for sub_kw in layer1[:8]:  # 最多展開前 8 個
-            sub_suggestions = get_youtube_suggestions(sub_kw, lang)
-            for s in sub_suggestions:
-                if s not in seen and s != keyword:
-                    seen.add(s)
-                    layer2.append(s)
-        results[2] = layer2
-
-    return results
-
-def translate_keyword_to_english(api_key, keyword, model_version="gemini-2.5-flash"):
-    """使用 AI 將關鍵字翻譯成英文"""
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(model_version)
-    
-    prompt = f"""
-    請將以下中文關鍵字翻譯成最適合在 YouTube 搜尋的英文關鍵字。
-    
-    中文關鍵字：{keyword}
-    
-    要求：
-    1. 翻譯要符合英文 YouTube 的搜尋習慣
-    2. 如果有多種翻譯方式，選擇搜尋量最大的版本
-    3. 只回覆英文關鍵字，不要其他解釋
-    4. 如果關鍵字本身就是英文或專有名詞，保持原樣
-    """
-    
-    try:
-        response = model.generate_content(prompt)
-        return response.text.strip()
-    except Exception as e:
-        return keyword  # 翻譯失敗就用原本的
-
-def batch_translate_keywords(api_key, keywords_list, model_version="gemini-2.5-flash"):
-    """批次翻譯關鍵字"""
-    translations = {}
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-        future_to_kw = {
-            executor.submit(translate_keyword_to_english, api_key, kw, model_version): kw 
-            for kw in keywords_list
-        }
-        
-        for future in concurrent.futures.as_completed(future_to_kw):
-            original_kw = future_to_kw[future]
-            try:
-                translated = future.result()
-                translations[original_kw] = translated
-            except Exception:
-                translations[original_kw] = original_kw
-    
-    return translations
-
-def search_youtube_api(api_key, query, max_results=5, region_code="TW", relevance_language=None):
-    """使用 YouTube Data API 獲取影片列表與詳細數據"""
-    try:
-        youtube = build('youtube', 'v3', developerKey=api_key)
-        
-        search_params = {
-            'q': query,
-            'part': 'id,snippet',
-            'maxResults': max_results,
-            'type': 'video',
-            'order': 'relevance',
-            'regionCode': region_code
-        }
-        
-        if relevance_language:
-            search_params['relevanceLanguage'] = relevance_language
-        
-        search_response = youtube.search().list(**search_params).execute()
-
-        video_ids = [item['id']['videoId'] for item in search_response['items']]
-
-        if not video_ids:
-            return []
-
-        # 記錄搜尋排名順序
-        rank_map = {vid: idx + 1 for idx, vid in enumerate(video_ids)}
-
-        stats_response = youtube.videos().list(
-            part='snippet,statistics,contentDetails',
-            id=','.join(video_ids)
-        ).execute()
-
-        results = []
-        for item in stats_response['items']:
-            results.append({
-                'id': item['id'],
-                'title': item['snippet']['title'],
-                'description': item['snippet']['description'],
-                'tags': item['snippet'].get('tags', []),
-                'channel': item['snippet']['channelTitle'],
-                'publish_time': item['snippet']['publishedAt'],
-                'channel_id': item['snippet'].get('channelId', ''),
-                'view_count': int(item['statistics'].get('viewCount', 0)),
-                'like_count': int(item['statistics'].get('likeCount', 0)),
-                'comment_count': int(item['statistics'].get('commentCount', 0)),
-                'duration_min': parse_iso_duration(item.get('contentDetails', {}).get('duration', '')),
-                'thumbnail': item['snippet']['thumbnails']['high']['url'],
-                'url': f"https://www.youtube.com/watch?v={item['id']}",
-                'source_keyword': query,
-                'language': relevance_language or 'zh',
-                'rank': rank_map.get(item['id'], 99)
-            })
-
-        # 按搜尋排名排序（stats API 不保證順序）
-        results.sort(key=lambda x: x['rank'])
-        return results
-
-    except Exception as e:
-        st.error(f"YouTube API 錯誤 ({query}): {e}")
-        return []
-
-def search_multiple_keywords(api_key, keywords_list, max_results_per_keyword, lang="zh"):
-    """批次搜尋多個關鍵字"""
-    all_results = []
-    seen_ids = set()
-    
-    region_code = "TW" if lang == "zh" else "US"
-    relevance_language = "zh-Hant" if lang == "zh" else "en"
-    
-    for keyword in keywords_list:
-        results = search_youtube_api(
-            api_key, keyword, max_results_per_keyword, 
-            region_code=region_code, 
-            relevance_language=relevance_language
+    st.markdown("---")
+    st.markdown("**💾 接續先前的執行**")
+    saved_runs = list_runs()
+    if saved_runs:
+        resume_meta = st.selectbox(
+            "執行紀錄",
+            saved_runs,
+            format_func=describe_run,
+            help="每個階段完成後都會存檔，重新整理頁面或伺服器重啟後可從這裡載回，已完成的階段不必重跑"
         )
-        for video in results:
-            if video['id'] not in seen_ids:
-                seen_ids.add(video['id'])
-                video['market'] = lang  # 標記市場
-                all_results.append(video)
-    
-    return all_results
-
-def fetch_top_comments(youtube_api_key, video_id, max_results=50):
-    """抓取單支影片的熱門留言（含回覆串——留言區的爭論是最有價值的分歧訊號）"""
-    try:
-        youtube = build('youtube', 'v3', developerKey=youtube_api_key)
-        response = youtube.commentThreads().list(
-            part='snippet,replies',
-            videoId=video_id,
-            order='relevance',
-            maxResults=max_results,
-            textFormat='plainText'
-        ).execute()
-
-        comments = []
-        for item in response.get('items', []):
-            snippet = item['snippet']['topLevelComment']['snippet']
-            comments.append({
-                'text': snippet['textDisplay'],
-                'likes': snippet.get('likeCount', 0),
-                'author': snippet.get('authorDisplayName', ''),
-                'is_reply': False,
-            })
-            # 回覆緊跟在母留言後面，保留對話脈絡
-            for reply in item.get('replies', {}).get('comments', [])[:3]:
-                rs = reply['snippet']
-                comments.append({
-                    'text': rs['textDisplay'],
-                    'likes': rs.get('likeCount', 0),
-                    'author': rs.get('authorDisplayName', ''),
-                    'is_reply': True,
-                })
-        return comments
-    except Exception:
-        return []
-
-def batch_fetch_comments(youtube_api_key, videos_by_keyword, top_n=3, max_per_video=20):
-    """對每個關鍵字排名前 top_n 的影片批次抓留言，回傳 {video_id: {title, keyword, comments}}"""
-    results = {}
-    seen_ids = set()
-
-    for keyword, videos in videos_by_keyword.items():
-        sorted_videos = sorted(videos, key=lambda v: v.get('rank', 999))
-        for video in sorted_videos[:top_n]:
-            vid = video['id']
-            if vid in seen_ids:
-                continue
-            seen_ids.add(vid)
-            comments = fetch_top_comments(youtube_api_key, vid, max_per_video)
-            results[vid] = {
-                'title': video['title'],
-                'keyword': keyword,
-                'comments': comments
-            }
-    return results
-
-# ==========================================
-# 3. AI 分析函式
-# ==========================================
-
-def extract_video_content_via_ai(api_key, video_info):
-    """用 AI 直接爬取單支 YouTube 影片的內容摘要"""
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(TRANSCRIPT_MODEL)
-    
-    video_url = video_info['url']
-    video_title = video_info['title']
-    market = video_info.get('market', 'zh')
-    
-    lang_instruction = "請用繁體中文回答" if market == "zh" else "請用繁體中文回答（影片是英文的，但分析請用中文）"
-    
-    prompt = f"""
-    請分析這支 YouTube 影片的完整內容：
-    影片網址：{video_url}
-    影片標題：{video_title}
-    
-    請提供：
-    1. **影片主題**：這支影片在講什麼？(1-2句)
-    2. **核心論點**：影片的主要觀點或教學重點 (條列3-5點)
-    3. **內容結構**：影片的段落架構 (開頭講什麼、中間講什麼、結尾講什麼)
-    4. **關鍵金句**：影片中有價值的句子或觀點 (2-3句)
-    5. **目標受眾**：這支影片是拍給誰看的？
-    6. **內容缺口**：這支影片沒講到但觀眾可能想知道的 (1-2點)
-    7. **獨特價值**：這支影片相比其他同類影片的獨特之處
-    
-    {lang_instruction}，格式清晰。
-    """
-    
-    try:
-        response = model.generate_content(prompt)
-        return {
-            'video_id': video_info['id'],
-            'title': video_title,
-            'url': video_url,
-            'view_count': video_info['view_count'],
-            'source_keyword': video_info.get('source_keyword', ''),
-            'market': market,
-            'ai_analysis': response.text,
-            'success': True
-        }
-    except Exception as e:
-        return {
-            'video_id': video_info['id'],
-            'title': video_title,
-            'url': video_url,
-            'view_count': video_info['view_count'],
-            'source_keyword': video_info.get('source_keyword', ''),
-            'market': market,
-            'ai_analysis': f"爬取失敗: {str(e)}",
-            'success': False
-        }
-
-def batch_extract_videos(api_key, videos_list, max_workers=3):
-    """批次爬取多支影片"""
-    results = []
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_video = {
-            executor.submit(extract_video_content_via_ai, api_key, video): video 
-            for video in videos_list
-        }
-        
-        for future in concurrent.futures.as_completed(future_to_video):
-            video = future_to_video[future]
-            try:
-                result = future.result()
-                results.append(result)
-            except Exception as e:
-                results.append({
-                    'video_id': video['id'],
-                    'title': video['title'],
-                    'url': video['url'],
-                    'view_count': video['view_count'],
-                    'source_keyword': video.get('source_keyword', ''),
-                    'market': video.get('market', 'zh'),
-                    'ai_analysis': f"執行錯誤: {str(e)}",
-                    'success': False
-                })
-    
-    return results
-
-def analyze_search_intent_bilingual(api_key, zh_keywords, en_keywords, zh_videos, en_videos, model_version):
-    """雙語市場意圖分析"""
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(model_version)
-    
-    # 整理中文市場數據
-    zh_summary = ""
-    if zh_videos:
-        zh_summary = "\n### 🇹🇼 繁體中文市場\n"
-        for keyword in zh_keywords:
-            keyword_videos = [v for v in zh_videos if v.get('source_keyword') == keyword]
-            if keyword_videos:
-                zh_summary += f"\n**關鍵字：「{keyword}」**\n"
-                for v in keyword_videos[:3]:
-                    zh_summary += f"- {v['title']} (觀看數: {v['view_count']:,})\n"
-    
-    # 整理英文市場數據
-    en_summary = ""
-    if en_videos:
-        en_summary = "\n### 🇺🇸 英文市場\n"
-        for keyword in en_keywords:
-            keyword_videos = [v for v in en_videos if v.get('source_keyword') == keyword]
-            if keyword_videos:
-                en_summary += f"\n**關鍵字：「{keyword}」**\n"
-                for v in keyword_videos[:3]:
-                    en_summary += f"- {v['title']} (觀看數: {v['view_count']:,})\n"
-
-    prompt = f"""
-    你是一個跨語言搜尋意圖分析專家。
-    
-    使用者研究的中文關鍵字：{', '.join(zh_keywords)}
-    {'對應的英文關鍵字：' + ', '.join(en_keywords) if en_keywords else ''}
-    
-    以下是搜尋結果：
-    {zh_summary}
-    {en_summary}
-    
-    請分析：
-    
-    ## 1. 【搜尋意圖分析】
-    - 這些關鍵字背後的使用者需求是什麼？
-    - 使用者最想解決什麼問題？
-    
-    ## 2. 【市場現況】
-    - 中文市場目前的內容主要集中在哪些角度？
-    {'- 英文市場的內容主要集中在哪些角度？' if en_videos else ''}
-    
-    ## 3. 【中英差距分析】{'（重點！）' if en_videos else '（未啟用英文搜尋）'}
-    {'- 英文市場有但中文市場缺乏的內容主題' if en_videos else '- 建議啟用英文市場搜尋以獲得更完整分析'}
-    {'- 英文市場的內容深度/專業度差異' if en_videos else ''}
-    {'- 最值得「搬運」到中文市場的內容方向' if en_videos else ''}
-    
-    ## 4. 【內容機會總結】
-    - 綜合以上分析，最有潛力的內容方向是？
-    
-    請用繁體中文回答，格式清晰。
-    """
-    
-    response = model.generate_content(prompt)
-    return response.text
-
-def analyze_intent_three_layers(api_key, zh_keywords, en_keywords, zh_videos, en_videos,
-                                 deep_suggestions_zh, deep_suggestions_en,
-                                 video_comments, model_version,
-                                 probe_suggestions_zh=None, probe_suggestions_en=None):
-    """三層意圖分析：長尾詞分群 → 排名語意 → 留言需求"""
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(model_version)
-    results = {}
-
-    # ── 第一層：長尾詞意圖分群 ──
-    suggestions_text = ""
-    for kw, layers in deep_suggestions_zh.items():
-        suggestions_text += f"\n【{kw}】\n"
-        for depth, terms in layers.items():
-            suggestions_text += f"  第{depth}層展開：{', '.join(terms[:20])}\n"
-    if deep_suggestions_en:
-        for kw, layers in deep_suggestions_en.items():
-            suggestions_text += f"\n【{kw}】(英文)\n"
-            for depth, terms in layers.items():
-                suggestions_text += f"  第{depth}層展開：{', '.join(terms[:20])}\n"
-
-    # 修飾詞探針結果（含 Google 相關性分數）
-    probe_text = ""
-    for probes in (probe_suggestions_zh or {}, probe_suggestions_en or {}):
-        for kw, probe_map in probes.items():
-            for q, scored in probe_map.items():
-                terms = ", ".join(f"{t}({s})" for t, s in scored[:10])
-                probe_text += f"  「{q}」→ {terms}\n"
-
-    # 競品影片 tags（創作者自填關鍵字）
-    tag_counter = collect_video_tags(zh_videos + en_videos)
-    tags_text = ", ".join(f"{t}(×{c})" for t, c in tag_counter.most_common(40))
-
-    layer1_prompt = f"""
-    你是搜尋需求分析專家。你的任務不是分類整理資料，而是從資料中找出「反差與異常」。
-
-    以下是使用者輸入的關鍵字，以及從 YouTube 自動完成功能遞迴展開得到的所有長尾搜尋詞（第1層是直接建議，第2層是從第1層再展開的結果）：
-
-    {suggestions_text}
-
-    {'以下是用修飾詞探針（教學/推薦/比較/缺點…）逼出的長尾詞，括號內為 Google 相關性分數，分數越高代表需求越強：' if probe_text else ''}
-    {probe_text}
-
-    {'以下是搜尋結果中競品影片創作者自填的 Tags（出現次數越多代表整個賽道越依賴這個詞）：' if tags_text else ''}
-    {tags_text}
-
-    只回答以下問題，每一條結論都必須引用具體的搜尋詞：
-
-    1. 【矛盾訊號】哪些相關性分數高的搜尋詞，彼此的需求方向互相矛盾或照理不該同時出現？這暗示什麼還沒被理解的需求？
-    2. 【卡點詞】哪些詞暗示使用者卡在某個具體步驟、或遇到某個具體問題？（卡點是最強的內容鉤子）
-    3. 【無主流講法的需求】探針逼出的詞裡，哪些方向的搜尋需求明顯存在（分數高），但還沒形成主流頭部詞、競品 Tags 也沒在用？
-    4. 【意料之外】哪些詞是「不看資料想不到有人會這樣搜」的？它暗示什麼被忽略的族群、情境或動機？
-
-    禁止：意圖分類表、資料的描述性總結、不看資料也寫得出來的結論。找不到某類異常就直說「未觀察到」，不要硬湊。
-
-    請用繁體中文回答。
-    """
-
-    try:
-        resp1 = model.generate_content(layer1_prompt)
-        results['layer1'] = resp1.text
-    except Exception as e:
-        results['layer1'] = f"❌ 第一層分析失敗: {str(e)}"
-
-    # ── 第二層：供需錯位偵測 ──
-    def _video_line(v):
-        views = v.get('view_count', 0)
-        age = video_age_days(v.get('publish_time', ''))
-        vpd = views / age if age else 0
-        er = (v.get('like_count', 0) + v.get('comment_count', 0)) / views if views else 0
-        subs = v.get('subscriber_count', 0)
-        dur = v.get('duration_min', 0)
-        line = f"  #{v.get('rank', '?')} {v['title']}\n"
-        line += (f"     頻道：{v['channel']}（訂閱 {subs:,}）| 觀看 {views:,}（日均 {vpd:,.0f}）"
-                 f"| 互動率 {er:.2%} | 上架 {age} 天前 | 片長 {dur} 分\n")
-        if v.get('description'):
-            desc_preview = v['description'][:100].replace('\n', ' ')
-            line += f"     描述：{desc_preview}\n"
-        return line
-
-    ranked_text = ""
-    all_keywords = zh_keywords + (en_keywords if en_keywords else [])
-    all_videos = zh_videos + en_videos
-
-    for kw in all_keywords:
-        kw_videos = [v for v in all_videos if v.get('source_keyword') == kw]
-        kw_videos.sort(key=lambda v: v.get('rank', 99))
-        if kw_videos:
-            market_tag = "🇺🇸" if kw in (en_keywords or []) else "🇹🇼"
-            ranked_text += f"\n【{market_tag} {kw}】\n"
-            for v in kw_videos:
-                ranked_text += _video_line(v)
-
-    layer2_prompt = f"""
-    你是 YouTube 供需錯位分析專家。以下是各關鍵字的搜尋結果，按演算法排名排列（#1 = YouTube 認為最符合搜尋意圖），附完整數據。
-    你的任務是偵測「異常」，不是描述前三名在講什麼。
-
-    {ranked_text}
-
-    請偵測以下四種異常，每一種都要指出具體的關鍵字與影片名稱；沒觀察到就直說「未觀察到」，不要硬湊：
-
-    1. 【小蝦米打大鯨魚】訂閱數明顯較小的頻道，排在大頻道前面的關鍵字 → 代表這個詞的需求真實存在、演算法在主動找答案，新頻道可切入。列出這些關鍵字並排出優先順序。
-    2. 【過時的前排】排名前列但上架已久、日均觀看明顯衰退的影片 → 「等人做新版」的機會。指出哪些關鍵字的前排最老舊。
-    3. 【高觀看低互動】觀看數高、但互動率明顯低於同關鍵字其他影片 → 觀眾點進去了但不滿足，標題的承諾沒有兌現。指出是哪支影片、可能沒兌現什麼。
-    4. 【同質化前排】前排標題角度高度雷同的關鍵字 → 說出雷同的角度具體是什麼，以及旁邊空著的差異化角度是什麼。
-
-    最後回答：綜合以上異常，哪 1-2 個關鍵字是「供需錯位最嚴重」＝最值得優先做的？理由是什麼？
-
-    禁止：逐一描述影片內容、複述資料、給「做出差異化」這類不看資料也寫得出來的建議。
-
-    請用繁體中文回答。
-    """
-
-    try:
-        resp2 = model.generate_content(layer2_prompt)
-        results['layer2'] = resp2.text
-    except Exception as e:
-        results['layer2'] = f"❌ 第二層分析失敗: {str(e)}"
-
-    # ── 第三層：承諾與兌現的落差 ──
-    comments_text = ""
-    for vid, data in video_comments.items():
-        if data['comments']:
-            comments_text += f"\n【{data['keyword']}】影片標題（＝對觀眾的承諾）：{data['title']}\n"
-            for c in data['comments'][:30]:
-                prefix = "    ↳ " if c.get('is_reply') else "  - "
-                likes_tag = f" (👍{c['likes']})" if c['likes'] > 0 else ""
-                comments_text += f"{prefix}{c['text'][:300]}{likes_tag}\n"
-
-    if comments_text:
-        layer3_prompt = f"""
-        你是觀眾落差分析專家。以下是各影片的「標題（＝影片對觀眾的承諾）」與其熱門留言（＝觀眾實際的反應；讚數＝認同這則留言的人數；「↳」開頭是回覆，回覆串代表觀眾之間的對話與爭論）：
-
-        {comments_text}
-
-        只回答以下問題，每一條結論都必須引用留言原文（可節錄）：
-
-        1. 【承諾 vs 兌現】哪些影片的留言顯示觀眾沒有得到標題承諾的東西？具體落差是什麼？
-        2. 【集體性未滿足需求】被大量點讚的抱怨、追問、許願是什麼？（這是全部資料中最接近「現成影片題材」的訊號）列出並附上讚數。
-        3. 【爭論點】回覆串裡觀眾意見分歧的地方在哪？各方立場是什麼？（分歧＝高互動潛力的切入角度）
-        4. 【觀眾的語言 vs 創作者的語言】觀眾描述問題時的用詞，和影片標題的用詞有什麼落差？觀眾的講法才是未來的搜尋詞，把它們列出來。
-        5. 【意料之外的使用情境】留言中透露的、創作者顯然沒設想到的使用場景或族群是什麼？
-
-        禁止：情緒比例統計、「觀眾希望更深入」這類籠統結論、沒有留言原文支撐的判斷。找不到就直說「未觀察到」。
-
-        請用繁體中文回答。
-        """
-
-        try:
-            resp3 = model.generate_content(layer3_prompt)
-            results['layer3'] = resp3.text
-        except Exception as e:
-            results['layer3'] = f"❌ 第三層分析失敗: {str(e)}"
+        if st.button("↩️ 載入這次執行", key="resume_run"):
+            restored = load_run(resume_meta['run_id'])
+            if restored:
+                # 先清掉目前的產出，避免新舊執行的結果混在一起
+                st.session_state.search_results = {'zh': [], 'en': []}
+                st.session_state.keyword_table = []
+                st.session_state.video_analyses = {'zh': [], 'en': []}
+                st.session_state.strategy_results = {}
+                st.session_state.stage_run = None
+                st.session_state.exports = {}
+                for name, value in restored.items():
+                    if name != 'completed_stages':
+                        st.session_state[name] = value
+                for lang in ('zh', 'en'):
+                    st.session_state[f"{lang}_suggestions_cache"] = {
+                        kw: deep.get(1, []) + deep.get(2, [])
+                        for kw, deep in restored.get(f"deep_suggestions_{lang}", {}).items()
+                    }
+                st.session_state.run_id = resume_meta['run_id']
+                st.rerun()
+            else:
+                st.error("執行紀錄讀取失敗")
     else:
-        results['layer3'] = "⚠️ 未抓取到留言資料，無法進行第三層分析。可能原因：影片關閉留言功能，或 API 配額不足。"
-
-    # ── 第四步：洞察引擎（三層對撞）──
-    synthesis_prompt = f"""
-    你是內容策略洞察總監。以下是針對同一批關鍵字的三份分析——需求端（搜尋詞異常）、供給端（排名供需錯位）、反應端（觀眾落差）：
-
-    【需求端分析】
-    {results.get('layer1', '（無）')}
-
-    【供給端分析】
-    {results.get('layer2', '（無）')}
-
-    【反應端分析】
-    {results.get('layer3', '（無）')}
-
-    把三份分析互相對撞，輸出 5-7 條洞察。每條格式固定：
-
-    ### 💡 洞察 N：（一句話，說出一個非顯而易見的判斷）
-    - **來自哪個反差**：哪兩個（或以上）資料源的訊號相減得出這個判斷
-    - **行動意義**：具體做什麼題目、用什麼關鍵字、切什麼角度
-
-    收錄門檻：這條判斷必須是「不對撞資料就想不到」的。三個資料源都指向同一方向的機會，排在最前面。
-
-    禁止：把單一層的結論換句話說、常識性建議（如「做出差異化」「提供價值」「了解你的觀眾」）。寧可只輸出 3 條真洞察，也不要湊滿 7 條。
-
-    請用繁體中文回答。
-    """
-
-    try:
-        resp4 = model.generate_content(synthesis_prompt)
-        results['synthesis'] = resp4.text
-    except Exception as e:
-        results['synthesis'] = f"❌ 洞察引擎失敗: {str(e)}"
-
-    return results
-
-def generate_keyword_master_table(api_key, model_version, zh_keywords, en_keywords,
-                                   deep_zh, deep_en, probes_zh, probes_en,
-                                   tag_counter, titles, video_comments):
-    """整併五種 YouTube 原生來源，生成結構化關鍵字總表（list of dict）"""
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(model_version)
-
-    seeds = zh_keywords + en_keywords
-    material = f"【種子關鍵字】{', '.join(seeds)}\n"
-
-    def fmt_deep(deep, label):
-        text = ""
-        for kw, layers in deep.items():
-            terms = layers.get(1, []) + layers.get(2, [])
-            if terms:
-                text += f"  {kw}: {', '.join(terms[:30])}\n"
-        return f"\n【來源1: YouTube 自動完成{label}】\n{text}" if text else ""
-
-    material += fmt_deep(deep_zh, "（中文）")
-    material += fmt_deep(deep_en, "（英文）")
-
-    def fmt_probes(probes, label):
-        text = ""
-        for kw, probe_map in probes.items():
-            for q, scored in probe_map.items():
-                terms = ", ".join(f"{t}({s})" for t, s in scored)
-                text += f"  「{q}」→ {terms}\n"
-        return f"\n【來源2: 修飾詞探針{label}，括號內為 Google 相關性分數，越高需求越強】\n{text}" if text else ""
-
-    material += fmt_probes(probes_zh, "（中文）")
-    material += fmt_probes(probes_en, "（英文）")
-
-    if tag_counter:
-        top_tags = tag_counter.most_common(50)
-        material += "\n【來源3: 競品影片 Tags（創作者自填的 SEO 關鍵字，×N 為出現次數）】\n"
-        material += ", ".join(f"{t}(×{c})" for t, c in top_tags) + "\n"
-
-    if titles:
-        material += "\n【來源4: 競品影片標題】\n"
-        for t in titles[:60]:
-            material += f"  - {t}\n"
-
-    comment_lines = []
-    for vid, data in (video_comments or {}).items():
-        for c in data.get('comments', [])[:10]:
-            text = c['text'][:100].replace('\n', ' ')
-            comment_lines.append(text)
-    if comment_lines:
-        material += "\n【來源5: 觀眾熱門留言（用來抽取觀眾實際用語）】\n"
-        for line in comment_lines[:100]:
-            material += f"  - {line}\n"
-
-    prompt = f"""
-你是 YouTube 關鍵字研究專家。以下是從多個 YouTube 原生資料來源收集到的原始素材：
-
-{material}
-
-請整併成一份「可直接拿去做內容企劃／搜尋研究」的關鍵字總表：
-
-1. 合併重複與同義變形，保留最接近真實搜尋用語的版本
-2. 從競品標題中抽出反覆出現的高頻詞組（例如「零基礎」「5分鐘學會」這類），作為關鍵字加入
-3. 從觀眾留言中抽出觀眾實際使用、但創作者標題較少用的講法，作為關鍵字加入
-4. 排除種子關鍵字本身，只保留新發現
-5. 每個關鍵字給出：
-   - market: "zh"（中文詞）或 "en"（英文詞）
-   - intent: 教學需求 / 比較評估 / 問題解決 / 購買決策 / 靈感娛樂 / 其他
-   - sources: 來源列表，值限 "autocomplete" / "probe" / "tags" / "title" / "comment"，可多個（跨來源交叉出現代表需求更可信）
-   - demand: 需求強度 1-5 的整數（綜合相關性分數、出現頻率、跨來源出現情況）
-   - note: 一句話說明這個詞代表的需求或適合的使用時機
-6. 按 demand 由高到低排序，最多輸出 60 個
-
-直接輸出 JSON 陣列，不要其他文字。格式範例：
-[{{"keyword": "...", "market": "zh", "intent": "教學需求", "sources": ["autocomplete", "probe"], "demand": 5, "note": "..."}}]
-"""
-
-    response = model.generate_content(
-        prompt,
-        generation_config={"response_mime_type": "application/json"}
-    )
-    text = response.text.strip()
-    if text.startswith("```"):
-        text = text.strip("`")
-        if text.startswith("json"):
-            text = text[4:]
-    rows = json.loads(text)
-
-    table = []
-    for r in rows:
-        if not isinstance(r, dict) or not str(r.get('keyword', '')).strip():
-            continue
-        try:
-            demand = int(r.get('demand', 3))
-        except (TypeError, ValueError):
-            demand = 3
-        table.append({
-            'keyword': str(r['keyword']).strip(),
-            'market': r.get('market') if r.get('market') in ('zh', 'en') else 'zh',
-            'intent': r.get('intent', '其他'),
-            'sources': ', '.join(r['sources']) if isinstance(r.get('sources'), list) else str(r.get('sources', '')),
-            'demand': demand,
-            'note': r.get('note', ''),
-        })
-    table.sort(key=lambda x: -x['demand'])
-    return table
-
-def generate_strategy_module(api_key, module_key, all_analyses, keywords_info, user_goal, model_version, has_english=False):
-    """生成單一策略模組的報告"""
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(model_version)
-    
-    module = STRATEGY_MODULES[module_key]
-    
-    # 整理影片分析內容
-    zh_analyses = [a for a in all_analyses if a.get('market') == 'zh']
-    en_analyses = [a for a in all_analyses if a.get('market') == 'en']
-    
-    combined_context = ""
-    
-    if zh_analyses:
-        combined_context += "### 🇹🇼 繁體中文市場競品\n\n"
-        for idx, analysis in enumerate(zh_analyses, 1):
-            combined_context += f"""
-**[中文 {idx}] {analysis['title']}**
-- 來源關鍵字：{analysis.get('source_keyword', 'N/A')}
-- 觀看數：{analysis['view_count']:,}
-- 網址：{analysis['url']}
-
-{analysis['ai_analysis']}
-
----
-"""
-    
-    if en_analyses:
-        combined_context += "\n### 🇺🇸 英文市場競品\n\n"
-        for idx, analysis in enumerate(en_analyses, 1):
-            combined_context += f"""
-**[英文 {idx}] {analysis['title']}**
-- 來源關鍵字：{analysis.get('source_keyword', 'N/A')}
-- 觀看數：{analysis['view_count']:,}
-- 網址：{analysis['url']}
-
-{analysis['ai_analysis']}
-
----
-"""
-
-    # 針對搬運策略的特殊處理
-    localization_context = ""
-    if module_key == "localization":
-        if not en_analyses:
-            return f"# {module['name']}\n\n⚠️ 未啟用英文市場搜尋，無法生成搬運策略。請在側邊欄啟用「英文市場比對」功能後重新執行。"
-        localization_context = """
-特別注意：請重點分析英文市場的影片，找出值得本地化到繁體中文市場的內容。
-"""
-
-    prompt = f"""
-    你是一位頂尖的 YouTube 內容策略顧問。
-    
-    研究關鍵字：{', '.join(keywords_info.get('zh', []))}
-    {'對應英文關鍵字：' + ', '.join(keywords_info.get('en', [])) if keywords_info.get('en') else ''}
-    
-    以下是競品影片的詳細分析：
-    
-    {combined_context}
-    
-    【使用者的創作目標】
-    {user_goal}
-    
-    {localization_context}
-    
-    請根據以上競品分析，專注於以下策略方向提出建議：
-    
-    {module['prompt']}
-    
-    請用繁體中文回答，內容要具體可執行，格式清晰專業。
-    """
-    
-    try:
-        response = model.generate_content(prompt)
-        return f"# {module['name']}\n\n{response.text}"
-    except Exception as e:
-        return f"# {module['name']}\n\n❌ 生成失敗: {str(e)}"
-
-def batch_generate_strategies(api_key, selected_modules, all_analyses, keywords_info, user_goal, model_version, has_english=False):
-    """並行生成多個策略模組"""
-    results = {}
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(selected_modules)) as executor:
-        future_to_module = {
-            executor.submit(
-                generate_strategy_module, 
-                api_key, module_key, all_analyses, keywords_info, user_goal, model_version, has_english
-            ): module_key 
-            for module_key in selected_modules
-        }
-        
-        for future in concurrent.futures.as_completed(future_to_module):
-            module_key = future_to_module[future]
-            try:
-                result = future.result()
-                results[module_key] = result
-            except Exception as e:
-                results[module_key] = f"# {STRATEGY_MODULES[module_key]['name']}\n\n❌ 執行錯誤: {str(e)}"
-    
-    return results
-
-# ==========================================
-# 4. 輔助函式
-# ==========================================
+        st.caption("尚無執行紀錄")
 
-def generate_all_analyses_md(video_analyses):
-    """將所有影片分析整合成一份 Markdown"""
-    zh_analyses = [a for a in video_analyses if a.get('market') == 'zh']
-    en_analyses = [a for a in video_analyses if a.get('market') == 'en']
-    
-    content = f"# YouTube 競品影片分析報告\n\n"
-    content += f"生成時間：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-    content += f"共分析 {len(video_analyses)} 支影片（中文 {len(zh_analyses)} 支，英文 {len(en_analyses)} 支）\n\n"
-    content += "---\n\n"
-    
-    if zh_analyses:
-        content += "## 🇹🇼 繁體中文市場\n\n"
-        for idx, analysis in enumerate(zh_analyses, 1):
-            status = "✅ 成功" if analysis['success'] else "❌ 失敗"
-            content += f"### {idx}. {analysis['title']}\n\n"
-            content += f"- **狀態**: {status}\n"
-            content += f"- **來源關鍵字**: {analysis.get('source_keyword', 'N/A')}\n"
-            content += f"- **網址**: {analysis['url']}\n"
-            content += f"- **觀看數**: {analysis['view_count']:,}\n\n"
-            content += f"#### 分析內容\n\n{analysis['ai_analysis']}\n\n"
-            content += "---\n\n"
-    
-    if en_analyses:
-        content += "## 🇺🇸 英文市場\n\n"
-        for idx, analysis in enumerate(en_analyses, 1):
-            status = "✅ 成功" if analysis['success'] else "❌ 失敗"
-            content += f"### {idx}. {analysis['title']}\n\n"
-            content += f"- **狀態**: {status}\n"
-            content += f"- **來源關鍵字**: {analysis.get('source_keyword', 'N/A')}\n"
-            content += f"- **網址**: {analysis['url']}\n"
-            content += f"- **觀看數**: {analysis['view_count']:,}\n\n"
-            content += f"#### 分析內容\n\n{analysis['ai_analysis']}\n\n"
-            content += "---\n\n"
-    
-    return content
+    st.markdown("---")
+    with st.expander("⏱️ 啟動效能與快取"):
+        st.caption(f"本次 rerun 到側邊欄渲染完成：{(time.perf_counter() - _RUN_STARTED) * 1000:.0f} ms")
+        if IMPORT_TIMINGS:
+            st.caption("模組首次載入耗時（Google SDK、pandas 用到時才載入）：")
+            for module_name, seconds in sorted(IMPORT_TIMINGS.items(), key=lambda x: -x[1]):
+                st.caption(f"- `{module_name}`：{seconds * 1000:.0f} ms")
+        if any(s['hits'] or s['misses'] for s in SHARED_CACHE_STATS.values()):
+            st.caption("跨 session 共用快取（命中／實際呼叫／目前筆數）：")
+            for fn_name, s in SHARED_CACHE_STATS.items():
+                st.caption(f"- `{fn_name}`：{s['hits']}／{s['misses']}／{s['size']}")
 
 # ==========================================
-# 5. Streamlit 主程式邏輯
+# 2. Streamlit 主程式邏輯
 # ==========================================
 
 st.title("🎯 YouTube 戰略內容切入分析儀 v3")
@@ -1108,7 +191,257 @@ if "video_analyses" not in st.session_state:
 if "strategy_results" not in st.session_state:
     st.session_state.strategy_results = {}
 if "user_goal" not in st.session_state:
-    st.session_state.user_goal = "我想做一支能蹭到流量，但在專業度上超越他們的影片"
+    st.session_state.user_goal = DEFAULT_USER_GOAL
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex  # 背景工作以此區分使用者
+if "job_notices" not in st.session_state:
+    st.session_state.job_notices = []  # 背景工作完成／失敗的提示，顯示一次後清除
+if "traces" not in st.session_state:
+    st.session_state.traces = []  # 最近幾次執行的 trace（tracing.Trace.to_dict()）
+if "exports" not in st.session_state:
+    st.session_state.exports = {}  # {檔名: 路徑}，按下「產生」才寫進 runs/<run_id>/ 的匯出檔
+if "bulk_run" not in st.session_state:
+    st.session_state.bulk_run = {}  # 大量關鍵字研究的結果摘要（大型資料在 run_dir 的檔案裡）
+
+# ------------------------------------------------------------
+# 背景工作：長流程在 worker thread 執行，rerun（點按鈕、切 tab）不會中斷；
+# 介面每次 rerun 只讀進度，完成後在這裡把結果寫回 session_state
+# ------------------------------------------------------------
+@st.cache_resource
+def shared_job_manager():
+    """同一個 server process 的所有 session 共用一個背景工作管理器（跨 rerun 保留）"""
+    return JobManager()
+
+job_manager = shared_job_manager()
+
+def search_job(ctx, stages, errors):
+    """STEP 1 搜尋＋意圖分析（背景執行）"""
+    def on_update(timings):
+        finished = sum(1 for t in timings.values() if t['status'] in ('done', 'failed', 'skipped'))
+        running = [t['label'] for t in timings.values() if t['status'] == 'running']
+        ctx.update(
+            progress=finished / len(timings),
+            message=f"執行中：{'、'.join(running)}" if running else "",
+            detail={name: dict(t) for name, t in timings.items()}
+        )
+    graph = run_stage_graph(stages, max_workers=6, on_update=on_update, cancel_event=ctx.cancel_event)
+    graph['errors'] = list(errors)
+    return graph
+
+def extract_job(ctx, api_key, videos, **options):
+    """STEP 2 影片分析（背景執行）"""
+    def on_progress(done, total):
+        ctx.update(progress=done / total if total else 1, message=f"已完成 {done}/{total} 支")
+    return batch_extract_videos(api_key, videos, on_progress=on_progress, cancel_event=ctx.cancel_event, **options)
+
+def strategy_job(ctx, *args, **kwargs):
+    """STEP 3 策略生成（背景執行）"""
+    ctx.update(message="濃縮競品分析並生成策略中..." if kwargs.get('map_reduce') else "生成策略中...")
+    return batch_generate_strategies(*args, **kwargs)
+
+def bulk_job(ctx, gemini_key, youtube_key, data, filename, run_dir, total, model_version, **options):
+    """大量關鍵字研究（背景執行）：逐批讀取上傳檔、處理完就寫檔釋放"""
+    def on_progress(done, total, summary):
+        note = "沿用上次結果" if summary.get('resumed') else (f"失敗：{summary['error']}" if summary.get('error') else f"{summary['videos']} 支影片")
+        ctx.update(
+            progress=done / total if total else 0,
+            message=f"第 {summary['chunk']} 批完成（{note}），已處理 {done}/{total} 個關鍵字",
+        )
+    return bulk.run_bulk(
+        gemini_key, youtube_key, bulk.read_keywords(data, filename), run_dir, model_version,
+        total=total, on_progress=on_progress, cancel_event=ctx.cancel_event, **options
+    )
+
+def checkpoint_stage(stage):
+    """把某階段的產出寫進本次執行紀錄（寫檔失敗只提示，不影響介面）"""
+    if not st.session_state.get('run_id'):
+        st.session_state.run_id = new_run_id()
+    # 產出變了，先前產生的匯出檔已過時
+    st.session_state.exports = {}
+    artifacts = {name: st.session_state[name] for name in STAGE_ARTIFACTS[stage] if name in st.session_state}
+    try:
+        save_checkpoint(
+            st.session_state.run_id, stage, artifacts,
+            st.session_state.zh_keywords, st.session_state.en_keywords
+        )
+    except OSError as e:
+        st.session_state.job_notices.append(('warning', f"執行紀錄寫入失敗：{e}"))
+
+def prepare_export(name, write):
+    """產生匯出檔：write(path) 逐段寫進 runs/<run_id>/<name>，之後的 rerun 只把檔案交給下載按鈕，不再重組"""
+    if not st.session_state.get('run_id'):
+        st.session_state.run_id = new_run_id()
+    path = os.path.join(RUNS_DIR, st.session_state.run_id, name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write(path)
+    except OSError as e:
+        st.error(f"匯出檔寫入失敗：{e}")
+        return
+    st.session_state.exports[name] = path
+
+def export_download_button(name, label, file_name, mime, **kwargs):
+    """已產生的匯出檔的下載按鈕（直接給檔案，不先讀成字串）；還沒產生時回傳 False"""
+    path = st.session_state.exports.get(name)
+    if not path or not os.path.exists(path):
+        return False
+    with open(path, "rb") as f:
+        st.download_button(label, f, file_name, mime=mime, **kwargs)
+    return True
+
+def apply_search_result(graph):
+    results = graph['results']
+    zh_results = results.get('search_zh', [])
+    en_results = results.get('search_en', [])
+    st.session_state.search_results = {'zh': zh_results, 'en': en_results}
+    st.session_state.video_analyses = {'zh': [], 'en': []}
+    st.session_state.strategy_results = {}
+    st.session_state.stage_run = {
+        'timings': graph['timings'],
+        'critical_path': graph['critical_path'],
+        'critical_seconds': graph['critical_seconds'],
+        'wall_seconds': graph['wall_seconds'],
+    }
+    for lang in ('zh', 'en'):
+        if f"deep_{lang}" in results:
+            st.session_state[f"deep_suggestions_{lang}"] = results[f"deep_{lang}"]
+            for kw, deep in results[f"deep_{lang}"].items():
+                st.session_state[f"{lang}_suggestions_cache"][kw] = deep.get(1, []) + deep.get(2, [])
+        if f"probe_{lang}" in results:
+            st.session_state[f"probe_suggestions_{lang}"] = results[f"probe_{lang}"]
+
+    notices = [('error', message) for message in graph.get('errors', [])]
+    if zh_results or en_results:
+        st.session_state.video_comments = results.get('comments', {})
+        three_layers = results.get('intent') or {}
+        st.session_state.intent_three_layers = three_layers
+        # 同時保留舊版相容（用於下載完整報告）
+        st.session_state.intent_analysis = combine_intent_layers(three_layers)
+        checkpoint_stage('search')
+    else:
+        notices.append(('warning', "找不到相關影片"))
+    return notices
+
+def apply_extract_result(analyses):
+    st.session_state.video_analyses = {
+        'zh': [a for a in analyses if a.get('market') == 'zh'],
+        'en': [a for a in analyses if a.get('market') == 'en'],
+    }
+    checkpoint_stage('extract')
+    success_count = sum(1 for a in analyses if a['success'])
+    cached_count = sum(1 for a in analyses if a.get('cached'))
+    transcript_count = sum(1 for a in analyses if a.get('content_source') == 'transcript' and not a.get('cached'))
+    cached_note = f"（其中 {cached_count} 支來自快取）" if cached_count else ""
+    cached_note += f"（{transcript_count} 支使用字幕分析）" if transcript_count else ""
+    return [('success', f"✅ 影片分析完成！成功 {success_count}/{len(analyses)} 支{cached_note}")]
+
+def apply_strategy_result(results):
+    st.session_state.strategy_results = results
+    checkpoint_stage('strategy')
+    return [('success', f"✅ 已生成 {len(results)} 個策略模組")]
+
+def apply_bulk_result(result):
+    st.session_state.bulk_run = {k: v for k, v in result.items() if k != 'merged'}
+    notices = [('success', f"✅ 大量關鍵字研究完成：{result['keywords']} 個關鍵字、{result['chunks']} 批、{result['videos']} 支影片")]
+    if result['failed_chunks']:
+        notices.append(('warning', f"{result['failed_chunks']} 批失敗，用同一個執行目錄重新開始會只重跑失敗的批次"))
+    return notices
+
+JOB_APPLIERS = {
+    'search': apply_search_result,
+    'extract': apply_extract_result,
+    'strategy': apply_strategy_result,
+    'bulk': apply_bulk_result,
+}
+
+def remember_trace(trace_dict):
+    """保留最近幾次執行的 trace，給側邊欄的瀑布圖用"""
+    if trace_dict and trace_dict['spans']:
+        st.session_state.traces = (st.session_state.traces + [trace_dict])[-5:]
+
+for job in job_manager.jobs_for(st.session_state.session_id):
+    if job['status'] in ('done', 'failed', 'cancelled'):
+        remember_trace(job.get('trace'))
+    if job['status'] == 'done':
+        st.session_state.job_notices += JOB_APPLIERS[job['kind']](job['result'])
+    elif job['status'] == 'failed':
+        st.session_state.job_notices.append(('error', f"背景工作失敗：{job['error']}"))
+    elif job['status'] == 'cancelled':
+        st.session_state.job_notices.append(('warning', "已取消執行"))
+    else:
+        continue
+    job_manager.discard(job['id'])
+
+def show_job_status(kind):
+    """在按鈕下方顯示該種類背景工作的進度與取消按鈕；有工作在跑時回傳 True"""
+    jobs = [j for j in job_manager.active(st.session_state.session_id) if j['kind'] == kind]
+    if not jobs:
+        return False
+    job = jobs[0]
+    elapsed = time.time() - (job['started'] or job['created'])
+    st.progress(job['progress'], text=f"⏳ 背景執行中（{elapsed:.0f} 秒）{job['message']}")
+    if kind == 'search' and job['detail']:
+        st.markdown(stage_timings_md(job['detail']))
+    if st.button("⏹️ 取消", key=f"cancel_job_{kind}"):
+        job_manager.cancel(job['id'])
+        st.rerun()
+    return True
+
+for level, message in st.session_state.job_notices:
+    getattr(st, level)(message)
+st.session_state.job_notices = []
+
+# 執行追蹤：每個外部呼叫與階段的瀑布圖（依 thread 分軌），可匯出給 chrome://tracing／Perfetto
+if st.session_state.traces:
+    with st.sidebar:
+        with st.expander("🧭 執行追蹤"):
+            trace_names = [
+                f"{datetime.fromtimestamp(t['started']).strftime('%H:%M:%S')}｜{t['name']}（{t['duration'] or 0:.1f} 秒）"
+                for t in st.session_state.traces
+            ]
+            trace_index = st.selectbox(
+                "選擇執行", range(len(trace_names)), index=len(trace_names) - 1,
+                format_func=lambda i: trace_names[i]
+            )
+            selected_trace = st.session_state.traces[trace_index]
+            pd = lazy_import("pandas")
+            alt = lazy_import("altair")
+            span_df = pd.DataFrame([
+                {
+                    'span': s['name'],
+                    'category': s['name'].split('.')[0].split(':')[0],
+                    'thread': s['thread'],
+                    'start': s['start'],
+                    'end': s['start'] + s['duration'],
+                    'ms': round(s['duration'] * 1000),
+                    'bytes': s['attrs'].get('bytes', 0),
+                    'tokens': s['attrs'].get('total_tokens', 0),
+                    'retries': s['attrs'].get('retries', 0),
+                    'error': s['attrs'].get('error', ''),
+                }
+                for s in selected_trace['spans']
+            ])
+            st.altair_chart(
+                alt.Chart(span_df).mark_bar().encode(
+                    x=alt.X('start:Q', title="秒"),
+                    x2='end:Q',
+                    y=alt.Y('thread:N', title=None),
+                    color=alt.Color('category:N', legend=alt.Legend(orient="bottom", title=None)),
+                    tooltip=['span', 'ms', 'bytes', 'tokens', 'retries', 'error'],
+                ),
+                use_container_width=True,
+            )
+            summary_df = pd.DataFrame([
+                {'span': name, **entry, 'total_s': round(entry['total_s'], 2), 'max_s': round(entry['max_s'], 2)}
+                for name, entry in tracing.summarize(selected_trace).items()
+            ]).sort_values('total_s', ascending=False)
+            st.dataframe(summary_df, hide_index=True, use_container_width=True)
+            st.download_button(
+                "📥 匯出 trace（chrome://tracing／Perfetto）",
+                json.dumps(tracing.to_chrome_trace(selected_trace), ensure_ascii=False),
+                file_name=f"trace_{selected_trace['name']}_{datetime.fromtimestamp(selected_trace['started']).strftime('%Y%m%d_%H%M%S')}.json",
+                mime="application/json",
+            )
 
 # ============================================================
 # STEP 1: 關鍵字輸入與搜尋
@@ -1464,130 +797,97 @@ with st.container(border=True):
         st.info("🎯 將搜尋：" + " + ".join(search_info_parts))
         
         if st.button("🚀 執行批次搜尋與三層意圖分析", type="primary"):
+            search_errors = []
             if not GEMINI_API_KEY or not YOUTUBE_API_KEY:
                 st.error("請先在左側設定 API Key")
             else:
-                zh_results = []
-                en_results = []
-
-                # 搜尋中文市場
-                if has_zh:
-                    with st.spinner(f"正在搜尋中文市場 ({len(st.session_state.zh_keywords)} 個關鍵字)..."):
-                        zh_results = search_multiple_keywords(
-                            YOUTUBE_API_KEY,
-                            st.session_state.zh_keywords,
-                            MAX_RESULTS_PER_KEYWORD,
-                            lang="zh"
-                        )
-
-                # 搜尋英文市場
-                if has_en:
-                    with st.spinner(f"正在搜尋英文市場 ({len(st.session_state.en_keywords)} 個關鍵字)..."):
-                        en_results = search_multiple_keywords(
-                            YOUTUBE_API_KEY,
-                            st.session_state.en_keywords,
-                            MAX_RESULTS_PER_KEYWORD,
-                            lang="en"
-                        )
-
-                # 查頻道訂閱數（供第二層「小蝦米打大鯨魚」異常偵測）
-                if zh_results or en_results:
-                    with st.spinner("正在查詢頻道訂閱數..."):
-                        channel_stats = fetch_channel_stats(
-                            YOUTUBE_API_KEY,
-                            [v.get('channel_id', '') for v in zh_results + en_results]
-                        )
-                        for v in zh_results + en_results:
-                            v['subscriber_count'] = channel_stats.get(v.get('channel_id', ''), 0)
-
-                st.session_state.search_results = {'zh': zh_results, 'en': en_results}
-                st.session_state.video_analyses = {'zh': [], 'en': []}
-                st.session_state.strategy_results = {}
-
-                if zh_results or en_results:
-                    # 如果尚未做 deep suggest，先自動執行
-                    if has_zh and not st.session_state.deep_suggestions_zh:
-                        with st.spinner("正在深度展開中文長尾詞..."):
-                            for kw in st.session_state.zh_keywords:
-                                if kw not in st.session_state.deep_suggestions_zh:
-                                    deep = get_youtube_suggestions_deep(kw, lang="zh-TW", depth=2)
-                                    st.session_state.deep_suggestions_zh[kw] = deep
-                                    all_sug = deep.get(1, []) + deep.get(2, [])
-                                    st.session_state.zh_suggestions_cache[kw] = all_sug
-
-                    if has_en and not st.session_state.deep_suggestions_en:
-                        with st.spinner("正在深度展開英文長尾詞..."):
-                            for kw in st.session_state.en_keywords:
-                                if kw not in st.session_state.deep_suggestions_en:
-                                    deep = get_youtube_suggestions_deep(kw, lang="en", depth=2)
-                                    st.session_state.deep_suggestions_en[kw] = deep
-                                    all_sug = deep.get(1, []) + deep.get(2, [])
-                                    st.session_state.en_suggestions_cache[kw] = all_sug
-
-                    # 修飾詞探針（供意圖分析與關鍵字總表使用）
-                    with st.spinner("正在執行修飾詞探針（教學/推薦/比較/缺點…）..."):
-                        if has_zh:
-                            for kw in st.session_state.zh_keywords:
-                                if kw not in st.session_state.probe_suggestions_zh:
-                                    st.session_state.probe_suggestions_zh[kw] = probe_youtube_suggestions(kw, lang="zh-TW", market="zh")
-                        if has_en:
-                            for kw in st.session_state.en_keywords:
-                                if kw not in st.session_state.probe_suggestions_en:
-                                    st.session_state.probe_suggestions_en[kw] = probe_youtube_suggestions(kw, lang="en", market="en")
-
-                    # 抓取前 5 名影片的熱門留言（含回覆串）
-                    with st.spinner("正在抓取排名前 5 影片的熱門留言（含回覆串）..."):
-                        videos_by_keyword = {}
-                        for v in zh_results + en_results:
-                            kw = v.get('source_keyword', '')
-                            if kw not in videos_by_keyword:
-                                videos_by_keyword[kw] = []
-                            videos_by_keyword[kw].append(v)
-
-                        comments = batch_fetch_comments(
-                            YOUTUBE_API_KEY,
-                            videos_by_keyword,
-                            top_n=5,
-                            max_per_video=50
-                        )
-                        st.session_state.video_comments = comments
-
-                    # 三層對撞意圖分析 + 洞察引擎
-                    with st.spinner("正在執行意圖分析（需求端 → 供給端 → 觀眾落差 → 洞察對撞）..."):
-                        en_kws = st.session_state.en_keywords if ENABLE_ENGLISH else []
-                        three_layers = analyze_intent_three_layers(
-                            GEMINI_API_KEY,
-                            st.session_state.zh_keywords,
-                            en_kws,
-                            zh_results,
-                            en_results,
-                            st.session_state.deep_suggestions_zh,
-                            st.session_state.deep_suggestions_en,
-                            st.session_state.video_comments,
-                            MODEL_VERSION,
-                            probe_suggestions_zh=st.session_state.probe_suggestions_zh,
-                            probe_suggestions_en=st.session_state.probe_suggestions_en
-                        )
-                        st.session_state.intent_three_layers = three_layers
-
-                        # 同時保留舊版相容（用於下載完整報告）
-                        combined = ""
-                        for layer_key in ['layer1', 'layer2', 'layer3']:
-                            if layer_key in three_layers:
-                                combined += three_layers[layer_key] + "\n\n---\n\n"
-                        st.session_state.intent_analysis = combined
+                zh_kws = st.session_state.zh_keywords if has_zh else []
+                en_kws = st.session_state.en_keywords if has_en else []
+                stages = search_pipeline_stages(
+                    GEMINI_API_KEY,
+                    YOUTUBE_API_KEY,
+                    zh_kws,
+                    en_kws,
+                    MODEL_VERSION,
+                    max_results_per_keyword=MAX_RESULTS_PER_KEYWORD,
+                    comment_top_n=5,
+                    deep_suggestions_zh=st.session_state.deep_suggestions_zh,
+                    deep_suggestions_en=st.session_state.deep_suggestions_en,
+                    probe_suggestions_zh=st.session_state.probe_suggestions_zh,
+                    probe_suggestions_en=st.session_state.probe_suggestions_en,
+                    on_error=search_errors.append
+                )
+                # 每次搜尋開一筆新的執行紀錄
+                st.session_state.run_id = new_run_id()
+                # 互不相依的階段（搜尋／長尾展開／探針）會同時跑，進度在下方即時顯示
+                job_manager.submit(st.session_state.session_id, 'search', search_job, stages, search_errors)
+                st.rerun()
 
-                    st.rerun()
-                else:
-                    st.warning("找不到相關影片")
+        show_job_status('search')
     else:
         st.warning("請先加入至少一個關鍵字（中文或英文）")
 
+# --- 大量關鍵字匯入：數百個關鍵字分批串流處理，每批結果寫進 runs/bulk_<id>/ ---
+with st.container(border=True):
+    st.subheader("📦 大量關鍵字匯入（CSV／TXT）")
+    st.caption("每批各自跑長尾展開 → 搜尋 → 留言 → 三層意圖分析，處理完就寫檔釋放記憶體；最後把各批洞察合併成一份報告。"
+               "CSV 取 keyword／關鍵字 欄（可加 market 欄 zh／en），TXT 每行一個")
+    bulk_file = st.file_uploader("關鍵字檔", type=["csv", "txt"], key="bulk_file")
+    bulk_cols = st.columns(2)
+    bulk_chunk_size = bulk_cols[0].number_input("每批關鍵字數", 5, 50, bulk.BULK_CHUNK_SIZE, step=5)
+    bulk_resume_dir = bulk_cols[1].text_input(
+        "接續執行目錄（選填）", value="",
+        help="填入中斷的執行目錄，已完成的批次會直接沿用（關鍵字檔與批次大小須與上次相同）；留空則開新目錄"
+    )
+    if bulk_file is not None:
+        bulk_data = bulk_file.getvalue()
+        bulk_total = sum(1 for _ in bulk.read_keywords(bulk_data, bulk_file.name))
+        st.info(f"🎯 共 {bulk_total} 個關鍵字，分 {-(-bulk_total // bulk_chunk_size)} 批處理")
+        if st.button("🚀 開始大量關鍵字研究", disabled=bulk_total == 0):
+            if not GEMINI_API_KEY or not YOUTUBE_API_KEY:
+                st.error("請先在左側設定 API Key")
+            else:
+                job_manager.submit(
+                    st.session_state.session_id, 'bulk', bulk_job,
+                    GEMINI_API_KEY, YOUTUBE_API_KEY, bulk_data, bulk_file.name,
+                    bulk_resume_dir.strip() or bulk.new_bulk_dir(), bulk_total, MODEL_VERSION,
+                    chunk_size=int(bulk_chunk_size), max_results_per_keyword=MAX_RESULTS_PER_KEYWORD,
+                )
+                st.rerun()
+    show_job_status('bulk')
+
+    bulk_run = st.session_state.bulk_run
+    if bulk_run:
+        st.caption(f"📁 {bulk_run['run_dir']}｜{bulk_run['keywords']} 個關鍵字、{bulk_run['chunks']} 批、{bulk_run['videos']} 支影片")
+        keyword_rows = list(bulk.read_jsonl(os.path.join(bulk_run['run_dir'], "keywords.jsonl")))
+        if keyword_rows:
+            pd = lazy_import("pandas")
+            bulk_df = pd.DataFrame(keyword_rows)
+            bulk_df['anomalies'] = bulk_df['anomalies'].map("、".join)
+            st.dataframe(bulk_df, hide_index=True, use_container_width=True)
+        merged_path = os.path.join(bulk_run['run_dir'], "merged.md")
+        if os.path.exists(merged_path):
+            with open(merged_path, encoding="utf-8") as f:
+                merged_md = f.read()
+            with st.expander("💡 跨批次洞察", expanded=True):
+                st.markdown(merged_md)
+            st.download_button(
+                "📥 下載跨批次洞察（Markdown）", merged_md,
+                file_name=f"{os.path.basename(bulk_run['run_dir'])}_insights.md", mime="text/markdown",
+            )
+
 # 顯示三層意圖分析結果
 if st.session_state.intent_three_layers:
     with st.container(border=True):
         st.subheader("📊 意圖分析報告（三層對撞 → 洞察）")
 
+        if st.session_state.get('stage_run'):
+            stage_run = st.session_state.stage_run
+            with st.expander(f"⏱️ 階段耗時（總計 {stage_run['wall_seconds']:.1f} 秒）"):
+                path_labels = " → ".join(stage_run['timings'][n]['label'] for n in stage_run['critical_path'])
+                st.caption(f"關鍵路徑（{stage_run['critical_seconds']:.1f} 秒）：{path_labels}")
+                st.markdown(stage_timings_md(stage_run['timings'], stage_run['critical_path']))
+
         layer_tabs = st.tabs([
             "💡 洞察引擎（三層對撞）",
             "🔍 需求端：搜尋詞異常",
@@ -1600,22 +900,31 @@ if st.session_state.intent_three_layers:
             with tab:
                 content = st.session_state.intent_three_layers.get(key, "尚未分析")
                 st.markdown(content)
+                trends = st.session_state.intent_three_layers.get('trends')
+                if key == 'layer1' and trends and (trends['rising'] or trends['new']):
+                    with st.expander("📈 自動完成的新詞與上升詞（與過去快照比較）"):
+                        st.markdown(trending_terms_md(trends))
+                if key == 'layer1' and st.session_state.intent_three_layers.get('tag_graph_error'):
+                    st.warning(st.session_state.intent_three_layers['tag_graph_error'])
+                if key == 'layer1' and st.session_state.intent_three_layers.get('tag_graph'):
+                    with st.expander("🏷️ 競品 Tags 共現與前排缺口（第一層 prompt 的輸入）"):
+                        st.markdown(tag_cooccurrence_md(st.session_state.intent_three_layers['tag_graph']))
+                if key == 'layer3' and st.session_state.intent_three_layers.get('comment_stats'):
+                    cs = st.session_state.intent_three_layers['comment_stats']
+                    st.caption(
+                        f"💬 留言前處理：共 {cs.get('input', 0)} 則，去除垃圾 {cs.get('spam', 0)}、純表情 {cs.get('noise', 0)}、"
+                        f"重複 {cs.get('duplicates', 0)}，依讚數抽樣送出 {cs.get('sampled', 0)} 則（約 {cs.get('tokens', 0):,} tokens）"
+                    )
+                if key == 'layer2' and st.session_state.intent_three_layers.get('anomalies'):
+                    with st.expander("🧮 程式偵測到的異常（第二層 prompt 的輸入）"):
+                        st.markdown(anomalies_md(st.session_state.intent_three_layers['anomalies']))
 
         # 下載合併報告
-        combined_report = f"# 三層意圖分析報告\n\n"
-        combined_report += f"生成時間：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-        combined_report += f"研究關鍵字（中文）：{', '.join(st.session_state.zh_keywords)}\n"
-        if st.session_state.en_keywords:
-            combined_report += f"研究關鍵字（英文）：{', '.join(st.session_state.en_keywords)}\n"
-        combined_report += "\n---\n\n"
-        combined_report += "## 💡 洞察引擎（三層對撞）\n\n"
-        combined_report += st.session_state.intent_three_layers.get('synthesis', '') + "\n\n---\n\n"
-        combined_report += "## 需求端：搜尋詞異常\n\n"
-        combined_report += st.session_state.intent_three_layers.get('layer1', '') + "\n\n---\n\n"
-        combined_report += "## 供給端：供需錯位\n\n"
-        combined_report += st.session_state.intent_three_layers.get('layer2', '') + "\n\n---\n\n"
-        combined_report += "## 反應端：觀眾落差\n\n"
-        combined_report += st.session_state.intent_three_layers.get('layer3', '') + "\n\n"
+        combined_report = generate_intent_report_md(
+            st.session_state.zh_keywords,
+            st.session_state.en_keywords,
+            st.session_state.intent_three_layers
+        )
 
         st.download_button(
             "📥 下載三層意圖分析報告",
@@ -1674,36 +983,43 @@ if st.session_state.zh_keywords or st.session_state.en_keywords:
                             st.session_state.deep_suggestions_en[kw] = deep
                             st.session_state.en_suggestions_cache[kw] = deep.get(1, []) + deep.get(2, [])
 
-                # 補齊修飾詞探針
-                with st.spinner("正在執行修飾詞探針..."):
-                    for kw in st.session_state.zh_keywords:
-                        if kw not in st.session_state.probe_suggestions_zh:
-                            st.session_state.probe_suggestions_zh[kw] = probe_youtube_suggestions(kw, lang="zh-TW", market="zh")
-                    for kw in st.session_state.en_keywords:
-                        if kw not in st.session_state.probe_suggestions_en:
-                            st.session_state.probe_suggestions_en[kw] = probe_youtube_suggestions(kw, lang="en", market="en")
-
-                with st.spinner("正在整併所有來源，生成關鍵字總表..."):
-                    try:
-                        table = generate_keyword_master_table(
-                            GEMINI_API_KEY,
-                            MODEL_VERSION,
-                            st.session_state.zh_keywords,
-                            st.session_state.en_keywords,
-                            st.session_state.deep_suggestions_zh,
-                            st.session_state.deep_suggestions_en,
-                            st.session_state.probe_suggestions_zh,
-                            st.session_state.probe_suggestions_en,
-                            collect_video_tags(_all_search_videos),
-                            [v['title'] for v in _all_search_videos],
-                            st.session_state.video_comments
-                        )
-                        st.session_state.keyword_table = table
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"生成失敗: {e}")
+                generated = False
+                with tracing.start_trace("keyword_table") as trace:
+                    # 補齊修飾詞探針
+                    with st.spinner("正在執行修飾詞探針..."):
+                        for kw in st.session_state.zh_keywords:
+                            if kw not in st.session_state.probe_suggestions_zh:
+                                st.session_state.probe_suggestions_zh[kw] = probe_youtube_suggestions(kw, lang="zh-TW", market="zh")
+                        for kw in st.session_state.en_keywords:
+                            if kw not in st.session_state.probe_suggestions_en:
+                                st.session_state.probe_suggestions_en[kw] = probe_youtube_suggestions(kw, lang="en", market="en")
+
+                    with st.spinner("正在整併所有來源，生成關鍵字總表..."):
+                        try:
+                            table = generate_keyword_master_table(
+                                GEMINI_API_KEY,
+                                MODEL_VERSION,
+                                st.session_state.zh_keywords,
+                                st.session_state.en_keywords,
+                                st.session_state.deep_suggestions_zh,
+                                st.session_state.deep_suggestions_en,
+                                st.session_state.probe_suggestions_zh,
+                                st.session_state.probe_suggestions_en,
+                                collect_video_tags(_all_search_videos),
+                                [v['title'] for v in _all_search_videos],
+                                st.session_state.video_comments
+                            )
+                            st.session_state.keyword_table = table
+                            checkpoint_stage('keyword_table')
+                            generated = True
+                        except Exception as e:
+                            st.error(f"生成失敗: {e}")
+                remember_trace(trace.to_dict())
+                if generated:
+                    st.rerun()
 
         if st.session_state.keyword_table:
+            pd = lazy_import("pandas")
             df = pd.DataFrame(st.session_state.keyword_table)
             df.insert(0, "加入", False)
 
@@ -1718,7 +1034,10 @@ if st.session_state.zh_keywords or st.session_state.en_keywords:
                     "market": st.column_config.TextColumn("市場"),
                     "intent": st.column_config.TextColumn("意圖類型"),
                     "sources": st.column_config.TextColumn("來源", help="跨來源交叉出現的詞，需求更可信"),
-                    "demand": st.column_config.NumberColumn("需求強度"),
+                    "demand": st.column_config.NumberColumn("需求強度", help="依需求分數分成 1～5 級"),
+                    "score": st.column_config.ProgressColumn("需求分數", min_value=0, max_value=100, format="%.1f",
+                                                             help="本地計算：相關性、建議詞、Tags、標題、留言提及次數加權，跨來源加分"),
+                    "evidence": st.column_config.TextColumn("證據", width="medium"),
                     "note": st.column_config.TextColumn("說明", width="large"),
                 },
                 key="kw_table_editor"
@@ -1770,15 +1089,10 @@ if zh_results or en_results:
             st.markdown("### 🇹🇼 繁體中文市場")
             st.caption(f"共 {len(zh_results)} 支影片")
             
-            videos_by_keyword = {}
-            for video in zh_results:
-                kw = video.get('source_keyword', '其他')
-                if kw not in videos_by_keyword:
-                    videos_by_keyword[kw] = []
-                videos_by_keyword[kw].append(video)
+            videos_by_keyword = VideoStore(zh_results).group_by_keyword()
             
             for keyword, videos in videos_by_keyword.items():
-                with st.expander(f"🔑 {keyword} ({len(videos)} 支)", expanded=True):
+                with st.expander(f"🔑 {keyword or '其他'} ({len(videos)} 支)", expanded=True):
                     cols = st.columns(3)
                     for idx, video in enumerate(videos):
                         with cols[idx % 3]:
@@ -1794,15 +1108,10 @@ if zh_results or en_results:
             st.markdown("### 🇺🇸 英文市場")
             st.caption(f"共 {len(en_results)} 支影片")
             
-            videos_by_keyword = {}
-            for video in en_results:
-                kw = video.get('source_keyword', '其他')
-                if kw not in videos_by_keyword:
-                    videos_by_keyword[kw] = []
-                videos_by_keyword[kw].append(video)
+            videos_by_keyword = VideoStore(en_results).group_by_keyword()
             
             for keyword, videos in videos_by_keyword.items():
-                with st.expander(f"🔑 {keyword} ({len(videos)} 支)", expanded=True):
+                with st.expander(f"🔑 {keyword or '其他'} ({len(videos)} 支)", expanded=True):
                     cols = st.columns(3)
                     for idx, video in enumerate(videos):
                         with cols[idx % 3]:
@@ -1825,26 +1134,19 @@ if zh_results or en_results:
                 if not GEMINI_API_KEY:
                     st.error("請先設定 Gemini API Key")
                 else:
-                    progress_bar = st.progress(0)
-                    status_text = st.empty()
-                    status_text.info(f"正在使用 {TRANSCRIPT_MODEL} 爬取 {len(selected_videos)} 支影片...")
-                    
-                    analyses = batch_extract_videos(
-                        GEMINI_API_KEY, 
+                    job_manager.submit(
+                        st.session_state.session_id,
+                        'extract',
+                        extract_job,
+                        GEMINI_API_KEY,
                         selected_videos,
-                        max_workers=MAX_CONCURRENT_AI
+                        max_workers=MAX_CONCURRENT_AI,
+                        use_cache=USE_ANALYSIS_CACHE,
+                        cache_ttl_days=ANALYSIS_CACHE_TTL_DAYS,
+                        use_transcripts=USE_TRANSCRIPTS
                     )
-                    
-                    progress_bar.progress(100)
-                    
-                    # 分類結果
-                    zh_analyses = [a for a in analyses if a.get('market') == 'zh']
-                    en_analyses = [a for a in analyses if a.get('market') == 'en']
-                    st.session_state.video_analyses = {'zh': zh_analyses, 'en': en_analyses}
-                    
-                    success_count = sum(1 for a in analyses if a['success'])
-                    status_text.success(f"✅ 完成！成功 {success_count}/{len(analyses)} 支")
                     st.rerun()
+            show_job_status('extract')
         else:
             st.warning("請先勾選至少一個影片")
     
@@ -1859,6 +1161,12 @@ if zh_results or en_results:
             
             success_count = sum(1 for a in all_analyses if a['success'])
             st.caption(f"成功 {success_count}/{len(all_analyses)} 支")
+
+            analysis_query = st.text_input("🔎 篩選分析（比對主題、論點、缺口等欄位，空白分隔多個詞）", key="analysis_filter")
+            if analysis_query:
+                zh_analyses = search_analyses(zh_analyses, analysis_query)
+                en_analyses = search_analyses(en_analyses, analysis_query)
+                st.caption(f"符合 {len(zh_analyses) + len(en_analyses)} 支")
             
             if zh_analyses:
                 st.markdown("#### 🇹🇼 中文影片分析")
@@ -1868,7 +1176,7 @@ if zh_results or en_results:
                         st.markdown(f"**網址**: {analysis['url']}")
                         st.markdown(f"**觀看數**: {analysis['view_count']:,}")
                         st.markdown("---")
-                        st.markdown(analysis['ai_analysis'])
+                        st.markdown(analysis_markdown(analysis))
             
             if en_analyses:
                 st.markdown("#### 🇺🇸 英文影片分析")
@@ -1878,13 +1186,17 @@ if zh_results or en_results:
                         st.markdown(f"**網址**: {analysis['url']}")
                         st.markdown(f"**觀看數**: {analysis['view_count']:,}")
                         st.markdown("---")
-                        st.markdown(analysis['ai_analysis'])
+                        st.markdown(analysis_markdown(analysis))
             
             st.markdown("---")
-            all_analyses_md = generate_all_analyses_md(all_analyses)
-            st.download_button(
+            if st.button("📝 產生全部影片分析（合併）", key="prepare_all_analyses"):
+                with st.spinner("產生中..."):
+                    prepare_export("all_video_analyses.md", lambda path: exports.write_markdown(
+                        path, iter_all_analyses_md(all_analyses)
+                    ))
+            export_download_button(
+                "all_video_analyses.md",
                 "📥 下載全部影片分析（合併）",
-                all_analyses_md,
                 f"all_video_analyses_{datetime.now().strftime('%Y%m%d_%H%M')}.md",
                 mime="text/markdown",
                 type="primary"
@@ -1941,26 +1253,35 @@ if all_analyses:
     with st.container(border=True):
         st.subheader("3-3. 生成策略")
         st.caption(f"使用 `{MODEL_VERSION}` 模型，{len(selected_modules)} 個 AI 將同時運作")
+
+        use_map_reduce = st.checkbox(
+            "📦 先按關鍵字濃縮競品分析（map-reduce）",
+            value=len(all_analyses) > MAP_REDUCE_THRESHOLD,
+            help=f"競品影片多時（>{MAP_REDUCE_THRESHOLD} 支預設開啟），先把每個關鍵字的分析並行濃縮成 brief，策略模組只讀 brief，prompt 長度與等待時間不再隨影片數線性成長",
+            key="use_map_reduce"
+        )
         
         if selected_modules:
             if st.button("🚀 生成策略報告", type="primary"):
-                with st.spinner(f"正在同時執行 {len(selected_modules)} 個策略分析..."):
-                    keywords_info = {
-                        'zh': st.session_state.zh_keywords,
-                        'en': st.session_state.en_keywords if ENABLE_ENGLISH else []
-                    }
-                    
-                    results = batch_generate_strategies(
-                        GEMINI_API_KEY,
-                        selected_modules,
-                        all_analyses,
-                        keywords_info,
-                        user_goal,
-                        MODEL_VERSION,
-                        has_english
-                    )
-                    st.session_state.strategy_results = results
-                    st.rerun()
+                keywords_info = {
+                    'zh': st.session_state.zh_keywords,
+                    'en': st.session_state.en_keywords if ENABLE_ENGLISH else []
+                }
+                job_manager.submit(
+                    st.session_state.session_id,
+                    'strategy',
+                    strategy_job,
+                    GEMINI_API_KEY,
+                    selected_modules,
+                    all_analyses,
+                    keywords_info,
+                    user_goal,
+                    MODEL_VERSION,
+                    has_english,
+                    map_reduce=use_map_reduce
+                )
+                st.rerun()
+            show_job_status('strategy')
         else:
             st.warning("請先選擇至少一個策略模組")
     
@@ -1987,47 +1308,50 @@ if all_analyses:
 # ============================================================
 # 全部下載區
 # ============================================================
-if st.session_state.strategy_results:
+if st.session_state.search_results.get('zh') or st.session_state.search_results.get('en'):
     st.markdown("---")
     st.header("📦 一鍵下載全部")
-    
+
     with st.container(border=True):
-        full_report = f"# YouTube 戰略內容分析完整報告\n\n"
-        full_report += f"生成時間：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-        full_report += f"研究關鍵字（中文）：{', '.join(st.session_state.zh_keywords)}\n"
-        if st.session_state.en_keywords:
-            full_report += f"研究關鍵字（英文）：{', '.join(st.session_state.en_keywords)}\n"
-        full_report += "\n---\n\n"
-        
-        full_report += "# PART 1: 意圖分析（三層對撞 → 洞察）\n\n"
-        if st.session_state.intent_three_layers:
-            full_report += "## 💡 洞察引擎（三層對撞）\n\n"
-            full_report += st.session_state.intent_three_layers.get('synthesis', '') + "\n\n---\n\n"
-            full_report += "## 需求端：搜尋詞異常\n\n"
-            full_report += st.session_state.intent_three_layers.get('layer1', '') + "\n\n---\n\n"
-            full_report += "## 供給端：供需錯位\n\n"
-            full_report += st.session_state.intent_three_layers.get('layer2', '') + "\n\n---\n\n"
-            full_report += "## 反應端：觀眾落差\n\n"
-            full_report += st.session_state.intent_three_layers.get('layer3', '') + "\n\n"
-        elif st.session_state.intent_analysis:
-            full_report += st.session_state.intent_analysis + "\n\n"
-        full_report += "---\n\n"
-        
-        all_analyses = st.session_state.video_analyses.get('zh', []) + st.session_state.video_analyses.get('en', [])
-        full_report += "# PART 2: 競品影片分析\n\n"
-        full_report += generate_all_analyses_md(all_analyses)
-        full_report += "\n---\n\n"
-        
-        full_report += "# PART 3: 策略報告\n\n"
-        for key, content in st.session_state.strategy_results.items():
-            full_report += content + "\n\n---\n\n"
-        
-        st.download_button(
-            "📥 下載完整報告（含所有分析）",
-            full_report,
-            f"youtube_full_report_{datetime.now().strftime('%Y%m%d_%H%M')}.md",
-            mime="text/markdown",
-            type="primary"
-        )
-        
-        st.caption("包含：市場意圖分析 + 所有影片分析 + 全部策略報告")
+        # 匯出檔都是按下才產生（逐段串流寫進 runs/<run_id>/），不在每次 rerun 重組整份報告
+        if st.session_state.strategy_results:
+            if st.button("📝 產生完整報告（含所有分析）", key="prepare_full_report"):
+                all_analyses = st.session_state.video_analyses.get('zh', []) + st.session_state.video_analyses.get('en', [])
+                with st.spinner("產生中..."):
+                    prepare_export("full_report.md", lambda path: exports.write_markdown(path, iter_full_report_md(
+                        st.session_state.zh_keywords,
+                        st.session_state.en_keywords,
+                        st.session_state.intent_three_layers,
+                        st.session_state.intent_analysis,
+                        all_analyses,
+                        st.session_state.strategy_results
+                    )))
+            export_download_button(
+                "full_report.md",
+                "📥 下載完整報告（含所有分析）",
+                f"youtube_full_report_{datetime.now().strftime('%Y%m%d_%H%M')}.md",
+                mime="text/markdown",
+                type="primary"
+            )
+
+            st.caption("包含：市場意圖分析 + 所有影片分析 + 全部策略報告")
+
+        if st.button("🗜️ 打包完整執行資料（zip）", key="prepare_bundle"):
+            with st.spinner("打包中..."):
+                prepare_export("bundle.zip", lambda path: exports.write_run_bundle(path, {
+                    name: st.session_state[name] for name in exports.BUNDLE_ARTIFACTS if name in st.session_state
+                }))
+        if export_download_button(
+            "bundle.zip",
+            "📥 下載完整資料包",
+            f"youtube_run_{st.session_state.get('run_id', '')}.zip",
+            mime="application/zip",
+        ):
+            st.caption("影片與留言（JSON Lines）、關鍵字總表（Parquet）、各層意圖分析與策略（Markdown）、完整報告")
+
+# ============================================================
+# 背景工作輪詢：有工作在跑就每秒重跑一次 script 更新進度（期間操作介面不會中斷工作）
+# ============================================================
+if job_manager.active(st.session_state.session_id):
+    time.sleep(1)
+    st.rerun()
@@ -0,0 +1,185 @@
+"""批次研究執行器：不開 Streamlit，一次跑很多組關鍵字（供 cron／worker 夜間排程使用）。
+
+用法：
+    python batch_runner.py keyword_sets.jsonl --out outputs/ --workers 4
+
+關鍵字組檔案格式：
+    .jsonl / .json：每組一個物件 {"name": "...", "zh": [...], "en": [...], "user_goal": "...", "modules": [...]}
+    .txt：每行一組，中文關鍵字以逗號分隔
+
+API 金鑰從環境變數 GEMINI_API_KEY、YOUTUBE_API_KEY 讀取（或用 --gemini-key / --youtube-key 指定）。
+每組關鍵字輸出 <序號>_<名稱>.json（完整產出）與 .md（完整報告）；加 --trace 另存各呼叫耗時的 .trace.json，加 --bundle 另存完整資料包 .zip。
+各階段同時寫入 runs/batch_<序號>_<名稱>/ 的 checkpoint；中斷後加 --resume 重跑，已完成的階段會直接沿用。
+
+加 --record cassettes/demo 會把所有外部 API 流量錄下來；之後用 --replay cassettes/demo 可在離線環境重跑
+（不需要 API 金鑰，--replay-latency 指定每次呼叫的模擬延遲秒數，預設照錄製時的耗時）。
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import sys
+import time
+
+import engine
+import exports
+import replay
+import tracing
+
+
+def load_keyword_sets(path):
+    """讀取關鍵字組檔案，回傳 [{name, zh, en, user_goal, modules}]"""
+    with open(path, encoding="utf-8") as f:
+        raw = f.read()
+
+    if path.endswith(".txt"):
+        items = []
+        for line in raw.splitlines():
+            kws = [kw.strip() for kw in line.replace('，', ',').split(',') if kw.strip()]
+            if kws:
+                items.append({'zh': kws})
+    elif path.endswith(".json"):
+        items = json.loads(raw)
+    else:
+        items = [json.loads(line) for line in raw.splitlines() if line.strip()]
+
+    keyword_sets = []
+    for item in items:
+        zh = list(item.get('zh', []))
+        en = list(item.get('en', []))
+        if not zh and not en:
+            continue
+        keyword_sets.append({
+            'name': item.get('name') or ' '.join(zh or en),
+            'zh': zh,
+            'en': en,
+            'user_goal': item.get('user_goal') or engine.DEFAULT_USER_GOAL,
+            'modules': item.get('modules'),
+        })
+    return keyword_sets
+
+
+def _slug(name):
+    return re.sub(r'[\\/:*?"<>|\s]+', '_', name).strip('_')[:80] or "set"
+
+
+def run_keyword_set(index, keyword_set, options):
+    """在 worker process 中跑一組關鍵字並寫出 JSON／Markdown，回傳摘要"""
+    started = time.time()
+    stem = f"{index:04d}_{_slug(keyword_set['name'])}"
+    base = os.path.join(options['out'], stem)
+    try:
+        with tracing.start_trace(keyword_set['name']) as trace:
+            run = engine.run_research(
+                options['gemini_key'],
+                options['youtube_key'],
+                keyword_set['zh'],
+                keyword_set['en'],
+                model_version=options['model'],
+                max_results_per_keyword=options['max_results'],
+                extract_top_n=options['extract_top_n'],
+                strategy_modules=[] if options['no_strategies'] else keyword_set['modules'],
+                user_goal=keyword_set['user_goal'],
+                build_keyword_table=not options['no_keyword_table'],
+                run_id=f"batch_{stem}",
+                resume=options['resume'],
+            )
+        with open(f"{base}.json", "w", encoding="utf-8") as f:
+            json.dump(run, f, ensure_ascii=False, indent=2)
+        if options['trace']:
+            with open(f"{base}.trace.json", "w", encoding="utf-8") as f:
+                json.dump(tracing.to_chrome_trace(trace.to_dict()), f, ensure_ascii=False)
+        all_analyses = run['video_analyses']['zh'] + run['video_analyses']['en']
+        exports.write_markdown(f"{base}.md", engine.iter_full_report_md(
+            run['zh_keywords'], run['en_keywords'], run['intent_three_layers'],
+            run['intent_analysis'], all_analyses, run['strategy_results']
+        ))
+        if options['bundle']:
+            exports.write_run_bundle(f"{base}.zip", run)
+        return {
+            'name': keyword_set['name'],
+            'ok': True,
+            'videos': len(run['search_results']['zh']) + len(run['search_results']['en']),
+            'analyses': len(all_analyses),
+            'seconds': round(time.time() - started, 1),
+            'output': base,
+        }
+    except Exception as e:
+        return {'name': keyword_set['name'], 'ok': False, 'error': str(e), 'seconds': round(time.time() - started, 1)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批次執行 YouTube 戰略內容研究（無介面）")
+    parser.add_argument("keyword_file", help="關鍵字組檔案（.jsonl / .json / .txt）")
+    parser.add_argument("--out", default="outputs", help="輸出目錄")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="同時處理的關鍵字組數（process 數）")
+    parser.add_argument("--model", default="gemini-2.5-flash", help="意圖分析與策略生成模型")
+    parser.add_argument("--max-results", type=int, default=5, help="每個關鍵字抓取影片數")
+    parser.add_argument("--extract-top-n", type=int, default=3, help="每個關鍵字分析排名前 N 的影片")
+    parser.add_argument("--no-strategies", action="store_true", help="不生成策略模組")
+    parser.add_argument("--no-keyword-table", action="store_true", help="不生成關鍵字總表")
+    parser.add_argument("--resume", action="store_true", help="沿用上次中斷時已完成的階段 checkpoint")
+    parser.add_argument("--bundle", action="store_true", help="另存 <序號>_<名稱>.zip 完整資料包（JSONL／Parquet／Markdown）")
+    parser.add_argument("--trace", action="store_true", help="另存 <序號>_<名稱>.trace.json（chrome://tracing／Perfetto 格式）")
+    parser.add_argument("--gemini-key", default=os.environ.get("GEMINI_API_KEY", ""))
+    parser.add_argument("--youtube-key", default=os.environ.get("YOUTUBE_API_KEY", ""))
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument("--record", metavar="DIR", help="把外部 API 流量錄進 cassette 目錄")
+    cassette.add_argument("--replay", metavar="DIR", help="從 cassette 目錄重播，不連網")
+    parser.add_argument("--replay-latency", type=float, help="重播時每次呼叫的固定延遲秒數（預設照錄製耗時）")
+    args = parser.parse_args(argv)
+
+    if args.record or args.replay:
+        # 用環境變數傳給 worker process（fork 與 spawn 都適用）
+        os.environ["YT_CASSETTE"] = args.record or args.replay
+        os.environ["YT_CASSETTE_MODE"] = "record" if args.record else "replay"
+        if args.replay_latency is not None:
+            os.environ["YT_REPLAY_LATENCY"] = str(args.replay_latency)
+        replay.activate_from_env()
+    if args.replay:
+        args.gemini_key = args.gemini_key or "replay"
+        args.youtube_key = args.youtube_key or "replay"
+
+    if not args.gemini_key or not args.youtube_key:
+        parser.error("請設定 GEMINI_API_KEY 與 YOUTUBE_API_KEY（環境變數或參數）")
+
+    keyword_sets = load_keyword_sets(args.keyword_file)
+    if not keyword_sets:
+        parser.error(f"{args.keyword_file} 裡沒有任何關鍵字組")
+    os.makedirs(args.out, exist_ok=True)
+
+    options = {
+        'out': args.out,
+        'gemini_key': args.gemini_key,
+        'youtube_key': args.youtube_key,
+        'model': args.model,
+        'max_results': args.max_results,
+        'extract_top_n': args.extract_top_n,
+        'no_strategies': args.no_strategies,
+        'no_keyword_table': args.no_keyword_table,
+        'resume': args.resume,
+        'trace': args.trace,
+        'bundle': args.bundle,
+    }
+
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [
+            executor.submit(run_keyword_set, idx, ks, options)
+            for idx, ks in enumerate(keyword_sets, 1)
+        ]
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            summary = future.result()
+            if summary['ok']:
+                print(f"[{done}/{len(futures)}] ✅ {summary['name']}：{summary['videos']} 支影片、"
+                      f"{summary['analyses']} 份分析，{summary['seconds']}s → {summary['output']}.md")
+            else:
+                failed += 1
+                print(f"[{done}/{len(futures)}] ❌ {summary['name']}：{summary['error']}", file=sys.stderr)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+"""多人同時使用的負載測試：模擬 N 個 session 同時跑「關鍵字 → 搜尋 → 影片分析 → 策略」完整流程。
+
+每個 session 的操作與 app.py 相同：三個步驟依序送進同一個（process 共用的）JobManager 背景執行，
+外部服務由 bench_pipeline.py 的本機替身伺服器提供，所以量到的是 server 端的排隊與資源競爭，而不是 Google 的波動。
+
+用法：
+    python bench_load.py --sessions 10                      # 10 個 session 同時開始
+    python bench_load.py --sessions 20 --ramp 30 --keywords 5 --overlap 0.3 --out load.json
+    python bench_load.py --sessions 20 --job-workers 8      # 比較不同的背景工作 worker 數
+
+報告每個步驟的延遲 p50/p95/p99（含排隊時間）、同時存在的 thread 數峰值、Python 記憶體峰值與每個 session 平均佔用。
+Streamlit 的 AppTest 只能同步執行單一 session（背景工作靠 rerun 輪詢），所以這裡直接驅動同一套 engine／JobManager。
+"""
+import argparse
+import gc
+import json
+import os
+import pickle
+import platform
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+from bench_pipeline import FAKE_KEY, MODEL, StandIn, git_commit
+
+STEPS = ['search', 'extract', 'strategy']
+
+
+def percentile(values, pct):
+    """nearest-rank 百分位數；沒有資料時回傳 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return round(ordered[index], 3)
+
+
+def session_keywords(index, count, overlap, rng):
+    """每個 session 的關鍵字：overlap 比例來自大家共用的熱門詞（會命中共用快取），其餘是自己的"""
+    shared = [f"熱門主題{i}" for i in range(count)]
+    return [
+        rng.choice(shared) if rng.random() < overlap else f"主題{index}-{k}"
+        for k in range(count)
+    ]
+
+
+def wait_job(manager, job_id, poll=0.05):
+    while True:
+        job = manager.get(job_id)
+        if job['status'] not in ('queued', 'running'):
+            return job
+        time.sleep(poll)
+
+
+def run_session(engine, manager, index, keywords, modules, record):
+    """一個使用者依序按下三個按鈕；每一步等背景工作完成再進行下一步"""
+    session_id = f"load_{index}"
+    started = time.time()
+    result_sizes = 0
+
+    def step(kind, fn, check=None):
+        """送出一個背景工作並等它完成；check(result) 回傳非空字串時，工作雖然跑完也算失敗（例如什麼都沒做出來）"""
+        nonlocal result_sizes
+        job_id = manager.submit(session_id, kind, fn)
+        job = wait_job(manager, job_id)
+        manager.discard(job_id)
+        status, error = job['status'], job['error']
+        if status == 'done' and check is not None:
+            problem = check(job['result'])
+            if problem:
+                status, error = 'failed', problem
+        record({
+            'session': index,
+            'step': kind,
+            'status': status,
+            'error': error,
+            'latency_s': job['finished'] - job['created'],
+            'queue_s': (job['started'] or job['finished']) - job['created'],
+        })
+        if status != 'done':
+            raise RuntimeError(f"{kind} {status}: {error}")
+        result_sizes += len(pickle.dumps(job['result']))
+        return job['result']
+
+    def search_problem(graph):
+        failed = [n for n, t in graph['timings'].items() if t['status'] in ('failed', 'skipped')]
+        if not graph['results'].get('search_zh'):
+            return f"搜尋沒有找到任何影片（{'；'.join(search_errors[:3]) or '沒有錯誤訊息'}）"
+        if failed or search_errors:
+            return f"階段失敗：{', '.join(failed) or '無'}；錯誤 {len(search_errors)} 筆：{'；'.join(search_errors[:3])}"
+        return ""
+
+    def extract_problem(analyses):
+        failed = [a for a in analyses if str(a.get('ai_analysis', '')).startswith("執行錯誤")]
+        if not analyses:
+            return "沒有任何影片可分析"
+        return f"{len(failed)}/{len(analyses)} 支影片分析失敗：{failed[0]['ai_analysis'][:120]}" if failed else ""
+
+    def strategy_problem(results):
+        # 失敗的模組是「# 名稱\n\n❌ 執行錯誤／生成失敗: …」
+        failed = [k for k, text in results.items() if text.split("\n\n", 1)[-1].startswith("❌")]
+        return f"{len(failed)}/{len(results)} 個策略模組失敗：{', '.join(failed)}" if failed else ""
+
+    search_errors = []
+    try:
+        stages = engine.search_pipeline_stages(
+            FAKE_KEY, FAKE_KEY, keywords, [], MODEL, max_results_per_keyword=5, comment_top_n=5,
+            on_error=search_errors.append,
+        )
+        graph = step('search', lambda ctx: engine.run_stage_graph(stages, max_workers=6, cancel_event=ctx.cancel_event),
+                     check=search_problem)
+        videos = graph['results'].get('search_zh', [])
+
+        selected = [v for group in engine.group_videos_by_keyword(videos, top_n=3).values() for v in group]
+        analyses = step('extract', lambda ctx: engine.batch_extract_videos(
+            FAKE_KEY, selected, max_workers=3, use_cache=False, use_transcripts=False, cancel_event=ctx.cancel_event
+        ), check=extract_problem)
+
+        if modules:
+            step('strategy', lambda ctx: engine.batch_generate_strategies(
+                FAKE_KEY, modules, analyses, {'zh': keywords, 'en': []}, engine.DEFAULT_USER_GOAL, MODEL,
+                map_reduce=len(analyses) > engine.MAP_REDUCE_THRESHOLD
+            ), check=strategy_problem)
+        ok = True
+    except Exception:
+        ok = False
+    record({'session': index, 'step': 'total', 'status': 'done' if ok else 'failed', 'error': '',
+            'latency_s': time.time() - started, 'queue_s': 0.0, 'result_bytes': result_sizes})
+
+
+class Sampler(threading.Thread):
+    """定時記錄同時存在的 thread 數峰值（記憶體峰值由 tracemalloc 自己追蹤）"""
+
+    def __init__(self, interval=0.1):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.peak_threads = threading.active_count()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="模擬多個 session 同時使用的負載測試")
+    parser.add_argument("--sessions", type=int, default=10, help="同時模擬的 session 數")
+    parser.add_argument("--ramp", type=float, default=0.0, help="在幾秒內把所有 session 陸續啟動（0 = 同時）")
+    parser.add_argument("--keywords", type=int, default=3, help="每個 session 的關鍵字數")
+    parser.add_argument("--overlap", type=float, default=0.0, help="關鍵字與其他 session 重複的比例（0～1）")
+    parser.add_argument("--modules", default="", help="策略模組（逗號分隔，預設全部）")
+    parser.add_argument("--job-workers", type=int, default=4, help="JobManager 的 worker 數（與 app.py 相同預設）")
+    parser.add_argument("--latency", type=float, default=0.05, help="替身服務每個請求的基本延遲秒數")
+    parser.add_argument("--jitter", type=float, default=0.05, help="額外的隨機延遲上限（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="替身服務回傳 500 的機率")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="結果輸出 JSON 路徑")
+    args = parser.parse_args(argv)
+
+    import engine
+    from jobs import JobManager
+
+    modules = [m for m in args.modules.split(",") if m] or list(engine.STRATEGY_MODULES)
+    rng = random.Random(args.seed)
+    stand_in = StandIn()
+    stand_in.point_engine(engine)
+    stand_in.reset(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    engine.clear_shared_caches()
+
+    manager = JobManager(max_workers=args.job_workers)
+    records = []
+    lock = threading.Lock()
+
+    def record(row):
+        with lock:
+            records.append(row)
+
+    gc.collect()
+    tracemalloc.start()
+    baseline_memory, _ = tracemalloc.get_traced_memory()
+    baseline_threads = threading.active_count()
+    sampler = Sampler()
+    sampler.start()
+    started = time.time()
+    try:
+        sessions = []
+        for i in range(args.sessions):
+            keywords = session_keywords(i, args.keywords, args.overlap, rng)
+            t = threading.Thread(target=run_session, args=(engine, manager, i, keywords, modules, record),
+                                 name=f"session_{i}", daemon=True)
+            t.start()
+            sessions.append(t)
+            if args.ramp and i < args.sessions - 1:
+                time.sleep(args.ramp / max(args.sessions - 1, 1))
+        for t in sessions:
+            t.join()
+    finally:
+        wall = time.time() - started
+        sampler.stop_event.set()
+        sampler.join()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        server_stats = stand_in.stats()
+        stand_in.close()
+
+    steps = {}
+    for step in STEPS + ['total']:
+        rows = [r for r in records if r['step'] == step]
+        latencies = [r['latency_s'] for r in rows if r['status'] == 'done']
+        queues = [r['queue_s'] for r in rows if r['status'] == 'done']
+        steps[step] = {
+            'count': len(rows),
+            'failed': sum(1 for r in rows if r['status'] != 'done'),
+            **{f"p{p}_s": percentile(latencies, p) for p in (50, 95, 99)},
+            'max_s': round(max(latencies), 3) if latencies else None,
+            'queue_p50_s': percentile(queues, 50),
+            'queue_p95_s': percentile(queues, 95),
+        }
+    result_bytes = [r.get('result_bytes', 0) for r in records if r['step'] == 'total']
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'created': datetime.now().isoformat(timespec="seconds"),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            **{k: v for k, v in vars(args).items() if k != 'out'},
+        },
+        'wall_s': round(wall, 2),
+        'steps': steps,
+        'threads': {'baseline': baseline_threads, 'peak': sampler.peak_threads},
+        'memory': {
+            'peak_mb': round(peak_memory / 1024 / 1024, 1),
+            'per_session_mb': round((peak_memory - baseline_memory) / 1024 / 1024 / max(args.sessions, 1), 2),
+            'result_per_session_kb': round(sum(result_bytes) / 1024 / max(len(result_bytes), 1), 1),
+        },
+        'calls': {route: s['calls'] for route, s in server_stats.items()},
+        'errors': [r['error'] for r in records if r['status'] != 'done' and r['error']][:20],
+    }
+
+    print(f"{args.sessions} 個 session，總耗時 {report['wall_s']}s")
+    for step, s in steps.items():
+        if s['count']:
+            print(f"  {step:<9} p50 {s['p50_s']}s｜p95 {s['p95_s']}s｜p99 {s['p99_s']}s｜"
+                  f"排隊 p95 {s['queue_p95_s']}s｜失敗 {s['failed']}/{s['count']}")
+    print(f"  thread 峰值 {sampler.peak_threads}（起始 {baseline_threads}）｜記憶體峰值 {report['memory']['peak_mb']} MB｜"
+          f"每個 session 約 {report['memory']['per_session_mb']} MB")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if any(s['failed'] for s in steps.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,543 @@
+"""端到端基準測試：用本機替身伺服器模擬 suggestqueries、YouTube Data API、Gemini，跑真正的 engine 函式。
+
+每個情境在不同關鍵字數量下量測：耗時、送出的請求數、傳輸位元組、Python 記憶體峰值（tracemalloc）。
+替身伺服器跑在獨立 process，可注入延遲與錯誤率；資料由關鍵字 hash 產生，每次執行結果一致。
+
+用法：
+    python bench_pipeline.py                                   # 關鍵字數 1,5,20,50,100,200
+    python bench_pipeline.py --sizes 1,10 --latency 0.05 --error-rate 0.02 --out bench.json
+    python bench_pipeline.py --cases search_multiple_keywords,batch_fetch_comments
+    python bench_pipeline.py --baseline bench.json             # 與先前結果比較，耗時變慢超過 --tolerance 即回傳 1
+    python bench_pipeline.py --check-replay --sizes 5          # 錄製一次再把時鐘往後調、改動快照庫後重播，有任何 miss 即回傳 1
+
+一般量測跑完也會用最小的關鍵字數做一次重播檢查（--skip-replay-check 可略過），對不上同樣回傳 1。
+
+耗時包含 tracemalloc 的額外負擔（每個 commit 都一樣，不影響比較）。
+"""
+import argparse
+import gc
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import replay
+import snapshots
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = [1, 5, 20, 50, 100, 200]
+FAKE_KEY = "bench"
+MODEL = "gemini-2.5-flash"
+
+# ==========================================
+# 替身伺服器（獨立 process）
+# ==========================================
+
+SUGGEST_WORDS = ["教學", "推薦", "比較", "評價", "新手", "2025", "缺點", "價格", "怎麼選", "心得", "懶人包", "實測"]
+VIDEO_POOL = 20000  # 影片 ID 從固定的池子產生，不同關鍵字會搜到部分相同的影片
+
+
+def _h(*parts):
+    return int(hashlib.md5("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:8], 16)
+
+
+def _suggest(query):
+    terms = [f"{query} {SUGGEST_WORDS[(_h(query) + i) % len(SUGGEST_WORDS)]}" for i in range(10)]
+    return terms, [1250 - i * 50 - _h(query, i) % 30 for i in range(10)]
+
+
+def _video_item(video_id):
+    seed = _h(video_id)
+    published = datetime(2025, 1, 1) - timedelta(days=seed % 1500)
+    return {
+        'id': video_id,
+        'snippet': {
+            'title': f"影片 {video_id}：{SUGGEST_WORDS[seed % len(SUGGEST_WORDS)]}完整解析",
+            'description': "影片說明 " * (20 + seed % 40),
+            'tags': [SUGGEST_WORDS[(seed + i) % len(SUGGEST_WORDS)] for i in range(seed % 8)],
+            'channelTitle': f"頻道 {seed % 3000}",
+            'channelId': f"UC{seed % 3000:06d}",
+            'publishedAt': published.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'thumbnails': {'high': {'url': f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg"}},
+        },
+        'statistics': {
+            'viewCount': str(seed % 2000000),
+            'likeCount': str(seed % 40000),
+            'commentCount': str(seed % 3000),
+        },
+        'contentDetails': {'duration': f"PT{seed % 40}M{seed % 60}S"},
+    }
+
+
+def _comment_thread(video_id, i):
+    seed = _h(video_id, i)
+    def snippet(text, n):
+        return {'textDisplay': text, 'likeCount': n, 'authorDisplayName': f"user{n}"}
+    return {
+        'snippet': {'topLevelComment': {'snippet': snippet(f"留言 {i}：這支影片講得很清楚，但{SUGGEST_WORDS[seed % len(SUGGEST_WORDS)]}呢？", seed % 500)}},
+        'replies': {'comments': [{'snippet': snippet(f"回覆 {j}", seed % 50 + j)} for j in range(seed % 3)]},
+    }
+
+
+def _gemini_text(body):
+    config = body.get('generationConfig') or body.get('generation_config') or {}
+    if config.get('responseMimeType') == "application/json" or config.get('response_mime_type') == "application/json":
+        if config.get('responseSchema') or config.get('response_schema'):
+            return json.dumps({
+                'topic': "替身分析", 'key_points': ["重點一", "重點二", "重點三"],
+                'structure': {'opening': "開場", 'body': "主體", 'ending': "結尾"},
+                'quotes': ["金句"], 'audience': "新手", 'gaps': ["缺口"], 'unique_value': "獨特價值",
+            }, ensure_ascii=False)
+        return "[]"
+    return "## 替身回應\n\n" + "- 分析要點\n" * 60
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _send(self, status, payload, route):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if route:
+            self.server.count(route, status, len(body))
+
+    def _dispatch(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length) if length else b""
+        parts = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+
+        if parts.path == "/__stats":
+            return self._send(200, server.snapshot(), None)
+        if parts.path == "/__reset":
+            server.reset(json.loads(raw_body or b"{}"))
+            return self._send(200, {'ok': True}, None)
+
+        if parts.path.endswith("/complete/search"):
+            route = "suggest"
+        elif "/youtube/v3/" in parts.path:
+            route = "youtube." + parts.path.rstrip("/").rsplit("/", 1)[-1]
+        else:
+            m = re.search(r"/models/([^/:]+):generateContent", parts.path)
+            route = "gemini" if m else None
+        if route is None:
+            return self._send(404, {'error': {'code': 404, 'message': parts.path}}, None)
+
+        server.count_request(route, len(self.requestline) + len(str(self.headers)) + len(raw_body))
+        delay = server.draw_delay()
+        if delay > 0:
+            time.sleep(delay)
+        if server.draw_error():
+            return self._send(500, {'error': {'code': 500, 'message': "injected error", 'status': "INTERNAL"}}, route)
+
+        if route == "suggest":
+            q = query.get('q', '')
+            terms, scores = _suggest(q)
+            if query.get('client') == "chrome":
+                payload = [q, terms, [""] * len(terms), [], {'google:suggestrelevance': scores}]
+            else:
+                payload = [q, terms]
+            return self._send(200, payload, route)
+
+        if route == "youtube.search":
+            q = query.get('q', '')
+            n = int(query.get('maxResults', 5))
+            items = [{'id': {'kind': "youtube#video", 'videoId': f"v{_h(q, i) % VIDEO_POOL:06d}"}} for i in range(n)]
+            return self._send(200, {'items': items}, route)
+        if route == "youtube.videos":
+            ids = [i for i in query.get('id', '').split(",") if i]
+            return self._send(200, {'items': [_video_item(i) for i in ids]}, route)
+        if route == "youtube.channels":
+            ids = [i for i in query.get('id', '').split(",") if i]
+            items = [{'id': c, 'statistics': {'subscriberCount': str(_h(c) % 1000000)}} for c in ids]
+            return self._send(200, {'items': items}, route)
+        if route == "youtube.commentThreads":
+            video_id = query.get('videoId', '')
+            n = min(int(query.get('maxResults', 20)), 100)
+            return self._send(200, {'items': [_comment_thread(video_id, i) for i in range(n)]}, route)
+
+        body = json.loads(raw_body or b"{}")
+        text = _gemini_text(body)
+        prompt_chars = sum(len(p.get('text', '')) for c in body.get('contents', []) for p in c.get('parts', []))
+        return self._send(200, {
+            'candidates': [{'content': {'role': "model", 'parts': [{'text': text}]}, 'finishReason': "STOP", 'index': 0}],
+            'usageMetadata': {
+                'promptTokenCount': prompt_chars // 2,
+                'candidatesTokenCount': len(text) // 2,
+                'totalTokenCount': prompt_chars // 2 + len(text) // 2,
+            },
+        }, route)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, StandInHandler)
+        self._lock = threading.Lock()
+        self.reset({})
+
+    def reset(self, config):
+        with self._lock:
+            self.latency = float(config.get('latency', 0))
+            self.jitter = float(config.get('jitter', 0))
+            self.error_rate = float(config.get('error_rate', 0))
+            self.rng = random.Random(config.get('seed', 0))
+            self.stats = {}
+
+    def _route(self, route):
+        return self.stats.setdefault(route, {'calls': 0, 'errors': 0, 'bytes_sent': 0, 'bytes_received': 0})
+
+    def count_request(self, route, size):
+        with self._lock:
+            entry = self._route(route)
+            entry['calls'] += 1
+            entry['bytes_sent'] += size  # 以客戶端角度：送出的位元組
+
+    def count(self, route, status, size):
+        with self._lock:
+            entry = self._route(route)
+            entry['bytes_received'] += size
+            if status >= 400:
+                entry['errors'] += 1
+
+    def draw_delay(self):
+        with self._lock:
+            return self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+
+    def draw_error(self):
+        with self._lock:
+            return self.error_rate > 0 and self.rng.random() < self.error_rate
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self.stats))
+
+
+def serve(port_queue):
+    server = StandInServer(("127.0.0.1", 0))
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StandIn:
+    """在子 process 啟動替身伺服器，並把 engine 的外部服務位址指過去"""
+
+    def __init__(self):
+        queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve, args=(queue,), daemon=True)
+        self.process.start()
+        self.base = f"http://127.0.0.1:{queue.get(timeout=30)}"
+
+    def _call(self, path, payload=None):
+        import urllib.request
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        with urllib.request.urlopen(urllib.request.Request(self.base + path, data=data), timeout=10) as resp:
+            return json.loads(resp.read())
+
+    def reset(self, **config):
+        self._call("/__reset", config)
+
+    def stats(self):
+        return self._call("/__stats")
+
+    def point_engine(self, engine):
+        engine.SUGGEST_URL = f"{self.base}/complete/search"
+        engine.YOUTUBE_API_ENDPOINT = f"{self.base}/youtube/v3/"
+        engine.GEMINI_API_ENDPOINT = self.base
+        # 替身服務的假建議詞不能寫進自動完成快照歷史
+        snapshots.configure(None)
+
+    def close(self):
+        self.process.terminate()
+        self.process.join(timeout=5)
+
+
+# ==========================================
+# 情境
+# ==========================================
+
+def build_fixtures(engine, keywords):
+    """準備下游情境需要的輸入（不計入量測，替身伺服器此時不加延遲與錯誤）"""
+    videos = engine.search_multiple_keywords(FAKE_KEY, keywords, 5, lang="zh")
+    selected = [v for group in engine.group_videos_by_keyword(videos, top_n=3).values() for v in group]
+    analyses = engine.batch_extract_videos(FAKE_KEY, selected, use_cache=False, use_transcripts=False)
+    return {
+        'keywords': keywords,
+        'videos': videos,
+        'selected': selected,
+        'deep': {kw: engine.get_youtube_suggestions_deep(kw, lang="zh-TW", depth=2) for kw in keywords},
+        'probes': {kw: engine.probe_youtube_suggestions(kw, lang="zh-TW", market="zh") for kw in keywords},
+        'comments': engine.batch_fetch_comments(FAKE_KEY, engine.group_videos_by_keyword(videos), top_n=5, max_per_video=50),
+        'analyses': analyses,
+    }
+
+
+CASES = {
+    'get_youtube_suggestions_deep': lambda engine, fx: [
+        engine.get_youtube_suggestions_deep(kw, lang="zh-TW", depth=2) for kw in fx['keywords']
+    ],
+    'probe_youtube_suggestions': lambda engine, fx: [
+        engine.probe_youtube_suggestions(kw, lang="zh-TW", market="zh") for kw in fx['keywords']
+    ],
+    'search_multiple_keywords': lambda engine, fx: engine.search_multiple_keywords(
+        FAKE_KEY, fx['keywords'], 5, lang="zh"
+    ),
+    'batch_fetch_comments': lambda engine, fx: engine.batch_fetch_comments(
+        FAKE_KEY, engine.group_videos_by_keyword(fx['videos']), top_n=5, max_per_video=50
+    ),
+    'batch_extract_videos': lambda engine, fx: engine.batch_extract_videos(
+        FAKE_KEY, fx['selected'], use_cache=False, use_transcripts=False
+    ),
+    'analyze_intent_three_layers': lambda engine, fx: engine.analyze_intent_three_layers(
+        FAKE_KEY, fx['keywords'], [], fx['videos'], [], fx['deep'], {}, fx['comments'], MODEL,
+        probe_suggestions_zh=fx['probes']
+    ),
+    'batch_generate_strategies': lambda engine, fx: engine.batch_generate_strategies(
+        FAKE_KEY, list(engine.STRATEGY_MODULES), fx['analyses'], {'zh': fx['keywords'], 'en': []},
+        engine.DEFAULT_USER_GOAL, MODEL, map_reduce=len(fx['analyses']) > engine.MAP_REDUCE_THRESHOLD
+    ),
+}
+
+
+def measure(engine, stand_in, case, fixtures, config):
+    """跑一個情境一次，回傳量測結果"""
+    engine.clear_shared_caches()
+    stand_in.reset(**config)
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        CASES[case](engine, fixtures)
+        error = ""
+    except Exception as e:
+        error = str(e)
+    wall = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    by_route = stand_in.stats()
+    return {
+        'case': case,
+        'keywords': len(fixtures['keywords']),
+        'wall_s': round(wall, 3),
+        'peak_kb': round(peak / 1024, 1),
+        'calls': sum(r['calls'] for r in by_route.values()),
+        'errors': sum(r['errors'] for r in by_route.values()),
+        'bytes_sent': sum(r['bytes_sent'] for r in by_route.values()),
+        'bytes_received': sum(r['bytes_received'] for r in by_route.values()),
+        'by_route': by_route,
+        'error': error,
+    }
+
+
+def run_all_cases(engine, keywords):
+    """準備 fixtures 並把每個情境各跑一次，回傳 {情境: 結果或錯誤訊息}"""
+    fixtures = build_fixtures(engine, keywords)
+    outputs = {}
+    for case, fn in CASES.items():
+        try:
+            outputs[case] = fn(engine, fixtures)
+        except Exception as e:
+            outputs[case] = f"❌ {e}"
+    return fixtures, outputs
+
+
+def check_replay(engine, stand_in, keywords, shift_days=30):
+    """錄製一次完整流程，再把時鐘往後調 shift_days 天、在快照庫加入新資料後離線重播：
+    重播不能有任何 cassette miss，意圖分析的產出也要與錄製時相同。
+    錄製前先在快照庫放幾天前的歷史，趨勢與觀看速度才真的會進 prompt。回傳發現的問題 list"""
+    workdir = tempfile.mkdtemp(prefix="replay_check_")
+    cassette_dir = os.path.join(workdir, "cassette")
+    real_datetime = engine.datetime
+
+    class ShiftedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return real_datetime.now(tz) + timedelta(days=shift_days)
+
+    problems = []
+    try:
+        stand_in.reset()
+        snapshots.configure(os.path.join(workdir, "snapshots.sqlite"))
+        engine.clear_shared_caches()
+        fixtures = build_fixtures(engine, keywords)
+        earlier = time.time() - 3 * 86400
+        store = snapshots.store()
+        store.record_video_stats(
+            [dict(v, view_count=int(v.get('view_count') or 0) // 2) for v in fixtures['videos']], fetched=earlier
+        )
+        for kw in keywords:
+            store.record_suggestions(kw, "zh-TW", [(f"{kw} 舊詞", None)], client="firefox", fetched=earlier)
+
+        engine.clear_shared_caches()
+        replay.activate(cassette_dir, mode="record")
+        fixtures, recorded = run_all_cases(engine, keywords)
+        replay.deactivate()
+
+        # 錄製之後快照庫又多了資料（隔天的建議詞與影片統計），時鐘也往後走
+        later = time.time() + shift_days * 86400
+        store.record_video_stats(
+            [dict(v, view_count=int(v.get('view_count') or 0) * 2 + 1000) for v in fixtures['videos']], fetched=later
+        )
+        for kw in keywords:
+            store.record_suggestions(kw, "zh-TW", [(f"{kw} 新詞", None)], client="firefox", fetched=later)
+        engine.datetime = ShiftedDatetime
+
+        engine.clear_shared_caches()
+        cassette = replay.activate(cassette_dir, mode="replay", latency=0)
+        _, replayed = run_all_cases(engine, keywords)
+        if cassette.stats['misses']:
+            problems.append(f"重播有 {cassette.stats['misses']} 次 cassette miss")
+        layers = ('layer1', 'layer2', 'layer3', 'synthesis')
+        before = recorded['analyze_intent_three_layers']
+        after = replayed['analyze_intent_three_layers']
+        if isinstance(before, str) or isinstance(after, str):
+            problems.append(f"意圖分析失敗：{before if isinstance(before, str) else after}")
+        else:
+            problems += [f"{k} 與錄製時不同：{after.get(k, '')[:80]}" for k in layers if before.get(k) != after.get(k)]
+            if not before.get('trends', {}).get('queries_compared'):
+                problems.append("錄製時沒有讀到快照歷史（趨勢），檢查不到快照庫是否固定")
+    finally:
+        engine.datetime = real_datetime
+        replay.deactivate()
+        snapshots.configure(None)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return problems
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def compare(results, baseline, tolerance):
+    """列出比 baseline 慢超過 tolerance 的 (情境, 關鍵字數)"""
+    before = {(r['case'], r['keywords']): r for r in baseline.get('results', [])}
+    regressions = []
+    for r in results:
+        old = before.get((r['case'], r['keywords']))
+        if old and old['wall_s'] > 0 and r['wall_s'] > old['wall_s'] * (1 + tolerance):
+            regressions.append((r['case'], r['keywords'], old['wall_s'], r['wall_s']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="以本機替身服務量測 engine 各階段效能")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="關鍵字數量（逗號分隔）")
+    parser.add_argument("--cases", default=",".join(CASES), help="要跑的情境（逗號分隔）")
+    parser.add_argument("--latency", type=float, default=0.02, help="每個請求的基本延遲秒數")
+    parser.add_argument("--jitter", type=float, default=0.01, help="額外的隨機延遲上限（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="回傳 500 的機率")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="結果輸出 JSON 路徑")
+    parser.add_argument("--baseline", help="先前的結果 JSON，用來檢查退化")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允許比 baseline 慢的比例")
+    parser.add_argument("--check-replay", action="store_true",
+                        help="不量測效能，只檢查錄製後隔一段時間重播是否完全對得上（用 --sizes 的第一個數量）")
+    parser.add_argument("--skip-replay-check", action="store_true", help="量測完不跑重播一致性檢查")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    cases = [c.strip() for c in args.cases.split(",") if c.strip()]
+    unknown = [c for c in cases if c not in CASES]
+    if unknown:
+        parser.error(f"未知的情境：{', '.join(unknown)}（可用：{', '.join(CASES)}）")
+    config = {'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate, 'seed': args.seed}
+
+    import engine
+
+    stand_in = StandIn()
+    stand_in.point_engine(engine)
+    def replay_problems():
+        problems = check_replay(engine, stand_in, [f"關鍵字{i}" for i in range(sizes[0])])
+        for problem in problems:
+            print(f"❌ {problem}", file=sys.stderr)
+        if not problems:
+            print("✅ 重播與錄製完全一致（0 次 cassette miss）")
+        return problems
+
+    if args.check_replay:
+        try:
+            return 1 if replay_problems() else 0
+        finally:
+            stand_in.close()
+
+    results = []
+    problems = []
+    try:
+        for size in sizes:
+            keywords = [f"關鍵字{i}" for i in range(size)]
+            stand_in.reset()
+            engine.clear_shared_caches()
+            fixtures = build_fixtures(engine, keywords)
+            for case in cases:
+                r = measure(engine, stand_in, case, fixtures, config)
+                results.append(r)
+                note = f"（❌ {r['error']}）" if r['error'] else ""
+                print(f"{case} × {size}: {r['wall_s']}s，{r['calls']} 次請求（{r['errors']} 失敗），"
+                      f"送出 {r['bytes_sent'] / 1024:.0f} KB／收到 {r['bytes_received'] / 1024:.0f} KB，"
+                      f"記憶體峰值 {r['peak_kb'] / 1024:.1f} MB{note}")
+        # 效能改動（並行化、快取）最容易讓重播對不上，每次量測順便確認
+        if not args.skip_replay_check:
+            problems = replay_problems()
+    finally:
+        stand_in.close()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'created': datetime.now().isoformat(timespec="seconds"),
+            'python': platform.python_version(),
+            'sizes': sizes,
+            **config,
+        },
+        'results': results,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for case, size, before, after in regressions:
+            print(f"⚠️ {case} × {size} 退化：{before}s → {after}s", file=sys.stderr)
+        return 1 if regressions or problems else 0
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
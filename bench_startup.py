@@ -0,0 +1,95 @@
+"""冷啟動效能基準：在全新的 Python process 裡量測 engine import 與 app 首次渲染（time to first paint）耗時。
+
+用法：
+    python bench_startup.py                           # 跑 5 輪並印出結果
+    python bench_startup.py --out startup.json        # 結果存成 JSON
+    python bench_startup.py --baseline startup.json   # 與先前結果比較，中位數變慢超過 --tolerance 即回傳 1
+
+time to first paint 用 streamlit.testing.v1.AppTest 執行一次 app.py（未填 API Key 時只會渲染介面，不會打外部 API）。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# 每個量測都在獨立 process 執行，才量得到真正的冷啟動
+PROBES = {
+    "import_engine": """
+import time
+started = time.perf_counter()
+import engine
+print(time.perf_counter() - started)
+""",
+    "first_paint": """
+import time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file("app.py", default_timeout=60)
+at.run()
+assert not at.exception, at.exception
+print(time.perf_counter() - started)
+""",
+}
+
+
+def run_probe(code):
+    """在乾淨的子 process 執行量測程式，回傳秒數"""
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=HERE,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="量測 app 冷啟動耗時")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--out", help="結果輸出 JSON 路徑")
+    parser.add_argument("--baseline", help="先前的結果 JSON，用來檢查退化")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允許比 baseline 慢的比例")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, code in PROBES.items():
+        samples = []
+        for _ in range(args.rounds):
+            try:
+                samples.append(run_probe(code))
+            except subprocess.CalledProcessError as e:
+                print(f"❌ {name} 執行失敗：{e.stderr.strip().splitlines()[-1] if e.stderr else e}", file=sys.stderr)
+                break
+        if samples:
+            results[name] = {
+                'median_ms': round(statistics.median(samples) * 1000, 1),
+                'min_ms': round(min(samples) * 1000, 1),
+                'max_ms': round(max(samples) * 1000, 1),
+                'rounds': len(samples),
+            }
+            print(f"{name}: 中位數 {results[name]['median_ms']} ms（{results[name]['min_ms']}–{results[name]['max_ms']} ms，{len(samples)} 輪）")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressed = False
+        for name, current in results.items():
+            before = baseline.get(name, {}).get('median_ms')
+            if before and current['median_ms'] > before * (1 + args.tolerance):
+                regressed = True
+                print(f"⚠️ {name} 退化：{before} ms → {current['median_ms']} ms", file=sys.stderr)
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
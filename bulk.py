@@ -0,0 +1,341 @@
+"""大量關鍵字研究：上傳 CSV／TXT（數百個關鍵字），分批串流跑「長尾展開 → 搜尋 → 留言 → 三層意圖分析」。
+
+每批處理完就把影片、建議詞、留言、意圖分析寫進 runs/bulk_<id>/chunk_<序號>/ 並從記憶體釋放，
+記憶體只跟批次大小有關、不隨關鍵字總數成長；中斷後用同一個目錄重跑會跳過已完成的批次
+（各批的關鍵字必須與上次相同，換了清單或批次大小會丟出 ResumeMismatch，不會拿別批的結果充數）。
+全部批次完成後，把各批的洞察再用 map-reduce 合併成一份跨批次報告（merged.md），
+每個關鍵字的摘要指標另存 keywords.jsonl。
+
+用法（無介面）：
+    python bulk.py keywords.csv --chunk-size 20
+    python bulk.py keywords.txt --run-dir runs/bulk_20240101_120000_abc123   # 接續中斷的執行
+
+CSV 取 keyword／關鍵字 欄（沒有標題列時取第一欄），market 欄（zh／en）可省略，省略時純英數字的詞視為 en。
+TXT 每行一個，或以逗號分隔。
+"""
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import re
+import sys
+import time
+
+import engine
+from checkpoints import RUNS_DIR, new_run_id
+from videostore import VideoStore
+
+BULK_CHUNK_SIZE = 20
+# 合併各批洞察時，一次 reduce 送進 prompt 的 token 上限（超過就先分組合併，再合併組的結果）
+MERGE_TOKEN_BUDGET = 12000
+
+_KEYWORD_COLUMNS = ('keyword', 'keywords', '關鍵字', 'query')
+
+
+class ResumeMismatch(Exception):
+    """接續執行的目錄裡，已完成批次的關鍵字與這次上傳的清單（或批次大小）對不上"""
+
+
+def _market(keyword, market=None):
+    market = (market or "").strip().lower()
+    if market in ('zh', 'en'):
+        return market
+    return "en" if re.fullmatch(r"[\x00-\x7f]+", keyword) else "zh"
+
+
+def read_keywords(stream, filename):
+    """逐行讀取上傳的關鍵字檔（bytes 或文字串流），產生去重後的 (keyword, market)"""
+    if isinstance(stream, (bytes, bytearray)):
+        stream = io.BytesIO(stream)
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    seen = set()
+
+    def emit(keyword, market=None):
+        keyword = keyword.strip()
+        if keyword and keyword.lower() not in seen:
+            seen.add(keyword.lower())
+            return keyword, _market(keyword, market)
+        return None
+
+    if filename.lower().endswith(".csv"):
+        rows = csv.reader(stream)
+        header = next(rows, None)
+        if header is None:
+            return
+        names = [h.strip().lower() for h in header]
+        keyword_col = next((names.index(c) for c in _KEYWORD_COLUMNS if c in names), None)
+        market_col = names.index('market') if 'market' in names else None
+        if keyword_col is None:
+            # 沒有標題列：第一列也是資料
+            keyword_col = 0
+            rows = itertools.chain([header], rows)
+        for row in rows:
+            if len(row) > keyword_col:
+                market = row[market_col] if market_col is not None and len(row) > market_col else None
+                item = emit(row[keyword_col], market)
+                if item:
+                    yield item
+    else:
+        for line in stream:
+            for keyword in line.replace('，', ',').split(','):
+                item = emit(keyword)
+                if item:
+                    yield item
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _write_jsonl(path, rows):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+
+def read_jsonl(path):
+    """逐行讀取 JSONL（不一次載入整個檔案）"""
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def new_bulk_dir():
+    return os.path.join(RUNS_DIR, f"bulk_{new_run_id()}")
+
+
+def keyword_summaries(videos, intent, keywords):
+    """每個關鍵字的摘要指標（影片數、總觀看、第一名影片、各類供需異常數）"""
+    store = VideoStore(videos)
+    anomalies = (intent or {}).get('anomalies') or {}
+    flagged = {}
+    for kind in ('underdogs', 'stale_front_rows', 'low_engagement', 'homogeneous_titles'):
+        for a in anomalies.get(kind, []):
+            flagged.setdefault(a['keyword'], set()).add(kind)
+    rows = []
+    for keyword, market in keywords:
+        group = store.by_keyword(keyword, market=market)
+        top = group[0] if group else {}
+        rows.append({
+            'keyword': keyword,
+            'market': market,
+            'videos': len(group),
+            'total_views': sum(v.get('view_count', 0) for v in group),
+            'top_title': top.get('title', ''),
+            'top_views': top.get('view_count', 0),
+            'anomalies': sorted(flagged.get(keyword, ())),
+        })
+    return rows
+
+
+def run_chunk(gemini_key, youtube_key, chunk, chunk_dir, model_version, max_results_per_keyword=5,
+              comment_top_n=3, cancel_event=None):
+    """跑一批關鍵字並把產出寫進 chunk_dir，回傳這批的摘要（不含大型資料）"""
+    started = time.time()
+    zh = [kw for kw, m in chunk if m == 'zh']
+    en = [kw for kw, m in chunk if m == 'en']
+    errors = []
+    stages = engine.search_pipeline_stages(
+        gemini_key, youtube_key, zh, en, model_version,
+        max_results_per_keyword=max_results_per_keyword, comment_top_n=comment_top_n, on_error=errors.append,
+    )
+    graph = engine.run_stage_graph(stages, max_workers=6, cancel_event=cancel_event)
+    results = graph['results']
+    videos = results.get('search_zh', []) + results.get('search_en', [])
+    intent = results.get('intent') or {}
+
+    os.makedirs(chunk_dir, exist_ok=True)
+    _write_jsonl(os.path.join(chunk_dir, "videos.jsonl"), videos)
+    _write_jsonl(os.path.join(chunk_dir, "comments.jsonl"),
+                 ({'video_id': vid, **data} for vid, data in (results.get('comments') or {}).items()))
+    _write_json(os.path.join(chunk_dir, "suggestions.json"), {
+        name: results.get(name, {}) for name in ('deep_zh', 'deep_en', 'probe_zh', 'probe_en')
+    })
+    _write_json(os.path.join(chunk_dir, "intent.json"), intent)
+    summary = {
+        'keywords': [kw for kw, _ in chunk],
+        'markets': [m for _, m in chunk],
+        'videos': len(videos),
+        'keyword_rows': keyword_summaries(videos, intent, chunk),
+        'synthesis': intent.get('synthesis', ''),
+        'failed_stages': [n for n, t in graph['timings'].items() if t['status'] in ('failed', 'skipped')],
+        'errors': errors[:10],
+        'seconds': round(time.time() - started, 1),
+    }
+    # summary.json 最後寫：它存在＝這批已完整完成（resume 判斷依據）
+    _write_json(os.path.join(chunk_dir, "summary.json"), summary)
+    return summary
+
+
+def load_chunk_summary(chunk_dir, chunk):
+    """已完成批次的 summary；沒有時回傳 None。
+    內容與這批關鍵字（含市場）不同時丟出 ResumeMismatch：換了清單或批次大小卻沿用舊目錄，不能拿別批的結果充數"""
+    summary_path = os.path.join(chunk_dir, "summary.json")
+    if not os.path.exists(summary_path):
+        return None
+    with open(summary_path, encoding="utf-8") as f:
+        summary = json.load(f)
+    expected = [kw for kw, _ in chunk]
+    markets = summary.get('markets', [m for _, m in chunk])
+    if summary.get('keywords') != expected or markets != [m for _, m in chunk]:
+        raise ResumeMismatch(
+            f"{chunk_dir} 已完成的關鍵字（{'、'.join(summary.get('keywords', [])[:5])}…）與這次清單的同一批"
+            f"（{'、'.join(expected[:5])}…）不同；請確認關鍵字檔與批次大小和上次相同，或改用新的輸出目錄"
+        )
+    summary['resumed'] = True
+    return summary
+
+
+def merge_syntheses(gemini_key, model_version, sections, token_budget=MERGE_TOKEN_BUDGET):
+    """把各批的洞察（[(標題, 內文)]）合併成一份跨批次洞察；超過預算時先分組合併（map-reduce）"""
+    sections = [(title, text) for title, text in sections if text and not text.startswith("❌")]
+    if not sections:
+        return ""
+    model = engine.gemini_model(gemini_key, model_version)
+
+    def reduce(group, final):
+        material = "\n\n".join(f"## {title}\n{text}" for title, text in group)
+        prompt = f"""
+你是內容策略洞察總監。以下是同一份大型關鍵字清單分批分析後，各批各自得出的洞察（每批都是需求端／供給端／反應端三層對撞的結果）：
+
+{material}
+
+把各批洞察合併成{'最終的' if final else '一份'}跨批次洞察：
+1. 不同批次指向同一個機會的，合併成一條，並列出涉及的關鍵字
+2. 只出現在單一批次、但證據強的洞察保留
+3. 依「機會大小 × 證據強度」排序，輸出 {'7-10' if final else '8-12'} 條
+
+每條格式固定：
+### 💡 洞察 N：（一句話判斷）
+- **涉及關鍵字**：…
+- **證據**：引用原洞察中的具體訊號
+- **行動意義**：具體做什麼題目、切什麼角度
+
+請用繁體中文回答。
+"""
+        with engine.tracing.span("bulk.merge", sections=len(group), final=final):
+            return model.generate_content(prompt).text
+
+    level = 0
+    while True:
+        groups, current, used = [], [], 0
+        for title, text in sections:
+            cost = engine.estimate_tokens(text)
+            if current and used + cost > token_budget:
+                groups.append(current)
+                current, used = [], 0
+            current.append((title, text))
+            used += cost
+        groups.append(current)
+        if len(groups) == 1:
+            return reduce(groups[0], final=True)
+        level += 1
+        sections = [(f"第 {level} 輪合併 #{i + 1}", reduce(g, final=False)) for i, g in enumerate(groups)]
+
+
+def run_bulk(gemini_key, youtube_key, keywords, run_dir, model_version, chunk_size=BULK_CHUNK_SIZE,
+             total=None, max_results_per_keyword=5, comment_top_n=3, on_progress=None, cancel_event=None):
+    """分批處理 keywords（可迭代的 (keyword, market)，可以是 generator），回傳
+    {run_dir, chunks, keywords, videos, failed_chunks, merged}。on_progress(done_keywords, total, summary) 在每批完成後呼叫"""
+    os.makedirs(run_dir, exist_ok=True)
+    totals = {'chunks': 0, 'keywords': 0, 'videos': 0, 'failed_chunks': 0}
+    keywords_path = os.path.join(run_dir, "keywords.jsonl")
+    # 先寫暫存檔、全部批次跑完才換上：中途取消或清單對不上時，不會蓋掉上次完整的 keywords.jsonl
+    tmp_path = f"{keywords_path}.{os.getpid()}.tmp"
+    sections = []
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as keyword_file:
+            for index, chunk in enumerate(_chunks(keywords, chunk_size), 1):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise engine.PipelineCancelled("大量關鍵字研究已取消")
+                chunk_dir = os.path.join(run_dir, f"chunk_{index:04d}")
+                summary = load_chunk_summary(chunk_dir, chunk)
+                if summary is None:
+                    try:
+                        summary = run_chunk(gemini_key, youtube_key, chunk, chunk_dir, model_version,
+                                            max_results_per_keyword=max_results_per_keyword,
+                                            comment_top_n=comment_top_n, cancel_event=cancel_event)
+                    except engine.PipelineCancelled:
+                        raise
+                    except Exception as e:
+                        # 單批失敗不中斷整份清單；沒寫 summary.json，下次 resume 會重跑這批
+                        summary = {'keywords': [kw for kw, _ in chunk], 'videos': 0, 'keyword_rows': [],
+                                   'synthesis': '', 'error': str(e)}
+                        totals['failed_chunks'] += 1
+                for row in summary['keyword_rows']:
+                    keyword_file.write(json.dumps(row, ensure_ascii=False) + "\n")
+                keyword_file.flush()
+                totals['chunks'] += 1
+                totals['keywords'] += len(chunk)
+                totals['videos'] += summary['videos']
+                # 只留洞察文字給最後的合併；影片、留言等大型資料已在磁碟上
+                sections.append((f"第 {index} 批：{'、'.join(summary['keywords'][:8])}"
+                                 + (f" 等 {len(summary['keywords'])} 個" if len(summary['keywords']) > 8 else ""),
+                                 summary['synthesis']))
+                if on_progress:
+                    on_progress(totals['keywords'], total, {'chunk': index, **summary})
+        os.replace(tmp_path, keywords_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    merged = merge_syntheses(gemini_key, model_version, sections) if len(sections) > 1 else (sections[0][1] if sections else "")
+    with open(os.path.join(run_dir, "merged.md"), "w", encoding="utf-8") as f:
+        f.write(merged)
+    return {'run_dir': run_dir, **totals, 'merged': merged}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="分批串流處理大量關鍵字（CSV／TXT）")
+    parser.add_argument("keyword_file", help="關鍵字檔（.csv / .txt）")
+    parser.add_argument("--run-dir", help="輸出目錄（沿用既有目錄會跳過已完成的批次）")
+    parser.add_argument("--chunk-size", type=int, default=BULK_CHUNK_SIZE, help="每批關鍵字數")
+    parser.add_argument("--model", default="gemini-2.5-flash", help="意圖分析模型")
+    parser.add_argument("--max-results", type=int, default=5, help="每個關鍵字抓取影片數")
+    parser.add_argument("--gemini-key", default=os.environ.get("GEMINI_API_KEY", ""))
+    parser.add_argument("--youtube-key", default=os.environ.get("YOUTUBE_API_KEY", ""))
+    args = parser.parse_args(argv)
+    if not args.gemini_key or not args.youtube_key:
+        parser.error("請設定 GEMINI_API_KEY 與 YOUTUBE_API_KEY（環境變數或參數）")
+
+    run_dir = args.run_dir or new_bulk_dir()
+
+    def on_progress(done, total, summary):
+        status = "沿用" if summary.get('resumed') else ("❌ " + summary['error'] if summary.get('error') else f"{summary.get('seconds', 0)}s")
+        print(f"[第 {summary['chunk']} 批] {done} 個關鍵字完成，{summary['videos']} 支影片（{status}）")
+
+    try:
+        with open(args.keyword_file, "rb") as f:
+            result = run_bulk(
+                args.gemini_key, args.youtube_key, read_keywords(f, args.keyword_file), run_dir, args.model,
+                chunk_size=args.chunk_size, max_results_per_keyword=args.max_results, on_progress=on_progress,
+            )
+    except ResumeMismatch as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 2
+    print(f"完成 {result['keywords']} 個關鍵字、{result['chunks']} 批 → {run_dir}/merged.md")
+    return 1 if result['failed_chunks'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
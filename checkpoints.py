@@ -0,0 +1,149 @@
+"""執行紀錄（checkpoint）：每個階段完成後把產出寫到 runs/<run_id>/，瀏覽器重新整理或 pod 重啟後可以接續。
+
+影片、影片分析、關鍵字總表這類「一列一筆」的產出存成 JSON Lines，其餘存成 JSON；
+meta.json 記錄關鍵字與已完成的階段。
+"""
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+
+RUNS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "runs")
+
+# 各階段寫入的產出（與 app.py 的 session_state 同名）
+STAGE_ARTIFACTS = {
+    'search': [
+        'search_results', 'deep_suggestions_zh', 'deep_suggestions_en',
+        'probe_suggestions_zh', 'probe_suggestions_en', 'video_comments',
+        'intent_three_layers', 'intent_analysis',
+    ],
+    'keyword_table': ['keyword_table'],
+    'extract': ['video_analyses'],
+    'strategy': ['strategy_results', 'user_goal'],
+}
+STAGE_LABELS = {'search': "搜尋＋意圖", 'keyword_table': "關鍵字總表", 'extract': "影片分析", 'strategy': "策略"}
+
+# {'zh': [...], 'en': [...]} 形式的產出，攤平成一個 JSONL（每筆已帶 market 欄位）
+_BY_MARKET = {'search_results', 'video_analyses'}
+_JSONL = {'keyword_table'}
+
+
+def new_run_id():
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+
+
+def _run_dir(run_id):
+    return os.path.join(RUNS_DIR, run_id)
+
+
+def _write_atomic(path, write):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _write_jsonl(path, rows):
+    def write(f):
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    _write_atomic(path, write)
+
+
+def _read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_checkpoint(run_id, stage, artifacts, zh_keywords=None, en_keywords=None):
+    """寫入某階段的產出並把階段標記為完成；artifacts 只需包含 STAGE_ARTIFACTS[stage] 裡的 key"""
+    run_dir = _run_dir(run_id)
+    os.makedirs(run_dir, exist_ok=True)
+
+    for name in STAGE_ARTIFACTS[stage]:
+        if name not in artifacts:
+            continue
+        value = artifacts[name]
+        if name in _BY_MARKET:
+            _write_jsonl(os.path.join(run_dir, f"{name}.jsonl"), value.get('zh', []) + value.get('en', []))
+        elif name in _JSONL:
+            _write_jsonl(os.path.join(run_dir, f"{name}.jsonl"), value)
+        else:
+            _write_atomic(os.path.join(run_dir, f"{name}.json"), lambda f: json.dump(value, f, ensure_ascii=False))
+
+    meta = load_meta(run_id) or {'run_id': run_id, 'created': time.time(), 'stages': []}
+    if zh_keywords is not None:
+        meta['zh_keywords'] = list(zh_keywords)
+    if en_keywords is not None:
+        meta['en_keywords'] = list(en_keywords)
+    if stage not in meta['stages']:
+        meta['stages'].append(stage)
+    meta['updated'] = time.time()
+    _write_atomic(os.path.join(run_dir, "meta.json"), lambda f: json.dump(meta, f, ensure_ascii=False))
+
+
+def load_meta(run_id):
+    try:
+        with open(os.path.join(_run_dir(run_id), "meta.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_run(run_id):
+    """讀回某次執行的所有產出，回傳 {artifact_name: value}（另含 zh_keywords、en_keywords、completed_stages）"""
+    meta = load_meta(run_id)
+    if meta is None:
+        return None
+    run_dir = _run_dir(run_id)
+    restored = {
+        'zh_keywords': meta.get('zh_keywords', []),
+        'en_keywords': meta.get('en_keywords', []),
+        'completed_stages': meta.get('stages', []),
+    }
+    for stage in meta.get('stages', []):
+        for name in STAGE_ARTIFACTS[stage]:
+            try:
+                if name in _BY_MARKET:
+                    rows = _read_jsonl(os.path.join(run_dir, f"{name}.jsonl"))
+                    restored[name] = {
+                        'zh': [r for r in rows if r.get('market', 'zh') == 'zh'],
+                        'en': [r for r in rows if r.get('market') == 'en'],
+                    }
+                elif name in _JSONL:
+                    restored[name] = _read_jsonl(os.path.join(run_dir, f"{name}.jsonl"))
+                else:
+                    with open(os.path.join(run_dir, f"{name}.json"), encoding="utf-8") as f:
+                        restored[name] = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    # JSON 的 dict key 一律是字串，長尾展開的層數要轉回 int
+    for name in ('deep_suggestions_zh', 'deep_suggestions_en'):
+        if name in restored:
+            restored[name] = {
+                kw: {int(depth): terms for depth, terms in layers.items()}
+                for kw, layers in restored[name].items()
+            }
+    return restored
+
+
+def list_runs(limit=20):
+    """最近的執行紀錄（meta），新的在前"""
+    try:
+        run_ids = os.listdir(RUNS_DIR)
+    except OSError:
+        return []
+    metas = [m for m in (load_meta(run_id) for run_id in run_ids) if m]
+    metas.sort(key=lambda m: -m.get('updated', 0))
+    return metas[:limit]
+
+
+def describe_run(meta):
+    """執行紀錄的一行說明（給選單用）"""
+    keywords = meta.get('zh_keywords', []) + meta.get('en_keywords', [])
+    keyword_text = "、".join(keywords[:3]) + ("…" if len(keywords) > 3 else "")
+    stages = "／".join(STAGE_LABELS.get(s, s) for s in meta.get('stages', []))
+    updated = datetime.fromtimestamp(meta.get('updated', 0)).strftime('%m-%d %H:%M')
+    return f"{updated}｜{keyword_text or '（無關鍵字）'}｜{stages}"
@@ -0,0 +1,2778 @@
+"""YouTube 戰略內容分析引擎：關鍵字展開、搜尋、留言、AI 分析與策略生成。
+
+不依賴 Streamlit，可由 app.py（互動介面）與 batch_runner.py（排程批次）共用。
+"""
+import json
+import re
+import concurrent.futures
+import copy
+import functools
+import hashlib
+import importlib
+import inspect
+import math
+import os
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from collections import Counter, OrderedDict
+from datetime import datetime
+
+import checkpoints
+import replay
+import snapshots
+import tracing
+from videostore import VideoStore
+
+# ==========================================
+# 1. 系統配置
+# ==========================================
+
+# 外部服務位址；可用環境變數指向本機替身伺服器（bench_pipeline.py 用來做離線基準測試）
+SUGGEST_URL = os.environ.get("YT_SUGGEST_URL", "http://suggestqueries.google.com/complete/search")
+YOUTUBE_API_ENDPOINT = os.environ.get("YT_API_ENDPOINT") or None
+GEMINI_API_ENDPOINT = os.environ.get("GEMINI_API_ENDPOINT") or None
+
+# YouTube Data API 遇到 429／5xx 時由 googleapiclient 指數退避重試的次數
+YOUTUBE_NUM_RETRIES = 2
+
+# 固定爬字幕用的模型（低成本）
+TRANSCRIPT_MODEL = "gemini-2.5-flash"
+
+# 關鍵字總表：需求強度由本地訊號計算，LLM 只補意圖標籤與說明
+KEYWORD_INTENTS = ["教學需求", "比較評估", "問題解決", "購買決策", "靈感娛樂", "其他"]
+KEYWORD_TABLE_SIZE = 60
+KEYWORD_LABEL_BATCH = 30
+# 各訊號在需求分數（0～100）中的權重；跨來源出現另有加分
+DEMAND_WEIGHTS = {'relevance': 0.30, 'suggest': 0.15, 'tags': 0.15, 'titles': 0.15, 'comments': 0.15}
+DEMAND_CROSS_SOURCE_BONUS = 0.10
+KEYWORD_LABEL_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "keyword": {"type": "STRING"},
+            "intent": {"type": "STRING", "enum": KEYWORD_INTENTS},
+            "note": {"type": "STRING"},
+        },
+        "required": ["keyword", "intent", "note"],
+    },
+}
+
+# 競品 Tags 共現分析（稀疏矩陣）
+TAG_MIN_VIDEOS = 2          # 至少出現在 2 支影片的 tag 才算共現與缺口
+TAG_PAIR_MIN_COUNT = 2      # 共現至少 2 次的 tag 組合才計算 PMI
+TAG_PAIRS_TOP_N = 20
+TAG_GAPS_TOP_N = 15
+TAG_COVERAGE_TOP_N = 5
+
+# 第二層（供需錯位）本地異常偵測的門檻
+FRONT_ROW_SIZE = 3                  # 「前排」＝排名前 3
+UNDERDOG_SUBSCRIBER_RATIO = 10      # 排在前面的頻道訂閱數不到後面頻道的 1/10，才算小蝦米打大鯨魚
+STALE_FRONT_ROW_DAYS = 730          # 前排多數影片上架超過 2 年＝過時的前排
+HIGH_VIEWS_Z = 0.5                  # 同關鍵字內日均觀看（log）z 分數高於此值
+LOW_ENGAGEMENT_Z = -1.0             # 且互動率 z 分數低於此值＝高觀看低互動
+HOMOGENEOUS_TITLE_TOP_N = 5         # 比較前 5 名標題的相似度
+HOMOGENEOUS_TITLE_SIMILARITY = 0.35  # 兩兩 Jaccard 相似度平均高於此值＝同質化前排
+
+# 影片分析 prompt 版本：改動 extract_video_content_via_ai 的 prompt 時要遞增，舊快取自動失效
+EXTRACT_PROMPT_VERSION = "v4"
+
+# 影片分析的結構化輸出格式（以 response_schema 強制 Gemini 回傳 JSON）
+VIDEO_ANALYSIS_FIELDS = [
+    ("topic", "影片主題"),
+    ("key_points", "核心論點"),
+    ("structure", "內容結構"),
+    ("quotes", "關鍵金句"),
+    ("audience", "目標受眾"),
+    ("gaps", "內容缺口"),
+    ("unique_value", "獨特價值"),
+]
+VIDEO_ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "topic": {"type": "STRING"},
+        "key_points": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "structure": {
+            "type": "OBJECT",
+            "properties": {
+                "opening": {"type": "STRING"},
+                "body": {"type": "STRING"},
+                "ending": {"type": "STRING"},
+            },
+        },
+        "quotes": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "audience": {"type": "STRING"},
+        "gaps": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "unique_value": {"type": "STRING"},
+    },
+    "required": ["topic", "key_points", "structure", "quotes", "audience", "gaps", "unique_value"],
+}
+
+# 競品分析超過這個數量時，策略生成預設走 map-reduce（先按關鍵字濃縮成 brief 再生成）
+MAP_REDUCE_THRESHOLD = 12
+
+# 影片分析快取目錄（競品影片內容不會變，跨 session 重跑時直接沿用）
+ANALYSIS_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "video_analyses")
+
+# 字幕快取目錄（以 video_id 為檔名）
+TRANSCRIPT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "transcripts")
+
+# 各市場的字幕語言優先順序（人工字幕優先於自動字幕由 youtube-transcript-api 處理）
+TRANSCRIPT_LANGUAGES = {
+    "zh": ["zh-TW", "zh-Hant", "zh", "zh-HK", "zh-Hans", "zh-CN", "en"],
+    "en": ["en", "en-US", "en-GB"],
+}
+
+# 字幕前處理：每段時間窗長度（秒）與送進分析 prompt 的 token 預算
+TRANSCRIPT_WINDOW_SEC = 60
+TRANSCRIPT_TOKEN_BUDGET = 6000
+
+# 留言前處理：第三層 prompt 的留言 token 預算、單則留言長度上限、近似重複判定（SimHash 漢明距離）
+COMMENT_TOKEN_BUDGET = 8000
+COMMENT_MAX_CHARS = 300
+COMMENT_MIN_CHARS = 2           # 去掉表情符號與標點後少於 2 個字＝純表情／灌水
+COMMENT_SIMHASH_DISTANCE = 7      # 短留言差一兩個字就會翻動好幾個位元，門檻比長文件寬
+COMMENT_SPAM_RE = re.compile(
+    r"https?://|www\.|t\.me/|wa\.me/|line\.me/|@\w+\.(?:com|net)|"
+    r"sub4sub|sub ?for ?sub|check out my|visit my channel|my channel|subscribe to me|"
+    r"加(?:我)?(?:賴|line|LINE|微信|vx|VX)|私訊|訂閱我|互訂|來我頻道|看我頻道|飆股|投資群|帶單",
+    re.IGNORECASE,
+)
+
+# 字幕中的贅詞與非語音標記（整行只剩這些的字幕會被丟掉）
+TRANSCRIPT_FILLER_RE = re.compile(
+    r"\[[^\]]*\]|\([^)]*\)|♪+|"
+    r"\b(?:um+|uh+|erm|hmm+|you know|i mean|okay so|so yeah)\b|"
+    r"嗯+|呃+|欸+|啊+|喔+|那個|就是說|然後呢|對對對|好那我們",
+    re.IGNORECASE
+)
+
+# 修飾詞探針：逼出 autocomplete 平常不會主動給的決策階段／疑慮類長尾詞
+PROBE_WORDS = {
+    "zh": {
+        "suffix": ["教學", "怎麼用", "推薦", "比較", "開箱", "實測", "新手", "免費", "缺點"],
+        "prefix": ["怎麼"],
+    },
+    "en": {
+        "suffix": ["tutorial", "vs", "review", "for beginners", "free"],
+        "prefix": ["how to", "best"],
+    },
+}
+
+# 預設創作目標
+DEFAULT_USER_GOAL = "我想做一支能蹭到流量，但在專業度上超越他們的影片"
+
+# 策略模組定義
+STRATEGY_MODULES = {
+    "related": {
+        "name": "🔗 相關策略 (Related)",
+        "description": "利用現有熱門影片的流量，做關聯內容",
+        "prompt": """
+## 🔗 相關策略 (Related)
+如何利用這些影片的現有熱度？
+
+請提供：
+1. **關聯標題建議** (3個，融合多個關鍵字)
+2. **關鍵字佈局建議**：主關鍵字、長尾關鍵字、標籤建議
+3. **回應影片策略**：如何做「回應影片」或「補充觀點」
+4. **SEO 優化建議**：標題、描述、縮圖的優化方向
+"""
+    },
+    "trending": {
+        "name": "🔥 蹭流量策略 (Trending)",
+        "description": "快速蹭熱門話題的流量",
+        "prompt": """
+## 🔥 蹭流量策略 (Trending)
+如何快速蹭到這些熱門話題的流量？
+
+請提供：
+1. **時效性切入**：目前最熱的議題點是什麼？
+2. **快速製作建議**：如何在 24-48 小時內產出相關內容
+3. **標題公式**：3 個能蹭流量的標題範本
+4. **風險評估**：這個話題的熱度週期預估
+5. **差異化角度**：如何在眾多蹭流量影片中脫穎而出
+"""
+    },
+    "extended": {
+        "name": "📈 延伸策略 (Extended)",
+        "description": "深入探討競品沒講清楚的內容",
+        "prompt": """
+## 📈 延伸策略 (Extended)
+這些影片沒講清楚的是什麼？
+
+請提供：
+1. **深度延伸點** (列舉 3-5 點)：競品影片提到但沒深入的主題
+2. **實作步驟補充**：競品只講概念，你可以補充的實際操作
+3. **數據佐證方向**：可以用什麼數據讓內容更有說服力
+4. **案例補充**：可以新增哪些案例讓內容更豐富
+5. **進階內容**：適合進階觀眾的延伸主題
+"""
+    },
+    "superior": {
+        "name": "🚀 超越策略 (Superior)",
+        "description": "製作品質更高的影片",
+        "prompt": """
+## 🚀 超越策略 (Superior)
+如何製作一支品質更高的影片？
+
+請提供：
+1. **視覺化升級**：如何用更好的視覺呈現（動畫、圖表、實拍）
+2. **獨特觀點**：競品都沒提到的獨特切入角度
+3. **情緒共鳴設計**：如何設計能引發觀眾共鳴的橋段
+4. **權威性建立**：如何展現你比競品更專業
+5. **製作規格建議**：片長、節奏、段落結構
+6. **腳本大綱**：完整的影片腳本結構建議
+"""
+    },
+    "localization": {
+        "name": "🌏 搬運策略 (Localization)",
+        "description": "將英文優質內容本地化",
+        "prompt": """
+## 🌏 搬運策略 (Localization)
+如何將英文市場的優質內容本地化？
+
+請提供：
+1. **可搬運內容**：哪些英文影片的內容值得本地化？
+2. **本地化調整**：需要針對台灣/華語市場做哪些調整？
+3. **在地案例替換**：可以用什麼本地案例替換國外案例？
+4. **文化適配**：有哪些文化差異需要注意？
+5. **合規建議**：如何避免版權問題，做出原創性內容
+6. **加值方向**：如何在搬運基礎上增加獨特價值
+"""
+    },
+    "comprehensive": {
+        "name": "📊 綜合評比 (Comprehensive)",
+        "description": "整合所有競品的優缺點分析",
+        "prompt": """
+## 📊 綜合評比 (Comprehensive)
+整合所有競品影片的優缺點分析
+
+請提供：
+1. **競品矩陣**：用表格列出各影片的優缺點比較
+2. **內容覆蓋度**：哪些主題被多次提到？哪些被忽略？
+3. **觀眾反應分析**：從觀看數推測觀眾偏好
+4. **最佳實踐**：綜合各競品的最佳做法
+5. **市場缺口總結**：整體市場還缺什麼內容？
+6. **優先順序建議**：如果只能做一支影片，應該選什麼主題？
+"""
+    }
+}
+
+# ==========================================
+# 2. 核心功能函式庫
+# ==========================================
+
+class PipelineCancelled(Exception):
+    """流程被使用者取消（背景工作的 cancel_event 被設定）"""
+
+# 延遲載入的重量級模組實際 import 耗時（秒），供啟動效能面板顯示
+IMPORT_TIMINGS = {}
+
+_import_lock = threading.Lock()
+_imported = set()  # 已確定 import 完成的模組（之後直接取 sys.modules）
+
+def lazy_import(module_name):
+    """第一次用到時才 import（Google SDK、pandas 等載入很慢，不該拖慢冷啟動），並記錄 import 耗時。
+    不能只看 sys.modules：別的 thread 正在 import 時裡面已經有（還沒初始化完的）模組，
+    所以第一次一律經過 importlib（會等到 import 完成），並以 lock 讓同時第一次呼叫的 thread 排隊"""
+    if module_name in _imported:
+        return sys.modules[module_name]
+    with _import_lock:
+        loaded_before = module_name in sys.modules
+        started = time.perf_counter()
+        module = importlib.import_module(module_name)
+        if not loaded_before:
+            IMPORT_TIMINGS.setdefault(module_name, time.perf_counter() - started)
+        _imported.add(module_name)
+    return module
+
+# 所有 shared_cache 的統計（函式名稱 → {hits, misses, size}），供介面顯示
+SHARED_CACHE_STATS = {}
+_SHARED_CACHES = []
+
+def clear_shared_caches():
+    """清空所有 shared_cache（基準測試每輪要從冷快取開始）"""
+    for cached_fn in _SHARED_CACHES:
+        cached_fn.cache_clear()
+
+def _freeze(value):
+    """把參數轉成可 hash 的快取 key（list/dict 轉 tuple）"""
+    if isinstance(value, (list, tuple, set)):
+        items = [_freeze(v) for v in value]
+        return tuple(sorted(items, key=repr)) if isinstance(value, set) else tuple(items)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+def shared_cache(ttl, max_entries, ignore=()):
+    """process 內所有 session 共用的 TTL 快取（thread-safe）。
+
+    - 同樣參數在 ttl 秒內直接回傳先前的結果（deepcopy，呼叫端可以放心修改）
+    - 多個 thread 同時查同一組參數時只打一次 API，其餘等待同一個結果
+    - 空結果不快取也不共用（抓取函式失敗時回傳 []／{}，不該把失敗留住；等待中的 thread 會自己再呼叫一次）
+    - 失敗時例外也會傳給等待同一個呼叫的 thread，各自處理（不會把別人的失敗變成自己的空結果）
+    - ignore 列出不影響結果的參數（例如 API 金鑰），不納入 key，不同金鑰的使用者也能共用
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+        lock = threading.Lock()
+        entries = OrderedDict()  # key → (到期時間, 結果)
+        inflight = {}  # key → Future（正在打 API 的呼叫）
+        stats = SHARED_CACHE_STATS.setdefault(fn.__name__, {'hits': 0, 'misses': 0, 'size': 0})
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = _freeze({k: v for k, v in bound.arguments.items() if k not in ignore})
+            now = time.time()
+            with lock:
+                entry = entries.get(key)
+                if entry and entry[0] > now:
+                    entries.move_to_end(key)
+                    stats['hits'] += 1
+                    return copy.deepcopy(entry[1])
+                future = inflight.get(key)
+                owner = future is None
+                if owner:
+                    future = concurrent.futures.Future()
+                    inflight[key] = future
+                    stats['misses'] += 1
+                else:
+                    stats['hits'] += 1
+            if not owner:
+                shared = future.result()
+                if shared:
+                    return copy.deepcopy(shared)
+                # 空結果不共用（多半是對方的呼叫失敗、錯誤被吞掉）：自己再呼叫一次，錯誤由自己的呼叫回報
+                return fn(*args, **kwargs)
+
+            try:
+                value = fn(*args, **kwargs)
+            except Exception as e:
+                with lock:
+                    inflight.pop(key, None)
+                future.set_exception(e)
+                raise
+            # 存一份呼叫端碰不到的副本，快取與等待中的 thread 都從這份複製
+            stored = copy.deepcopy(value)
+            with lock:
+                inflight.pop(key, None)
+                if value:
+                    entries[key] = (time.time() + ttl, stored)
+                    entries.move_to_end(key)
+                    while len(entries) > max_entries:
+                        entries.popitem(last=False)
+                stats['size'] = len(entries)
+            future.set_result(stored)
+            return value
+
+        def cache_clear():
+            with lock:
+                entries.clear()
+                stats['size'] = 0
+
+        wrapper.cache_clear = cache_clear
+        _SHARED_CACHES.append(wrapper)
+        return wrapper
+    return decorator
+
+_client_local = threading.local()
+
+# 設了 YT_CASSETTE 環境變數時，所有外部呼叫改走錄製／重播層（見 replay.py）
+replay.activate_from_env()
+
+def http_get(url, params=None, timeout=2):
+    """requests.get 的入口；啟用 cassette 時改由 cassette 錄製或重播"""
+    with tracing.span("suggest", q=(params or {}).get("q", "")) as s:
+        cassette = replay.current()
+        if cassette is not None:
+            response = cassette.http_get(url, params=params, timeout=timeout)
+        else:
+            response = lazy_import("requests").get(url, params=params, timeout=timeout)
+        s.set(status=response.status_code, bytes=len(response.content))
+    return response
+
+def gemini_model(api_key, model_version):
+    """建立 Gemini 模型物件（每次呼叫記成 trace span；啟用 cassette 時包上錄製／重播層，重播時不需要 SDK）"""
+    cassette = replay.current()
+    if cassette is not None and cassette.mode == "replay":
+        return tracing.TracedModel(cassette.wrap_model(None, model_version), model_version)
+    genai = lazy_import("google.generativeai")
+    if GEMINI_API_ENDPOINT:
+        genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+    else:
+        genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(model_version)
+    if cassette is not None:
+        model = cassette.wrap_model(model, model_version)
+    return tracing.TracedModel(model, model_version)
+
+def youtube_client(api_key):
+    """YouTube Data API v3 client，每個 thread 每把金鑰只建立一次（googleapiclient 底層的 httplib2 不是 thread-safe，不能跨 thread 共用）"""
+    clients = getattr(_client_local, "youtube", None)
+    if clients is None:
+        clients = _client_local.youtube = {}
+    cassette = replay.current()
+    key = (api_key, id(cassette), YOUTUBE_API_ENDPOINT)
+    if key not in clients:
+        discovery = lazy_import("googleapiclient.discovery")
+        http = cassette.youtube_http() if cassette is not None else lazy_import("googleapiclient.http").build_http()
+        options = {'developerKey': api_key, 'http': tracing.TracedHttp(http)}
+        if YOUTUBE_API_ENDPOINT:
+            options['client_options'] = {'api_endpoint': YOUTUBE_API_ENDPOINT}
+        clients[key] = discovery.build('youtube', 'v3', **options)
+    return clients[key]
+
+def _live_traffic():
+    """目前的外部呼叫是不是真的連到 YouTube（重播 cassette 時是舊資料，不能寫進快照歷史）"""
+    cassette = replay.current()
+    return cassette is None or cassette.mode != "replay"
+
+def _snapshot_view():
+    """讀快照歷史（趨勢、觀看速度）時傳給 snapshots.trending／video_velocity 的參數；None 表示沒有可讀的歷史。
+    快照庫會隨時間變動，所以啟用 cassette 時固定讀 cassette 裡的複本（錄製時由 snapshots.pin 複製），
+    且只看錄製開始（cassette.clock）之前的快照：錄製與重播讀到的歷史完全相同，組出的 prompt 才對得上"""
+    cassette = replay.current()
+    if cassette is None:
+        return {}
+    path = os.path.join(cassette.path, "snapshots.sqlite")
+    source = snapshots.pin(path) if cassette.mode == "record" else snapshots.pinned(path)
+    return None if source is None else {'source': source, 'as_of': cassette.clock}
+
+def _record_snapshot(query, lang, scored, client):
+    """真的從 YouTube 取回的建議詞寫進快照歷史"""
+    if _live_traffic():
+        snapshots.record_suggestions(query, lang, scored, client=client)
+
+@shared_cache(ttl=6 * 3600, max_entries=5000)
+def get_youtube_suggestions(keyword, lang="zh-TW"):
+    """抓取 YouTube 搜尋下拉選單的自動完成關鍵字"""
+    try:
+        url = SUGGEST_URL
+        params = {
+            "client": "firefox",
+            "ds": "yt",
+            "q": keyword,
+            "hl": lang
+        }
+        response = http_get(url, params=params, timeout=2)
+        data = response.json()
+        if data and len(data) > 1:
+            _record_snapshot(keyword, lang, [(t, None) for t in data[1]], "firefox")
+            return data[1]
+        return []
+    except Exception:
+        return []
+
+@shared_cache(ttl=6 * 3600, max_entries=5000)
+def get_youtube_suggestions_with_scores(keyword, lang="zh-TW"):
+    """抓取 YouTube 自動完成關鍵字與 Google 相關性分數，回傳 [(term, score), ...]，分數越高需求越強"""
+    try:
+        url = SUGGEST_URL
+        params = {
+            "client": "chrome",
+            "ds": "yt",
+            "q": keyword,
+            "hl": lang
+        }
+        response = http_get(url, params=params, timeout=2)
+        response.encoding = "utf-8"
+        data = response.json()
+        terms = data[1] if len(data) > 1 else []
+        meta = data[4] if len(data) > 4 and isinstance(data[4], dict) else {}
+        scores = meta.get("google:suggestrelevance", [])
+        if terms:
+            scored = [(t, scores[i] if i < len(scores) else 0) for i, t in enumerate(terms)]
+            _record_snapshot(keyword, lang, scored, "chrome")
+            return scored
+    except Exception:
+        pass
+    # chrome client 解析失敗時退回 firefox client（無分數）
+    return [(t, 0) for t in get_youtube_suggestions(keyword, lang)]
+
+@tracing.traced("probe")
+def probe_youtube_suggestions(keyword, lang="zh-TW", market="zh"):
+    """用修飾詞探針打 YouTube suggest，挖出決策階段／疑慮類長尾詞。回傳 {probe_query: [(term, score), ...]}"""
+    probes = PROBE_WORDS.get(market, PROBE_WORDS["zh"])
+    queries = [f"{keyword} {p}" for p in probes.get("suffix", [])]
+    queries += [f"{p} {keyword}" for p in probes.get("prefix", [])]
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
+        futures = [executor.submit(tracing.bind(get_youtube_suggestions_with_scores), q, lang) for q in queries]
+        # 依探針順序收結果（不是完成順序），下游分群與 prompt 才會每次一致
+        for q, future in zip(queries, futures):
+            try:
+                scored = future.result()
+                if scored:
+                    results[q] = scored[:10]
+            except Exception:
+                pass
+    return results
+
+_opencc = None
+
+def _to_traditional(text):
+    """簡體轉繁體（有安裝 opencc 才轉，沒有就原樣回傳）"""
+    global _opencc
+    if _opencc is None:
+        try:
+            _opencc = lazy_import("opencc").OpenCC("s2t").convert
+        except Exception:
+            _opencc = lambda t: t
+    return _opencc(text)
+
+def term_key(term):
+    """建議詞的正規化寫法：NFKC、小寫、簡轉繁後，以空白切詞、排序再接起來（與詞序、空白都無關）。
+    兩個詞的 key 相同才算同一個詞的變體；只差一兩個字的不同長尾詞（「推薦 2024」與「推薦 平價」）不會被合併"""
+    words = _to_traditional(unicodedata.normalize("NFKC", term).lower()).split()
+    return "".join(sorted(words))
+
+def cluster_terms(entries):
+    """把同一個詞的不同寫法（見 term_key）分成一群，每群保留一個代表詞。
+    entries：[{term, score, seed, source, market}]（同一個詞可出現多次，例如不同種子、不同來源）
+    回傳 [{term, market, score（群內最高相關性分數）, score_sum, count（出現次數）, variants, seeds, sources, source_counts}]，
+    依 score、count 由高到低排序"""
+    by_term = {}
+    for e in entries:
+        term = e['term'].strip()
+        if not term:
+            continue
+        info = by_term.get(term)
+        if info is None:
+            info = by_term[term] = {'score': 0, 'score_sum': 0, 'count': 0, 'seeds': set(), 'sources': {}, 'market': e.get('market', 'zh')}
+        info['score'] = max(info['score'], e.get('score', 0) or 0)
+        info['score_sum'] += e.get('score', 0) or 0
+        info['count'] += 1
+        if e.get('seed'):
+            info['seeds'].add(e['seed'])
+        if e.get('source'):
+            info['sources'][e['source']] = info['sources'].get(e['source'], 0) + 1
+    # 依詞排序後再分群：結果只跟「有哪些詞」有關，與 entries 的先後（各來源完成的順序）無關
+    terms = sorted(by_term)
+    if not terms:
+        return []
+
+    # 正規化寫法完全相同才合併：一次 dict 分組，不做兩兩比較，也不會經由中間詞一路串成大群
+    members = {}
+    for term in terms:
+        members.setdefault(term_key(term), []).append(term)
+
+    clusters = []
+    for group in members.values():
+        infos = [(term, by_term[term]) for term in group]
+        # 代表詞：最高分 → 出現最多次 → 最短 → 字典序最前
+        rep, rep_info = min(infos, key=lambda x: (-x[1]['score'], -x[1]['count'], len(x[0]), x[0]))
+        source_counts = {}
+        for _, info in infos:
+            for source, n in info['sources'].items():
+                source_counts[source] = source_counts.get(source, 0) + n
+        clusters.append({
+            'term': rep,
+            'market': rep_info['market'],
+            'score': max(info['score'] for _, info in infos),
+            'score_sum': sum(info['score_sum'] for _, info in infos),
+            'count': sum(info['count'] for _, info in infos),
+            'variants': sorted(t for t, _ in infos if t != rep),
+            'seeds': sorted(set().union(*(info['seeds'] for _, info in infos))),
+            'sources': sorted(source_counts),
+            'source_counts': source_counts,
+        })
+    clusters.sort(key=lambda c: (-c['score'], -c['count'], c['term']))
+    return clusters
+
+def suggestion_entries(deep_suggestions, probe_suggestions, market="zh"):
+    """把長尾展開 {kw: {depth: [terms]}} 與探針 {kw: {query: [(term, score)]}} 攤平成 cluster_terms 的輸入"""
+    entries = []
+    for kw, layers in (deep_suggestions or {}).items():
+        for terms in layers.values():
+            entries += [{'term': t, 'score': 0, 'seed': kw, 'source': 'autocomplete', 'market': market} for t in terms]
+    for kw, probe_map in (probe_suggestions or {}).items():
+        for scored in probe_map.values():
+            entries += [{'term': t, 'score': s, 'seed': kw, 'source': 'probe', 'market': market} for t, s in scored]
+    return entries
+
+def format_term_cluster(cluster, show_sources=False):
+    """一個分群的 prompt 表示：代表詞(最高分數, ×出現次數, 變體數)"""
+    details = []
+    if cluster['score']:
+        details.append(str(cluster['score']))
+    if cluster['count'] > 1:
+        details.append(f"×{cluster['count']}")
+    if cluster['variants']:
+        details.append(f"+{len(cluster['variants'])}變體")
+    if show_sources:
+        details.append("+".join(cluster['sources']))
+    return f"{cluster['term']}({', '.join(details)})" if details else cluster['term']
+
+def collect_video_tags(videos):
+    """收集競品影片的 tags（創作者自填的 SEO 關鍵字），回傳出現頻率 Counter"""
+    counter = Counter()
+    for v in videos or []:
+        for t in v.get('tags', []):
+            t = t.strip().lower()
+            if t:
+                counter[t] += 1
+    return counter
+
+def parse_iso_duration(duration_str):
+    """將 ISO 8601 時長 (PT12M34S) 轉為分鐘數"""
+    m = re.match(r'PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?', duration_str or '')
+    if not m:
+        return 0
+    h, mi, s = (int(g) if g else 0 for g in m.groups())
+    return round(h * 60 + mi + s / 60, 1)
+
+def video_age_days(publish_time):
+    """影片上架至今的天數（最小 1）"""
+    try:
+        dt = datetime.strptime(publish_time[:10], '%Y-%m-%d')
+        return max((replay.now() - dt).days, 1)
+    except Exception:
+        return 0
+
+@shared_cache(ttl=24 * 3600, max_entries=500, ignore=("api_key",))
+def fetch_channel_stats(api_key, channel_ids):
+    """批次查詢頻道訂閱數，回傳 {channel_id: subscriber_count}。訂閱數是偵測「小蝦米打大鯨魚」異常的關鍵訊號"""
+    stats = {}
+    # 去重但保留順序：請求內容每次相同，cassette 重播才比對得到
+    ids = list(dict.fromkeys(c for c in channel_ids if c))
+    if not ids:
+        return stats
+    try:
+        youtube = youtube_client(api_key)
+        for i in range(0, len(ids), 50):
+            resp = youtube.channels().list(
+                part='statistics',
+                id=','.join(ids[i:i + 50])
+            ).execute(num_retries=YOUTUBE_NUM_RETRIES)
+            for item in resp.get('items', []):
+                stats[item['id']] = int(item['statistics'].get('subscriberCount', 0))
+    except Exception:
+        pass
+    return stats
+
+def refresh_video_stats(api_key, video_ids=None, stale_hours=24, max_workers=4):
+    """增量更新影片統計快照：只重新抓追蹤中且快照已過期的影片（不給 video_ids 時由快照庫挑選），
+    每 50 支一次 videos.list(part=statistics)（1 單位配額）。回傳 {requested, refreshed, missing, failed, errors}：
+    missing＝請求成功但 API 沒回傳的影片（已下架或設為私人），failed＝所在批次請求失敗的影片數，errors 為各批的錯誤訊息"""
+    store = snapshots.store()
+    if store is None:
+        return {'requested': 0, 'refreshed': 0, 'missing': 0, 'failed': 0, 'errors': []}
+    ids = list(dict.fromkeys(video_ids)) if video_ids is not None else store.stale_video_ids(stale_hours=stale_hours)
+
+    def fetch(batch):
+        youtube = youtube_client(api_key)
+        resp = youtube.videos().list(
+            part='statistics',
+            id=','.join(batch),
+            fields='items(id,statistics(viewCount,likeCount,commentCount))',
+            maxResults=50,
+        ).execute(num_retries=YOUTUBE_NUM_RETRIES)
+        return [
+            {
+                'id': item['id'],
+                'view_count': int(item['statistics'].get('viewCount', 0)),
+                'like_count': int(item['statistics'].get('likeCount', 0)),
+                'comment_count': int(item['statistics'].get('commentCount', 0)),
+            }
+            for item in resp.get('items', [])
+        ]
+
+    result = {'requested': len(ids), 'refreshed': 0, 'missing': 0, 'failed': 0, 'errors': []}
+    batches = [ids[i:i + 50] for i in range(0, len(ids), 50)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_batch = {executor.submit(tracing.bind(fetch), b): b for b in batches}
+        for future in concurrent.futures.as_completed(future_to_batch):
+            batch = future_to_batch[future]
+            try:
+                rows = future.result()
+            except Exception as e:
+                # 配額用完、網路錯誤等：這批的影片沒更新，與「影片已下架」分開回報
+                result['failed'] += len(batch)
+                result['errors'].append(str(e))
+                continue
+            # 已下架／設為私人的影片不會回傳，之後仍會被挑到，但不影響其他影片
+            result['missing'] += len(batch) - len(rows)
+            if _live_traffic():
+                result['refreshed'] += snapshots.record_video_stats(rows, source="refresh")
+    return result
+
+@tracing.traced("suggest.deep")
+def get_youtube_suggestions_deep(keyword, lang="zh-TW", depth=2):
+    """遞迴展開 YouTube 自動完成關鍵字，回傳 {depth_level: [suggestions]}"""
+    results = {}
+
+    # 第一層
+    layer1 = get_youtube_suggestions(keyword, lang)
+    results[1] = layer1
+
+    if depth >= 2 and layer1:
+        layer2 = []
+        seen = set(layer1)
+        for sub_kw in layer1[:8]:  # 最多展開前 8 個
+            sub_suggestions = get_youtube_suggestions(sub_kw, lang)
+            for s in sub_suggestions:
+                if s not in seen and s != keyword:
+                    seen.add(s)
+                    layer2.append(s)
+        results[2] = layer2
+
+    return results
+
+@tracing.traced("translate")
+def translate_keyword_to_english(api_key, keyword, model_version="gemini-2.5-flash"):
+    """使用 AI 將關鍵字翻譯成英文"""
+    model = gemini_model(api_key, model_version)
+    
+    prompt = f"""
+    請將以下中文關鍵字翻譯成最適合在 YouTube 搜尋的英文關鍵字。
+    
+    中文關鍵字：{keyword}
+    
+    要求：
+    1. 翻譯要符合英文 YouTube 的搜尋習慣
+    2. 如果有多種翻譯方式，選擇搜尋量最大的版本
+    3. 只回覆英文關鍵字，不要其他解釋
+    4. 如果關鍵字本身就是英文或專有名詞，保持原樣
+    """
+    
+    try:
+        response = model.generate_content(prompt)
+        return response.text.strip()
+    except Exception as e:
+        return keyword  # 翻譯失敗就用原本的
+
+def batch_translate_keywords(api_key, keywords_list, model_version="gemini-2.5-flash"):
+    """批次翻譯關鍵字"""
+    translations = {}
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        future_to_kw = {
+            executor.submit(tracing.bind(translate_keyword_to_english), api_key, kw, model_version): kw 
+            for kw in keywords_list
+        }
+        
+        for future in concurrent.futures.as_completed(future_to_kw):
+            original_kw = future_to_kw[future]
+            try:
+                translated = future.result()
+                translations[original_kw] = translated
+            except Exception:
+                translations[original_kw] = original_kw
+    
+    return translations
+
+@shared_cache(ttl=3600, max_entries=1000)
+def _search_youtube_api(api_key, query, max_results=5, region_code="TW", relevance_language=None):
+    """search_youtube_api 的快取核心：失敗時丟出例外（同時等待同一個呼叫的其他 session 也會收到，各自回報）。
+    金鑰納入快取 key：金鑰無效或配額用完的 session 要看到自己的錯誤，不能拿到別人的快取結果"""
+    youtube = youtube_client(api_key)
+    
+    search_params = {
+        'q': query,
+        'part': 'id,snippet',
+        'maxResults': max_results,
+        'type': 'video',
+        'order': 'relevance',
+        'regionCode': region_code
+    }
+    
+    if relevance_language:
+        search_params['relevanceLanguage'] = relevance_language
+    
+    search_response = youtube.search().list(**search_params).execute(num_retries=YOUTUBE_NUM_RETRIES)
+
+    video_ids = [item['id']['videoId'] for item in search_response['items']]
+
+    if not video_ids:
+        return []
+
+    # 記錄搜尋排名順序
+    rank_map = {vid: idx + 1 for idx, vid in enumerate(video_ids)}
+
+    stats_response = youtube.videos().list(
+        part='snippet,statistics,contentDetails',
+        id=','.join(video_ids)
+    ).execute(num_retries=YOUTUBE_NUM_RETRIES)
+
+    results = []
+    for item in stats_response['items']:
+        results.append({
+            'id': item['id'],
+            'title': item['snippet']['title'],
+            'description': item['snippet']['description'],
+            'tags': item['snippet'].get('tags', []),
+            'channel': item['snippet']['channelTitle'],
+            'publish_time': item['snippet']['publishedAt'],
+            'channel_id': item['snippet'].get('channelId', ''),
+            'view_count': int(item['statistics'].get('viewCount', 0)),
+            'like_count': int(item['statistics'].get('likeCount', 0)),
+            'comment_count': int(item['statistics'].get('commentCount', 0)),
+            'duration_min': parse_iso_duration(item.get('contentDetails', {}).get('duration', '')),
+            'thumbnail': item['snippet']['thumbnails']['high']['url'],
+            'url': f"https://www.youtube.com/watch?v={item['id']}",
+            'source_keyword': query,
+            'language': relevance_language or 'zh',
+            'rank': rank_map.get(item['id'], 99)
+        })
+
+    # 按搜尋排名排序（stats API 不保證順序）
+    results.sort(key=lambda x: x['rank'])
+    if _live_traffic():
+        snapshots.record_video_stats(results, source="search")
+    return results
+
+def search_youtube_api(api_key, query, max_results=5, region_code="TW", relevance_language=None, on_error=None):
+    """使用 YouTube Data API 獲取影片列表與詳細數據；失敗時回傳 []，錯誤訊息交給 on_error（例如 st.error）"""
+    try:
+        return _search_youtube_api(api_key, query, max_results, region_code, relevance_language)
+    except Exception as e:
+        if on_error:
+            on_error(f"YouTube API 錯誤 ({query}): {e}")
+        return []
+
+def search_multiple_keywords(api_key, keywords_list, max_results_per_keyword, lang="zh", on_error=None):
+    """批次搜尋多個關鍵字"""
+    all_results = []
+    seen_ids = set()
+    
+    region_code = "TW" if lang == "zh" else "US"
+    relevance_language = "zh-Hant" if lang == "zh" else "en"
+    
+    for keyword in keywords_list:
+        results = search_youtube_api(
+            api_key, keyword, max_results_per_keyword, 
+            region_code=region_code, 
+            relevance_language=relevance_language,
+            on_error=on_error
+        )
+        for video in results:
+            if video['id'] not in seen_ids:
+                seen_ids.add(video['id'])
+                video['market'] = lang  # 標記市場
+                all_results.append(video)
+    
+    return all_results
+
+@shared_cache(ttl=3600, max_entries=2000, ignore=("youtube_api_key",))
+def fetch_top_comments(youtube_api_key, video_id, max_results=50):
+    """抓取單支影片的熱門留言（含回覆串——留言區的爭論是最有價值的分歧訊號）"""
+    try:
+        youtube = youtube_client(youtube_api_key)
+        response = youtube.commentThreads().list(
+            part='snippet,replies',
+            videoId=video_id,
+            order='relevance',
+            maxResults=max_results,
+            textFormat='plainText'
+        ).execute(num_retries=YOUTUBE_NUM_RETRIES)
+
+        comments = []
+        for item in response.get('items', []):
+            snippet = item['snippet']['topLevelComment']['snippet']
+            comments.append({
+                'text': snippet['textDisplay'],
+                'likes': snippet.get('likeCount', 0),
+                'author': snippet.get('authorDisplayName', ''),
+                'is_reply': False,
+            })
+            # 回覆緊跟在母留言後面，保留對話脈絡
+            for reply in item.get('replies', {}).get('comments', [])[:3]:
+                rs = reply['snippet']
+                comments.append({
+                    'text': rs['textDisplay'],
+                    'likes': rs.get('likeCount', 0),
+                    'author': rs.get('authorDisplayName', ''),
+                    'is_reply': True,
+                })
+        return comments
+    except Exception:
+        return []
+
+def batch_fetch_comments(youtube_api_key, videos_by_keyword, top_n=3, max_per_video=20):
+    """對每個關鍵字排名前 top_n 的影片批次抓留言，回傳 {video_id: {title, keyword, comments}}"""
+    results = {}
+    seen_ids = set()
+
+    for keyword, videos in videos_by_keyword.items():
+        sorted_videos = sorted(videos, key=lambda v: v.get('rank', 999))
+        for video in sorted_videos[:top_n]:
+            vid = video['id']
+            if vid in seen_ids:
+                continue
+            seen_ids.add(vid)
+            comments = fetch_top_comments(youtube_api_key, vid, max_per_video)
+            results[vid] = {
+                'title': video['title'],
+                'keyword': keyword,
+                'comments': comments
+            }
+    return results
+
+# ==========================================
+# 3. AI 分析函式
+# ==========================================
+
+def youtube_transcript_source(video_id, languages):
+    """預設字幕來源：youtube-transcript-api，回傳 [{text, start, duration}]；影片沒有字幕時回傳 None"""
+    YouTubeTranscriptApi = lazy_import("youtube_transcript_api").YouTubeTranscriptApi
+    try:
+        if hasattr(YouTubeTranscriptApi, "get_transcript"):
+            return YouTubeTranscriptApi.get_transcript(video_id, languages=languages)
+        # youtube-transcript-api >= 1.0 改為實例方法
+        return YouTubeTranscriptApi().fetch(video_id, languages=languages).to_raw_data()
+    except Exception:
+        return None
+
+def make_local_transcript_source(directory):
+    """本地字幕替身（測試／離線用）：讀取 directory/<video_id>.json（[{text, start, duration}]）或 .txt（每行一句）"""
+    def source(video_id, languages):
+        json_path = os.path.join(directory, f"{video_id}.json")
+        txt_path = os.path.join(directory, f"{video_id}.txt")
+        try:
+            if os.path.exists(json_path):
+                with open(json_path, encoding="utf-8") as f:
+                    return json.load(f)
+            if os.path.exists(txt_path):
+                with open(txt_path, encoding="utf-8") as f:
+                    lines = [line.strip() for line in f if line.strip()]
+                return [{'text': line, 'start': float(i), 'duration': 1.0} for i, line in enumerate(lines)]
+        except (OSError, ValueError):
+            pass
+        return None
+    return source
+
+def fetch_transcript(video_id, market="zh", source=None, use_cache=True):
+    """取得單支影片字幕（先查磁碟快取），回傳 [{text, start, duration}] 或 None"""
+    path = os.path.join(TRANSCRIPT_CACHE_DIR, f"{video_id}.json")
+    if use_cache:
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    source = source or youtube_transcript_source
+    languages = TRANSCRIPT_LANGUAGES.get(market, TRANSCRIPT_LANGUAGES["zh"])
+    try:
+        segments = source(video_id, languages)
+    except Exception:
+        segments = None
+    if not segments:
+        return None
+
+    segments = [
+        {'text': seg['text'], 'start': float(seg.get('start', 0)), 'duration': float(seg.get('duration', 0))}
+        for seg in segments if str(seg.get('text', '')).strip()
+    ]
+    if use_cache and segments:
+        try:
+            os.makedirs(TRANSCRIPT_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(segments, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+    return segments or None
+
+def batch_fetch_transcripts(videos, max_workers=8, source=None, use_cache=True):
+    """並行抓取多支影片的字幕，回傳 {video_id: segments}（沒有字幕的影片不會出現在結果中）"""
+    transcripts = {}
+    if not videos:
+        return transcripts
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_id = {
+            executor.submit(tracing.bind(fetch_transcript), v['id'], v.get('market', 'zh'), source, use_cache): v['id']
+            for v in videos
+        }
+        for future in concurrent.futures.as_completed(future_to_id):
+            try:
+                segments = future.result()
+            except Exception:
+                segments = None
+            if segments:
+                transcripts[future_to_id[future]] = segments
+    return transcripts
+
+def _text_tokens(text):
+    """斷詞：中日韓文字取字元 bigram、拉丁文字取小寫單字（TF-IDF 與 token 估算共用）"""
+    tokens = re.findall(r"[a-z0-9']+", text.lower())
+    for run in re.findall(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]+", text):
+        tokens += [run[i:i + 2] for i in range(max(len(run) - 1, 1))]
+    return tokens
+
+def estimate_tokens(text):
+    """粗估 LLM token 數：中日韓文字約 1 字 1 token，英文約 1 字 1.3 token"""
+    cjk = len(re.findall(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]", text))
+    words = len(re.findall(r"[A-Za-z0-9']+", text))
+    return cjk + int(words * 1.3) + 1
+
+def segment_transcript(segments, window_sec=TRANSCRIPT_WINDOW_SEC):
+    """依時間窗切段，同時去除贅詞、非語音標記與重複字幕。回傳 [{start, sentences: [...]}]"""
+    windows = []
+    seen = set()
+    for seg in segments:
+        text = TRANSCRIPT_FILLER_RE.sub(" ", seg['text'].replace('\n', ' '))
+        text = re.sub(r"\s+", " ", text).strip(" ,，、.。")
+        key = re.sub(r"\W+", "", text.lower())
+        # 太短（純贅詞殘渣）或重複（自動字幕的滾動重疊）的行直接丟掉
+        if len(key) < 2 or key in seen:
+            continue
+        seen.add(key)
+        idx = int(seg.get('start', 0) // window_sec)
+        if not windows or windows[-1]['index'] != idx:
+            windows.append({'index': idx, 'start': idx * window_sec, 'sentences': []})
+        sentences = windows[-1]['sentences']
+        # 自動字幕常把一句話拆成很多短行，太短的併進上一句
+        if sentences and len(sentences[-1]) < 20:
+            sentences[-1] += " " + text
+        else:
+            sentences.append(text)
+    return windows
+
+def compress_transcript(segments, token_budget=TRANSCRIPT_TOKEN_BUDGET, window_sec=TRANSCRIPT_WINDOW_SEC):
+    """字幕前處理：時間窗切段 → 去贅詞與重複 → TF-IDF 抽取式排序 → 在 token 預算內保留最有資訊量的句子（依時間順序輸出）"""
+    windows = segment_transcript(segments, window_sec)
+    sentences = [(w, s) for w in windows for s in w['sentences']]
+    if not sentences:
+        return ""
+
+    def render(chosen):
+        lines = []
+        last_window = None
+        for w, sent in chosen:
+            if w is not last_window:
+                lines.append(f"[{w['start'] // 60:02d}:{w['start'] % 60:02d}]")
+                last_window = w
+            lines.append(sent)
+        return "\n".join(lines)
+
+    full_text = render(sentences)
+    if estimate_tokens(full_text) <= token_budget:
+        return full_text
+
+    # 以時間窗為文件算 IDF：只在少數段落出現的詞才是該段的重點
+    window_tokens = [set(_text_tokens(" ".join(w['sentences']))) for w in windows]
+    df = Counter(t for tokens in window_tokens for t in tokens)
+    n_windows = len(windows)
+    idf = {t: math.log((1 + n_windows) / (1 + c)) + 1 for t, c in df.items()}
+
+    scored = []
+    for order, (w, sent) in enumerate(sentences):
+        tf = Counter(_text_tokens(sent))
+        if not tf:
+            continue
+        score = sum(c * idf.get(t, 1) for t, c in tf.items()) / math.sqrt(sum(tf.values()))
+        scored.append((score, order, w, sent))
+
+    # 先保證每個時間窗至少留下最高分的一句（保留影片結構），再依分數補滿預算
+    best_per_window = {}
+    for item in scored:
+        key = id(item[2])
+        if key not in best_per_window or item[0] > best_per_window[key][0]:
+            best_per_window[key] = item
+    ranked = sorted(best_per_window.values(), key=lambda x: -x[0])
+    first_pass = {x[1] for x in ranked}
+    ranked += sorted((x for x in scored if x[1] not in first_pass), key=lambda x: -x[0])
+
+    chosen = []
+    used = 0
+    used_windows = set()
+    for score, order, w, sent in ranked:
+        # 每個時間窗的時間戳標題約佔 4 個 token
+        cost = estimate_tokens(sent) + (0 if id(w) in used_windows else 4)
+        if used + cost > token_budget:
+            continue
+        chosen.append((order, w, sent))
+        used_windows.add(id(w))
+        used += cost
+    chosen.sort(key=lambda x: x[0])
+    return render([(w, sent) for _, w, sent in chosen])
+
+def normalize_comment(text):
+    """留言正規化：NFKC、去零寬字元、合併空白、把連續重複 4 次以上的字元縮成 3 個（哈哈哈哈哈、!!!!!）"""
+    text = unicodedata.normalize("NFKC", text or "")
+    text = re.sub(r"[\u200b-\u200f\u2060\ufeff]", "", text)
+    text = re.sub(r"(.)\1{3,}", r"\1\1\1", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+def comment_language(text):
+    """依文字系統粗判語言：zh／ja／ko／en／other（不需要額外的語言偵測套件）"""
+    kana = len(re.findall(r"[\u3040-\u30ff]", text))
+    hangul = len(re.findall(r"[\uac00-\ud7af]", text))
+    han = len(re.findall(r"[\u3400-\u9fff]", text))
+    latin = len(re.findall(r"[A-Za-z]", text))
+    if kana:
+        return "ja"
+    if hangul > han:
+        return "ko"
+    if han:
+        return "zh"
+    return "en" if latin else "other"
+
+@functools.lru_cache(maxsize=65536)
+def _token_bits(token):
+    return format(int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "big"), "064b")
+
+def _simhash(tokens):
+    """64 位元 SimHash：字詞集合相近的文字，雜湊值只差幾個位元（逐位元多數決，用字串欄位計數代替逐位元迴圈）"""
+    rows = [_token_bits(tok) for tok in set(tokens)]
+    return int("".join("1" if 2 * column.count("1") > len(rows) else "0" for column in map("".join, zip(*rows))), 2)
+
+def clean_comments(video_comments, stats=None):
+    """留言前處理（逐則串流處理）：正規化 → 過濾垃圾留言與純表情 → 近似重複去重 → 標註語言。
+    產生 (video_id, 留言)；重複留言不輸出，改把它的讚數與次數併進第一次出現的那則（dupes），
+    母留言被丟掉時整串回覆一起丟。stats 傳入 Counter 時累計各類被丟掉的數量"""
+    stats = stats if stats is not None else Counter()
+    seen_exact = {}
+    # SimHash 切成「門檻 + 1」段：差異位元數不超過門檻的兩個值，必有一段完全相同（只比對同段相同的候選）
+    n_bands = COMMENT_SIMHASH_DISTANCE + 1
+    width = 64 // n_bands
+    mask = (1 << width) - 1
+    bands = [{} for _ in range(n_bands)]
+    for vid, data in (video_comments or {}).items():
+        keep_thread = False
+        for c in data.get('comments', []):
+            stats['input'] += 1
+            if c.get('is_reply') and not keep_thread:
+                stats['orphan_replies'] += 1
+                continue
+            text = normalize_comment(c.get('text', ''))
+            if not c.get('is_reply'):
+                keep_thread = False
+            if COMMENT_SPAM_RE.search(text):
+                stats['spam'] += 1
+                continue
+            key = re.sub(r"[\W_]+", "", text.lower())
+            if len(key) < COMMENT_MIN_CHARS:
+                stats['noise'] += 1
+                continue
+
+            tokens = _text_tokens(text)
+            original = seen_exact.get(key)
+            if original is None and len(set(tokens)) >= 4:
+                fingerprint = _simhash(tokens)
+                for i, band in enumerate(bands):
+                    for candidate, cand_fp in band.get(fingerprint >> (width * i) & mask, ()):
+                        if bin(fingerprint ^ cand_fp).count("1") <= COMMENT_SIMHASH_DISTANCE:
+                            original = candidate
+                            break
+                    if original is not None:
+                        break
+            if original is not None:
+                original['likes'] += c.get('likes', 0)
+                original['dupes'] += 1
+                stats['duplicates'] += 1
+                continue
+
+            cleaned = {
+                'text': text[:COMMENT_MAX_CHARS],
+                'likes': c.get('likes', 0),
+                'author': c.get('author', ''),
+                'is_reply': bool(c.get('is_reply')),
+                'lang': comment_language(text),
+                'dupes': 0,
+            }
+            seen_exact[key] = cleaned
+            if len(set(tokens)) >= 4:
+                for i, band in enumerate(bands):
+                    band.setdefault(fingerprint >> (width * i) & mask, []).append((cleaned, fingerprint))
+            if not cleaned['is_reply']:
+                keep_thread = True
+            stats['kept'] += 1
+            stats[f"lang_{cleaned['lang']}"] += 1
+            yield vid, cleaned
+
+def sample_comments(video_comments, token_budget=COMMENT_TOKEN_BUDGET):
+    """前處理後依讚數加權抽樣，整串（母留言＋回覆）一起選，總量控制在 token 預算內。
+    回傳 ({video_id: {title, keyword, comments}}, stats)；各影片輪流選，避免留言多的影片吃光預算"""
+    stats = Counter()
+    threads = {}
+    for vid, c in clean_comments(video_comments, stats):
+        if c['is_reply'] and threads.get(vid):
+            threads[vid][-1].append(c)
+        elif not c['is_reply']:
+            threads.setdefault(vid, []).append([c])
+
+    def priority(thread):
+        # 加權抽樣（Efraimidis–Spirakis）：key = u^(1/w)，w 隨讚數與重複次數遞增；u 取自文字雜湊，結果可重現
+        weight = math.log1p(sum(c['likes'] + c['dupes'] for c in thread)) + 1
+        u = (zlib.crc32(thread[0]['text'].encode("utf-8")) + 1) / 2 ** 32
+        return u ** (1 / weight)
+
+    queues = {vid: sorted(ts, key=priority, reverse=True) for vid, ts in threads.items()}
+    chosen = {vid: [] for vid in queues}
+    used = 0
+    while any(queues.values()):
+        for vid, queue in queues.items():
+            if not queue:
+                continue
+            thread = queue.pop(0)
+            cost = sum(estimate_tokens(c['text']) + 6 for c in thread)
+            if used + cost > token_budget:
+                stats['over_budget'] += len(thread)
+                continue
+            chosen[vid].append(thread)
+            used += cost
+
+    sampled = {}
+    for vid, picked in chosen.items():
+        if not picked:
+            continue
+        # 輸出時依讚數排序（整串一起移動），讀起來跟 YouTube 的熱門排序一致
+        picked.sort(key=lambda t: -(t[0]['likes'] + t[0]['dupes']))
+        data = video_comments[vid]
+        sampled[vid] = {'title': data.get('title', ''), 'keyword': data.get('keyword', ''),
+                        'comments': [c for thread in picked for c in thread]}
+        stats['sampled'] += len(sampled[vid]['comments'])
+    stats['tokens'] = used
+    return sampled, dict(stats)
+
+def parse_json_response(text):
+    """解析 Gemini 回傳的 JSON（容忍 ```json 包裹）"""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        if text.startswith("json"):
+            text = text[4:]
+    return json.loads(text)
+
+def render_video_analysis_md(structured):
+    """把結構化影片分析渲染成 Markdown（供 UI 顯示與匯出）"""
+    lines = []
+    for idx, (field, label) in enumerate(VIDEO_ANALYSIS_FIELDS, 1):
+        value = structured.get(field)
+        lines.append(f"{idx}. **{label}**：")
+        if field == "structure" and isinstance(value, dict):
+            lines.append(f"   - 開頭：{value.get('opening', '')}")
+            lines.append(f"   - 中段：{value.get('body', '')}")
+            lines.append(f"   - 結尾：{value.get('ending', '')}")
+        elif isinstance(value, list):
+            lines += [f"   - {item}" for item in value]
+        else:
+            lines[-1] += f"{value or ''}"
+    return "\n".join(lines)
+
+def analysis_markdown(analysis):
+    """單支影片分析的 Markdown 內文：有結構化欄位就從欄位渲染，否則用原文（失敗訊息或舊格式）"""
+    if analysis.get('structured'):
+        return render_video_analysis_md(analysis['structured'])
+    return analysis['ai_analysis']
+
+def format_analysis_for_prompt(analysis):
+    """策略 prompt 用的精簡版影片分析：從結構化欄位組成，舊格式（純文字）原樣使用"""
+    structured = analysis.get('structured')
+    if not structured:
+        return analysis['ai_analysis']
+    structure = structured.get('structure') or {}
+    return "\n".join([
+        f"主題：{structured.get('topic', '')}",
+        f"論點：{'；'.join(structured.get('key_points', []))}",
+        f"結構：{structure.get('opening', '')} → {structure.get('body', '')} → {structure.get('ending', '')}",
+        f"金句：{'；'.join(structured.get('quotes', []))}",
+        f"受眾：{structured.get('audience', '')}",
+        f"缺口：{'；'.join(structured.get('gaps', []))}",
+        f"獨特價值：{structured.get('unique_value', '')}",
+    ])
+
+def search_analyses(analyses, query):
+    """在本地依結構化欄位篩選影片分析（不需重新解析文字），query 以空白分隔、全部命中才保留"""
+    terms = [t.lower() for t in query.split() if t]
+    if not terms:
+        return list(analyses)
+    matched = []
+    for a in analyses:
+        haystack = json.dumps(a.get('structured') or a.get('ai_analysis', ''), ensure_ascii=False).lower()
+        haystack += a.get('title', '').lower()
+        if all(t in haystack for t in terms):
+            matched.append(a)
+    return matched
+
+@tracing.traced("extract")
+def extract_video_content_via_ai(api_key, video_info, transcript=None):
+    """分析單支 YouTube 影片的內容，回傳結構化欄位（structured）與渲染後的 Markdown（ai_analysis）。
+    有字幕時直接分析字幕文字；沒有字幕才退回請 AI 依網址爬取"""
+    model = gemini_model(api_key, TRANSCRIPT_MODEL)
+    
+    video_url = video_info['url']
+    video_title = video_info['title']
+    market = video_info.get('market', 'zh')
+    
+    lang_instruction = "所有欄位請用繁體中文填寫" if market == "zh" else "所有欄位請用繁體中文填寫（影片是英文的，但分析請用中文；金句可保留英文原文）"
+    
+    if transcript:
+        source_text = f"""
+    請根據以下影片字幕分析這支 YouTube 影片的完整內容：
+    影片標題：{video_title}
+
+    【字幕】
+    {compress_transcript(transcript)}
+    """
+    else:
+        source_text = f"""
+    請分析這支 YouTube 影片的完整內容：
+    影片網址：{video_url}
+    影片標題：{video_title}
+    """
+
+    prompt = f"""
+    {source_text}
+    請依 JSON 格式回傳以下欄位：
+    - topic：這支影片在講什麼？(1-2句)
+    - key_points：影片的主要觀點或教學重點 (3-5點)
+    - structure：段落架構，opening（開頭講什麼）、body（中間講什麼）、ending（結尾講什麼）
+    - quotes：影片中有價值的句子或觀點 (2-3句)
+    - audience：這支影片是拍給誰看的？
+    - gaps：這支影片沒講到但觀眾可能想知道的 (1-2點)
+    - unique_value：這支影片相比其他同類影片的獨特之處
+    
+    {lang_instruction}。
+    """
+    
+    base = {
+        'video_id': video_info['id'],
+        'title': video_title,
+        'url': video_url,
+        'view_count': video_info['view_count'],
+        'source_keyword': video_info.get('source_keyword', ''),
+        'market': market,
+        'content_source': 'transcript' if transcript else 'url',
+    }
+    try:
+        response = model.generate_content(
+            prompt,
+            generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": VIDEO_ANALYSIS_SCHEMA,
+            }
+        )
+        try:
+            structured = parse_json_response(response.text)
+        except ValueError:
+            structured = None
+        if not isinstance(structured, dict):
+            # JSON 解析失敗時保留原文，仍可供閱讀與策略生成
+            return {**base, 'structured': None, 'ai_analysis': response.text, 'success': True}
+        return {
+            **base,
+            'structured': structured,
+            'ai_analysis': render_video_analysis_md(structured),
+            'success': True
+        }
+    except Exception as e:
+        return {**base, 'structured': None, 'ai_analysis': f"爬取失敗: {str(e)}", 'success': False}
+
+def _analysis_cache_path(video_id, model=TRANSCRIPT_MODEL, prompt_version=EXTRACT_PROMPT_VERSION):
+    """快取檔路徑，以 (video_id, 模型, prompt 版本) 為 key"""
+    key = hashlib.sha1(f"{video_id}|{model}|{prompt_version}".encode("utf-8")).hexdigest()
+    return os.path.join(ANALYSIS_CACHE_DIR, f"{key}.json")
+
+def load_cached_analysis(video_info, ttl_days=None, use_transcripts=False):
+    """讀取單支影片的分析快取；不存在、過期或檔案損毀時回傳 None。ttl_days 為 0/None 代表永不過期。
+    use_transcripts=True 時不沿用依網址分析的結果（當時沒抓字幕或字幕抓取失敗），讓這支影片重新用字幕分析"""
+    try:
+        with open(_analysis_cache_path(video_info['id']), encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if ttl_days and time.time() - entry.get('cached_at', 0) > ttl_days * 86400:
+        return None
+    analysis = entry.get('analysis')
+    if not isinstance(analysis, dict):
+        return None
+    if use_transcripts and analysis.get('content_source', 'url') != 'transcript':
+        return None
+    # 觀看數、來源關鍵字等會隨本次搜尋變動，以本次的影片資料為準
+    analysis.update({
+        'title': video_info['title'],
+        'url': video_info['url'],
+        'view_count': video_info['view_count'],
+        'source_keyword': video_info.get('source_keyword', ''),
+        'market': video_info.get('market', 'zh'),
+        'cached': True,
+    })
+    return analysis
+
+def save_cached_analysis(analysis, use_transcripts=False):
+    """寫入分析快取（只存成功的結果，失敗的下次重爬）。
+    use_transcripts=True 時依網址分析的結果（沒拿到字幕）不存，下次再試字幕"""
+    if not analysis.get('success'):
+        return
+    if use_transcripts and analysis.get('content_source') != 'transcript':
+        return
+    entry = {
+        'video_id': analysis['video_id'],
+        'model': TRANSCRIPT_MODEL,
+        'prompt_version': EXTRACT_PROMPT_VERSION,
+        'cached_at': time.time(),
+        'analysis': {k: v for k, v in analysis.items() if k != 'cached'},
+    }
+    path = _analysis_cache_path(analysis['video_id'])
+    try:
+        os.makedirs(ANALYSIS_CACHE_DIR, exist_ok=True)
+        # 先寫暫存檔再 rename，避免並行寫入時讀到半個檔案
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+def batch_extract_videos(api_key, videos_list, max_workers=3, use_cache=True, cache_ttl_days=None,
+                         use_transcripts=True, transcript_source=None, on_progress=None, cancel_event=None):
+    """批次爬取多支影片；已有快取的影片直接載入，未快取的先並行抓字幕，再送進 worker pool 分析。
+    on_progress(done, total) 回報進度；cancel_event 被設定時取消尚未開始的影片並丟出 PipelineCancelled。
+    回傳順序與 videos_list 相同（不受完成先後影響，後面的 prompt 才會每次一致）"""
+    results = [None] * len(videos_list)
+    pending = []
+    for index, video in enumerate(videos_list):
+        cached = load_cached_analysis(video, cache_ttl_days, use_transcripts=use_transcripts) if use_cache else None
+        if cached:
+            results[index] = cached
+        else:
+            pending.append(index)
+
+    if not pending:
+        return results
+
+    done = len(videos_list) - len(pending)
+    if on_progress:
+        on_progress(done, len(videos_list))
+    pending_videos = [videos_list[index] for index in pending]
+    transcripts = batch_fetch_transcripts(pending_videos, source=transcript_source) if use_transcripts else {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_index = {
+            executor.submit(tracing.bind(extract_video_content_via_ai), api_key, videos_list[index],
+                            transcripts.get(videos_list[index]['id'])): index
+            for index in pending
+        }
+        
+        for future in concurrent.futures.as_completed(future_to_index):
+            if cancel_event is not None and cancel_event.is_set():
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise PipelineCancelled("影片分析已取消")
+            index = future_to_index[future]
+            video = videos_list[index]
+            done += 1
+            if on_progress:
+                on_progress(done, len(videos_list))
+            try:
+                result = future.result()
+                results[index] = result
+                save_cached_analysis(result, use_transcripts=use_transcripts)
+            except Exception as e:
+                results[index] = {
+                    'video_id': video['id'],
+                    'title': video['title'],
+                    'url': video['url'],
+                    'view_count': video['view_count'],
+                    'source_keyword': video.get('source_keyword', ''),
+                    'market': video.get('market', 'zh'),
+                    'structured': None,
+                    'ai_analysis': f"執行錯誤: {str(e)}",
+                    'success': False
+                }
+    
+    return results
+
+def analyze_search_intent_bilingual(api_key, zh_keywords, en_keywords, zh_videos, en_videos, model_version):
+    """雙語市場意圖分析"""
+    model = gemini_model(api_key, model_version)
+    
+    # 各市場依關鍵字取排名前 3 的影片（索引查詢，不逐關鍵字重掃）
+    zh_store, en_store = VideoStore(zh_videos), VideoStore(en_videos)
+
+    # 整理中文市場數據
+    zh_summary = ""
+    if zh_videos:
+        zh_summary = "\n### 🇹🇼 繁體中文市場\n"
+        for keyword in zh_keywords:
+            keyword_videos = zh_store.by_keyword(keyword, top_n=3)
+            if keyword_videos:
+                zh_summary += f"\n**關鍵字：「{keyword}」**\n"
+                for v in keyword_videos:
+                    zh_summary += f"- {v['title']} (觀看數: {v['view_count']:,})\n"
+    
+    # 整理英文市場數據
+    en_summary = ""
+    if en_videos:
+        en_summary = "\n### 🇺🇸 英文市場\n"
+        for keyword in en_keywords:
+            keyword_videos = en_store.by_keyword(keyword, top_n=3)
+            if keyword_videos:
+                en_summary += f"\n**關鍵字：「{keyword}」**\n"
+                for v in keyword_videos:
+                    en_summary += f"- {v['title']} (觀看數: {v['view_count']:,})\n"
+
+    prompt = f"""
+    你是一個跨語言搜尋意圖分析專家。
+    
+    使用者研究的中文關鍵字：{', '.join(zh_keywords)}
+    {'對應的英文關鍵字：' + ', '.join(en_keywords) if en_keywords else ''}
+    
+    以下是搜尋結果：
+    {zh_summary}
+    {en_summary}
+    
+    請分析：
+    
+    ## 1. 【搜尋意圖分析】
+    - 這些關鍵字背後的使用者需求是什麼？
+    - 使用者最想解決什麼問題？
+    
+    ## 2. 【市場現況】
+    - 中文市場目前的內容主要集中在哪些角度？
+    {'- 英文市場的內容主要集中在哪些角度？' if en_videos else ''}
+    
+    ## 3. 【中英差距分析】{'（重點！）' if en_videos else '（未啟用英文搜尋）'}
+    {'- 英文市場有但中文市場缺乏的內容主題' if en_videos else '- 建議啟用英文市場搜尋以獲得更完整分析'}
+    {'- 英文市場的內容深度/專業度差異' if en_videos else ''}
+    {'- 最值得「搬運」到中文市場的內容方向' if en_videos else ''}
+    
+    ## 4. 【內容機會總結】
+    - 綜合以上分析，最有潛力的內容方向是？
+    
+    請用繁體中文回答，格式清晰。
+    """
+    
+    response = model.generate_content(prompt)
+    return response.text
+
+def video_frame(videos):
+    """把影片（list 或 VideoStore）轉成 DataFrame，一次算好上架天數、日均觀看、互動率，以及同關鍵字內的 z 分數"""
+    pd = lazy_import("pandas")
+    np = lazy_import("numpy")
+    store = videos if isinstance(videos, VideoStore) else VideoStore(videos or [])
+    # 整數欄位直接取 VideoStore 的 array 欄位，其餘逐欄取值（不為每支影片建中間 dict）
+    data = {c: np.frombuffer(store.column(c), dtype=np.int64) if len(store) else np.zeros(0, dtype=np.int64)
+            for c in ('rank', 'view_count', 'like_count', 'comment_count', 'subscriber_count')}
+    for c, default in (('id', ''), ('title', ''), ('channel', ''), ('channel_id', ''), ('source_keyword', ''),
+                       ('market', 'zh'), ('publish_time', '')):
+        data[c] = [v.get(c) or default for v in store]
+    data['duration_min'] = pd.to_numeric(pd.Series([v.get('duration_min') for v in store], dtype=object), errors='coerce').fillna(0)
+    df = pd.DataFrame(data)
+
+    # 與 video_age_days 相同：日期解析失敗時為 0，否則最小 1
+    published = pd.to_datetime(df['publish_time'].astype(str).str[:10], format='%Y-%m-%d', errors='coerce')
+    age = (pd.Timestamp(replay.now().date()) - published).dt.days
+    df['age_days'] = age.clip(lower=1).fillna(0).astype(int)
+
+    views = df['view_count'].to_numpy(dtype=float)
+    age_days = df['age_days'].to_numpy(dtype=float)
+    interactions = (df['like_count'] + df['comment_count']).to_numpy(dtype=float)
+    df['views_per_day'] = np.divide(views, age_days, out=np.zeros(len(df)), where=age_days > 0)
+    df['engagement'] = np.divide(interactions, views, out=np.zeros(len(df)), where=views > 0)
+
+    groups = df['source_keyword']
+    for col, values in (('views_z', np.log1p(df['views_per_day'])), ('engagement_z', df['engagement']), ('age_z', df['age_days'])):
+        values = values.astype(float)
+        mean = values.groupby(groups).transform('mean')
+        std = values.groupby(groups).transform('std', ddof=0)
+        df[col] = ((values - mean) / std.replace(0, np.nan)).fillna(0.0)
+    return df
+
+def _title_similarity(titles, keyword):
+    """標題兩兩 Jaccard 相似度平均，與出現在過半標題的共同字詞（不含關鍵字本身的字詞）"""
+    np = lazy_import("numpy")
+    own = set(_text_tokens(keyword))
+    token_sets = [set(_text_tokens(t)) - own for t in titles]
+    vocab = sorted(set().union(*token_sets))
+    if len(titles) < 2 or not vocab:
+        return 0.0, []
+    index = {tok: i for i, tok in enumerate(vocab)}
+    matrix = np.zeros((len(titles), len(vocab)), dtype=np.int32)
+    for row, tokens in enumerate(token_sets):
+        matrix[row, [index[t] for t in tokens]] = 1
+    inter = matrix @ matrix.T
+    sizes = matrix.sum(axis=1)
+    union = sizes[:, None] + sizes[None, :] - inter
+    jaccard = np.divide(inter, union, out=np.zeros(inter.shape), where=union > 0)
+    upper = np.triu_indices(len(titles), k=1)
+    doc_freq = matrix.sum(axis=0)
+    shared = [vocab[i] for i in np.argsort(-doc_freq, kind='stable') if doc_freq[i] * 2 > len(titles)]
+    return float(jaccard[upper].mean()), shared[:8]
+
+def detect_supply_anomalies(videos):
+    """第二層供需錯位的本地偵測（一次向量化計算所有影片），只回傳被標記的異常：
+    underdogs（小蝦米打大鯨魚）、stale_front_rows（過時的前排）、low_engagement（高觀看低互動）、homogeneous_titles（同質化前排）"""
+    anomalies = {
+        'underdogs': [], 'stale_front_rows': [], 'low_engagement': [], 'homogeneous_titles': [],
+        'videos_scanned': len(videos or ()), 'keywords_scanned': 0, 'videos_with_velocity': 0,
+    }
+    df = video_frame(videos)
+    if df.empty:
+        return anomalies
+    anomalies['keywords_scanned'] = int(df['source_keyword'].nunique())
+    df = df.reset_index(drop=True).rename_axis('row').reset_index()
+    # 有兩筆以上統計快照的影片，改用快照差值算出的近期日均觀看與加速度（上架以來的平均看不出是在成長還是衰退）
+    view = _snapshot_view()
+    velocity = snapshots.video_velocity(df['id'].tolist(), **view) if view is not None else {}
+    df['recent_views_per_day'] = df['id'].map(lambda vid: velocity.get(vid, {}).get('views_per_day')).astype(float)
+    df['acceleration'] = df['id'].map(lambda vid: velocity.get(vid, {}).get('acceleration')).astype(float)
+    anomalies['videos_with_velocity'] = len(velocity)
+
+    # 1. 排名與訂閱數倒掛：同關鍵字內兩兩配對，排名較前但訂閱數不到對方 1/N（訂閱數 0 視為未知，不比較）
+    known = df[df['subscriber_count'] > 0][['row', 'source_keyword', 'rank', 'subscriber_count']]
+    pairs = known.merge(known, on='source_keyword', suffixes=('', '_other'))
+    pairs = pairs[
+        (pairs['rank'] < pairs['rank_other'])
+        & (pairs['subscriber_count'] * UNDERDOG_SUBSCRIBER_RATIO <= pairs['subscriber_count_other'])
+    ]
+    if not pairs.empty:
+        inversions = pairs.groupby('row').agg(
+            outranked=('rank_other', 'size'),
+            outranked_subscribers=('subscriber_count_other', 'max'),
+        )
+        underdogs = df.join(inversions, on='row', how='inner')
+        underdogs['ratio'] = underdogs['outranked_subscribers'] / underdogs['subscriber_count']
+        for r in underdogs.sort_values(['ratio', 'rank'], ascending=[False, True]).itertuples():
+            anomalies['underdogs'].append({
+                'keyword': r.source_keyword, 'market': r.market, 'rank': int(r.rank), 'title': r.title,
+                'channel': r.channel, 'subscribers': int(r.subscriber_count),
+                'outranked': int(r.outranked), 'outranked_subscribers': int(r.outranked_subscribers),
+                'ratio': round(float(r.ratio), 1),
+            })
+
+    # 2. 過時的前排：前排過半影片上架超過 STALE_FRONT_ROW_DAYS 天
+    front = df[df['rank'] <= FRONT_ROW_SIZE].assign(stale=lambda x: x['age_days'] >= STALE_FRONT_ROW_DAYS)
+    front_stats = front.groupby('source_keyword').agg(
+        stale=('stale', 'sum'), size=('stale', 'size'), median_age=('age_days', 'median'),
+    )
+    stale_keywords = front_stats[(front_stats['stale'] > 0) & (front_stats['stale'] * 2 > front_stats['size'])]
+    keyword_vpd = df.groupby('source_keyword')['views_per_day'].median()
+    # 前排影片一次走訪、依關鍵字分桶（逐關鍵字切 DataFrame 在關鍵字多時很慢）
+    front_rows = {}
+    front_columns = ['source_keyword', 'market', 'rank', 'title', 'age_days', 'views_per_day', 'recent_views_per_day', 'acceleration']
+    for r in front.sort_values('rank')[front_columns].itertuples(index=False):
+        front_rows.setdefault(r.source_keyword, []).append(r)
+
+    def measured(value, digits=1):
+        return None if value != value else round(float(value), digits)  # NaN＝沒有足夠的快照
+
+    for keyword, stats in stale_keywords.sort_values('median_age', ascending=False).iterrows():
+        rows = front_rows[keyword]
+        front_row = [
+            {'rank': int(r.rank), 'title': r.title, 'age_days': int(r.age_days), 'views_per_day': round(float(r.views_per_day), 1),
+             'recent_views_per_day': measured(r.recent_views_per_day), 'acceleration': measured(r.acceleration, 2)}
+            for r in rows
+        ]
+        anomalies['stale_front_rows'].append({
+            'keyword': keyword, 'market': rows[0].market,
+            'median_age_days': int(stats['median_age']),
+            'keyword_median_views_per_day': round(float(keyword_vpd[keyword]), 1),
+            # 近期速度低於上架以來平均、或加速度為負＝實測正在衰退的前排影片數
+            'decaying': sum(
+                1 for f in front_row
+                if f['recent_views_per_day'] is not None
+                and (f['recent_views_per_day'] < f['views_per_day'] or (f['acceleration'] or 0) < 0)
+            ),
+            'front_row': front_row,
+        })
+    # 實測衰退的前排排在最前面（「等人做新版」的訊號最強）
+    anomalies['stale_front_rows'].sort(key=lambda a: (-a['decaying'], -a['median_age_days']))
+
+    # 3. 高觀看低互動：同關鍵字內日均觀看偏高、互動率偏低
+    median_engagement = df.groupby('source_keyword')['engagement'].transform('median')
+    low = df.assign(keyword_median_engagement=median_engagement)[
+        (df['views_z'] >= HIGH_VIEWS_Z) & (df['engagement_z'] <= LOW_ENGAGEMENT_Z) & (df['view_count'] > 0)
+    ]
+    for r in low.sort_values('engagement_z').itertuples():
+        anomalies['low_engagement'].append({
+            'keyword': r.source_keyword, 'market': r.market, 'rank': int(r.rank), 'title': r.title,
+            'views': int(r.view_count), 'views_per_day': round(float(r.views_per_day), 1),
+            'engagement': round(float(r.engagement), 4),
+            'keyword_median_engagement': round(float(r.keyword_median_engagement), 4),
+            'views_z': round(float(r.views_z), 2), 'engagement_z': round(float(r.engagement_z), 2),
+        })
+
+    # 4. 同質化前排：前 N 名標題字詞高度重疊
+    top = df[df['rank'] <= HOMOGENEOUS_TITLE_TOP_N].sort_values(['source_keyword', 'rank'])
+    for keyword, rows in top.groupby('source_keyword', sort=False):
+        titles = rows['title'].tolist()
+        similarity, shared = _title_similarity(titles, keyword)
+        if similarity >= HOMOGENEOUS_TITLE_SIMILARITY:
+            anomalies['homogeneous_titles'].append({
+                'keyword': keyword, 'market': rows['market'].iloc[0],
+                'similarity': round(similarity, 2), 'shared_terms': shared, 'titles': titles,
+            })
+    anomalies['homogeneous_titles'].sort(key=lambda a: -a['similarity'])
+    return anomalies
+
+def anomalies_md(anomalies):
+    """把 detect_supply_anomalies 的結果轉成條列（給第二層 prompt 與介面顯示）"""
+    def tag(a):
+        return f"{'🇺🇸' if a.get('market') == 'en' else '🇹🇼'} {a['keyword']}"
+
+    measured = f"，其中 {anomalies['videos_with_velocity']} 支有統計快照可算近期速度" if anomalies.get('videos_with_velocity') else ""
+    lines = [f"（掃描 {anomalies['keywords_scanned']} 個關鍵字、{anomalies['videos_scanned']} 支影片{measured}）", ""]
+    lines.append(f"### 1. 小蝦米打大鯨魚（排名較前、訂閱數不到被壓過頻道的 1/{UNDERDOG_SUBSCRIBER_RATIO}）")
+    for a in anomalies['underdogs']:
+        lines.append(
+            f"- 【{tag(a)}】#{a['rank']} {a['title']}｜{a['channel']}（訂閱 {a['subscribers']:,}）"
+            f"壓過 {a['outranked']} 支影片，最大的對手訂閱 {a['outranked_subscribers']:,}（{a['ratio']:,.0f} 倍）"
+        )
+    if not anomalies['underdogs']:
+        lines.append("- 未偵測到")
+
+    lines += ["", f"### 2. 過時的前排（前 {FRONT_ROW_SIZE} 名過半上架超過 {STALE_FRONT_ROW_DAYS} 天）"]
+    def velocity(f):
+        if f.get('recent_views_per_day') is None:
+            return ""
+        trend = "" if f.get('acceleration') is None else f"，加速度 {f['acceleration']:+,.1f}/天²"
+        return f"，近期實測日均 {f['recent_views_per_day']:,.0f}{trend}"
+
+    for a in anomalies['stale_front_rows']:
+        front = "；".join(
+            f"#{f['rank']} {f['title']}（{f['age_days']} 天，上架以來日均 {f['views_per_day']:,.0f}{velocity(f)}）" for f in a['front_row']
+        )
+        decaying = f"，{a['decaying']} 支實測正在衰退" if a.get('decaying') else ""
+        lines.append(f"- 【{tag(a)}】前排中位數 {a['median_age_days']} 天{decaying}，同詞日均觀看中位數 {a['keyword_median_views_per_day']:,.0f}：{front}")
+    if not anomalies['stale_front_rows']:
+        lines.append("- 未偵測到")
+
+    lines += ["", "### 3. 高觀看低互動（同關鍵字內日均觀看偏高、互動率明顯偏低）"]
+    for a in anomalies['low_engagement']:
+        lines.append(
+            f"- 【{tag(a)}】#{a['rank']} {a['title']}｜觀看 {a['views']:,}（日均 {a['views_per_day']:,.0f}，z={a['views_z']:+.1f}）"
+            f"｜互動率 {a['engagement']:.2%}（同詞中位數 {a['keyword_median_engagement']:.2%}，z={a['engagement_z']:+.1f}）"
+        )
+    if not anomalies['low_engagement']:
+        lines.append("- 未偵測到")
+
+    lines += ["", f"### 4. 同質化前排（前 {HOMOGENEOUS_TITLE_TOP_N} 名標題相似度 ≥ {HOMOGENEOUS_TITLE_SIMILARITY}）"]
+    for a in anomalies['homogeneous_titles']:
+        shared = "、".join(a['shared_terms']) or "（無單一共同字詞）"
+        lines.append(f"- 【{tag(a)}】相似度 {a['similarity']:.2f}，共同字詞：{shared}")
+        lines += [f"  - {t}" for t in a['titles']]
+    if not anomalies['homogeneous_titles']:
+        lines.append("- 未偵測到")
+    return "\n".join(lines)
+
+def tag_cooccurrence(videos):
+    """影片 × tag 稀疏矩陣上的共現分析，回傳：
+    pairs（PMI 最高的 tag 組合）、coverage（各關鍵字最常用的 tag 與覆蓋率）、
+    gaps（同關鍵字內日均觀看偏高的影片常用、但前排影片都沒用的 tag）"""
+    np = lazy_import("numpy")
+    sparse = lazy_import("scipy.sparse")
+    store = videos if isinstance(videos, VideoStore) else VideoStore(videos or [])
+    summary = {'videos': len(store), 'tags': 0, 'pairs': [], 'coverage': {}, 'gaps': []}
+
+    vocab, rows, cols = {}, [], []
+    for row, v in enumerate(store):
+        # 與 collect_video_tags 相同的正規化；同一支影片重複的 tag 只算一次
+        for tag in {t.strip().lower() for t in v.get('tags') or []} - {""}:
+            rows.append(row)
+            cols.append(vocab.setdefault(tag, len(vocab)))
+    summary['tags'] = len(vocab)
+    if not vocab:
+        return summary
+    tags = np.array(list(vocab), dtype=object)
+    n_videos = len(store)
+    X = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(n_videos, len(vocab)))
+    doc_freq = np.asarray(X.sum(axis=0)).ravel()
+
+    # 1. PMI：只算出現在 TAG_MIN_VIDEOS 支以上影片的 tag，共現矩陣取上三角
+    kept = np.flatnonzero(doc_freq >= TAG_MIN_VIDEOS)
+    if len(kept) > 1:
+        co = sparse.triu(X[:, kept].T @ X[:, kept], k=1).tocoo()
+        mask = co.data >= TAG_PAIR_MIN_COUNT
+        a, b, count = kept[co.row[mask]], kept[co.col[mask]], co.data[mask]
+        pmi = np.log(count * n_videos / (doc_freq[a] * doc_freq[b]))
+        # 依 共現次數 × PMI 排序：只共現兩次的冷門 tag PMI 很高但多半是巧合，乘上次數後常見的固定搭配才會排前面
+        order = np.argsort(-(count * pmi), kind='stable')[:TAG_PAIRS_TOP_N]
+        summary['pairs'] = [
+            {'a': tags[a[i]], 'b': tags[b[i]], 'count': int(count[i]), 'pmi': round(float(pmi[i]), 2)}
+            for i in order if pmi[i] > 0
+        ]
+
+    # 2. 關鍵字 × tag：用 0/1 指示矩陣乘上影片 × tag 矩陣，一次得到每個關鍵字各 tag 的影片數
+    keyword_keys = list(store.keywords())
+    keyword_index = {kw: i for i, kw in enumerate(keyword_keys)}
+    keyword_of_row = np.array([keyword_index[v.get('source_keyword', '')] for v in store])
+    K = sparse.csr_matrix(
+        (np.ones(n_videos, dtype=np.float32), (keyword_of_row, np.arange(n_videos))),
+        shape=(len(keyword_keys), n_videos),
+    )
+    per_keyword = (K @ X).tocsr()
+    keyword_sizes = np.bincount(keyword_of_row, minlength=len(keyword_keys))
+    tagged = np.bincount(keyword_of_row, weights=(np.diff(X.indptr) > 0), minlength=len(keyword_keys))
+    for i, kw in enumerate(keyword_keys):
+        counts = per_keyword.getrow(i)
+        top = counts.indices[np.argsort(-counts.data, kind='stable')[:TAG_COVERAGE_TOP_N]]
+        summary['coverage'][kw] = {
+            'videos': int(keyword_sizes[i]),
+            'tagged': int(tagged[i]),
+            'distinct_tags': int(counts.nnz),
+            'top': [(tags[t], round(float(per_keyword[i, t] / keyword_sizes[i]), 2)) for t in top],
+        }
+
+    # 3. 前排缺口：同關鍵字的高日均觀看影片（views_z ≥ HIGH_VIEWS_Z）有用、前排影片都沒用的 tag
+    frame = video_frame(store)
+    high = (frame['views_z'] >= HIGH_VIEWS_Z).to_numpy() & (frame['rank'] > FRONT_ROW_SIZE).to_numpy()
+    front = (frame['rank'] <= FRONT_ROW_SIZE).to_numpy()
+    if high.any():
+        high_counts = (K @ sparse.diags(high.astype(np.float32)) @ X).toarray()
+        front_counts = (K @ sparse.diags(front.astype(np.float32)) @ X).toarray()
+        gap = np.where((front_counts == 0) & (doc_freq >= TAG_MIN_VIDEOS), high_counts, 0)
+        totals = gap.sum(axis=0)
+        for t in np.argsort(-totals, kind='stable')[:TAG_GAPS_TOP_N]:
+            if totals[t] <= 0:
+                break
+            summary['gaps'].append({
+                'tag': tags[t],
+                'high_videos': int(totals[t]),
+                'keywords': [keyword_keys[k] for k in np.flatnonzero(gap[:, t])],
+            })
+    return summary
+
+def tag_cooccurrence_md(summary):
+    """把 tag_cooccurrence 的結果轉成精簡條列（給第一層 prompt 與介面顯示）"""
+    lines = [f"（{summary['videos']} 支影片、{summary['tags']} 個不重複 tag）", "", "### 常一起出現的 tag 組合（PMI 越高＝越是固定搭配）"]
+    lines += [f"- {p['a']} + {p['b']}（共現 {p['count']} 次，PMI {p['pmi']}）" for p in summary['pairs']] or ["- 未觀察到"]
+    lines += ["", "### 各關鍵字的 tag 覆蓋（括號內為使用該 tag 的影片比例）"]
+    for kw, c in summary['coverage'].items():
+        top = "、".join(f"{t}({share:.0%})" for t, share in c['top']) or "（無 tag）"
+        lines.append(f"- 【{kw}】{c['tagged']}/{c['videos']} 支有 tag，共 {c['distinct_tags']} 個：{top}")
+    lines += ["", f"### 前排缺口（同詞日均觀看偏高的影片常用、但前 {FRONT_ROW_SIZE} 名都沒用）"]
+    for g in summary['gaps']:
+        keywords = "、".join(g['keywords'][:5]) + (f" 等 {len(g['keywords'])} 個關鍵字" if len(g['keywords']) > 5 else "")
+        lines.append(f"- {g['tag']}（{g['high_videos']} 支高日均影片；{keywords}）")
+    if not summary['gaps']:
+        lines.append("- 未觀察到")
+    return "\n".join(lines)
+
+def trending_terms_md(trends, limit=15):
+    """把 snapshots.trending 的結果轉成條列（給第一層 prompt 與介面顯示）"""
+    def score(value):
+        return "—" if value is None else str(value)
+
+    lines = [f"（比較 {trends['queries_compared']} 個查詢；基準快照至少 {trends['baseline_age_days']} 天前）"]
+    lines.append("### 新出現的詞")
+    lines += [f"- {r['term']}（查詢「{r['query']}」第 {r['position']} 名，分數 {score(r['score'])}）"
+              for r in trends['new'][:limit]] or ["- 未觀察到"]
+    lines.append("### 分數上升")
+    lines += [f"- {r['term']}（{score(r['previous_score'])} → {score(r['score'])}，第 {r['previous_position']} → {r['position']} 名）"
+              for r in trends['rising'][:limit]] or ["- 未觀察到"]
+    if trends['falling']:
+        lines.append("### 分數下降")
+        lines += [f"- {r['term']}（{score(r['previous_score'])} → {score(r['score'])}）" for r in trends['falling'][:limit // 3 or 1]]
+    return "\n".join(lines)
+
+@tracing.traced("intent")
+def analyze_intent_three_layers(api_key, zh_keywords, en_keywords, zh_videos, en_videos,
+                                 deep_suggestions_zh, deep_suggestions_en,
+                                 video_comments, model_version,
+                                 probe_suggestions_zh=None, probe_suggestions_en=None):
+    """三層意圖分析：長尾詞分群 → 排名語意 → 留言需求"""
+    model = gemini_model(api_key, model_version)
+    results = {}
+    store = VideoStore(zh_videos + en_videos)
+
+    # ── 第一層：長尾詞意圖分群 ──
+    # 長尾展開與探針的詞先在本地合併近似變體（空白、簡繁、詞序），每群只送代表詞
+    suggestions_text = ""
+    for deep, probes, market, label in (
+        (deep_suggestions_zh, probe_suggestions_zh, "zh", ""),
+        (deep_suggestions_en, probe_suggestions_en, "en", "(英文)"),
+    ):
+        clusters = cluster_terms(suggestion_entries(deep, probes, market))
+        by_seed = {}
+        for c in clusters:
+            by_seed.setdefault(c['seeds'][0] if c['seeds'] else "", []).append(c)
+        for kw, seed_clusters in by_seed.items():
+            suggestions_text += f"\n【{kw}】{label}\n"
+            autocomplete = [c for c in seed_clusters if 'probe' not in c['sources']]
+            probed = [c for c in seed_clusters if 'probe' in c['sources']]
+            if autocomplete:
+                suggestions_text += f"  自動完成：{', '.join(format_term_cluster(c) for c in autocomplete[:30])}\n"
+            if probed:
+                suggestions_text += f"  探針逼出（括號內為 Google 相關性分數）：{', '.join(format_term_cluster(c) for c in probed[:30])}\n"
+
+    # 競品影片 tags（創作者自填關鍵字）
+    tag_counter = collect_video_tags(store)
+    tags_text = ", ".join(f"{t}(×{c})" for t, c in tag_counter.most_common(40))
+    try:
+        tag_graph = tag_cooccurrence(store)
+        results['tag_graph'] = tag_graph
+        if tag_graph['tags']:
+            tags_text += "\n\n" + tag_cooccurrence_md(tag_graph)
+    except Exception as e:
+        # 共現分析只是補充材料，失敗時第一層照跑（只送 tags 頻率），但要留下原因給介面顯示
+        results['tag_graph_error'] = f"❌ 標籤共現分析失敗: {str(e)}"
+
+    # 自動完成快照歷史（本機 SQLite，不連網）：與至少一天前的快照相比，新冒出來與分數上升的詞
+    view = _snapshot_view()
+    trends = snapshots.trending(list(zh_keywords) + list(en_keywords), **view) if view is not None else snapshots.empty_trends()
+    results['trends'] = trends
+    trends_text = trending_terms_md(trends) if trends['rising'] or trends['new'] else ""
+
+    layer1_prompt = f"""
+    你是搜尋需求分析專家。你的任務不是分類整理資料，而是從資料中找出「反差與異常」。
+
+    以下是使用者輸入的關鍵字，以及從 YouTube 自動完成功能遞迴展開、用修飾詞探針（教學/推薦/比較/缺點…）逼出的長尾搜尋詞。
+    近似變體（空白、簡繁、詞序不同）已合併成一個代表詞：括號內數字是 Google 相關性分數（越高需求越強）、×N 是在各來源出現的次數、+N變體 是被合併的寫法數：
+
+    {suggestions_text}
+
+    {'以下是搜尋結果中競品影片創作者自填的 Tags（出現次數越多代表整個賽道越依賴這個詞），以及程式算好的 tag 共現、覆蓋與前排缺口：' if tags_text else ''}
+    {tags_text}
+
+    {'以下是與過去快照比較的自動完成變化（同一個查詢在不同時間點取回的建議詞）：' if trends_text else ''}
+    {trends_text}
+
+    只回答以下問題，每一條結論都必須引用具體的搜尋詞：
+
+    1. 【矛盾訊號】哪些相關性分數高的搜尋詞，彼此的需求方向互相矛盾或照理不該同時出現？這暗示什麼還沒被理解的需求？
+    2. 【卡點詞】哪些詞暗示使用者卡在某個具體步驟、或遇到某個具體問題？（卡點是最強的內容鉤子）
+    3. 【無主流講法的需求】探針逼出的詞裡，哪些方向的搜尋需求明顯存在（分數高），但還沒形成主流頭部詞、競品 Tags 也沒在用？
+    4. 【意料之外】哪些詞是「不看資料想不到有人會這樣搜」的？它暗示什麼被忽略的族群、情境或動機？
+    {'5. 【上升中的詞】新冒出來或分數上升的詞代表什麼正在形成的需求？哪些值得搶在變成頭部詞之前先做？' if trends_text else ''}
+
+    禁止：意圖分類表、資料的描述性總結、不看資料也寫得出來的結論。找不到某類異常就直說「未觀察到」，不要硬湊。
+
+    請用繁體中文回答。
+    """
+
+    try:
+        with tracing.span("intent.layer1"):
+            resp1 = model.generate_content(layer1_prompt)
+        results['layer1'] = resp1.text
+    except Exception as e:
+        results['layer1'] = f"❌ 第一層分析失敗: {str(e)}"
+
+    # ── 第二層：供需錯位偵測 ──
+    try:
+        anomalies = detect_supply_anomalies(store)
+        results['anomalies'] = anomalies
+
+        layer2_prompt = f"""
+        你是 YouTube 供需錯位分析專家。以下是程式從各關鍵字的搜尋結果（按演算法排名，#1 = YouTube 認為最符合搜尋意圖）中，
+        依訂閱數、上架天數、日均觀看、互動率、標題字詞計算出的「異常」。數字已經算好、可直接引用；沒列出的影片都沒有異常。
+
+        {anomalies_md(anomalies)}
+
+        請逐類解讀這些異常（某一類「未偵測到」就直說，不要硬湊）：
+
+        1. 【小蝦米打大鯨魚】→ 代表這個詞的需求真實存在、演算法在主動找答案，新頻道可切入。排出這些關鍵字的切入優先順序。
+        2. 【過時的前排】→ 「等人做新版」的機會。有近期實測速度的，衰退中（近期日均低於上架以來平均、加速度為負）的舊前排最該被取代。這些舊影片在新版本中該更新什麼？
+        3. 【高觀看低互動】→ 觀眾點進去了但不滿足，標題的承諾沒有兌現。從標題推測它承諾了什麼、可能沒兌現什麼。
+        4. 【同質化前排】→ 說出雷同的角度具體是什麼，以及旁邊空著的差異化角度是什麼。
+
+        最後回答：綜合以上異常，哪 1-2 個關鍵字是「供需錯位最嚴重」＝最值得優先做的？理由是什麼？
+
+        禁止：逐一描述影片內容、複述資料、給「做出差異化」這類不看資料也寫得出來的建議。
+
+        請用繁體中文回答。
+        """
+
+        with tracing.span("intent.layer2"):
+            resp2 = model.generate_content(layer2_prompt)
+        results['layer2'] = resp2.text
+    except Exception as e:
+        results['layer2'] = f"❌ 第二層分析失敗: {str(e)}"
+
+    # ── 第三層：承諾與兌現的落差 ──
+    # 留言先在本地去垃圾、去重，再依讚數加權抽樣到 token 預算內，不再固定取每支影片前 30 則
+    sampled, comment_stats = sample_comments(video_comments)
+    results['comment_stats'] = comment_stats
+    comments_text = ""
+    for vid, data in sampled.items():
+        comments_text += f"\n【{data['keyword']}】影片標題（＝對觀眾的承諾）：{data['title']}\n"
+        for c in data['comments']:
+            prefix = "    ↳ " if c['is_reply'] else "  - "
+            likes_tag = f" (👍{c['likes']})" if c['likes'] > 0 else ""
+            dupes_tag = f" (另有 {c['dupes']} 則相同留言)" if c['dupes'] else ""
+            comments_text += f"{prefix}{c['text']}{likes_tag}{dupes_tag}\n"
+
+    if comments_text:
+        layer3_prompt = f"""
+        你是觀眾落差分析專家。以下是各影片的「標題（＝影片對觀眾的承諾）」與其熱門留言（＝觀眾實際的反應；讚數＝認同這則留言的人數；「↳」開頭是回覆，回覆串代表觀眾之間的對話與爭論）：
+
+        {comments_text}
+
+        只回答以下問題，每一條結論都必須引用留言原文（可節錄）：
+
+        1. 【承諾 vs 兌現】哪些影片的留言顯示觀眾沒有得到標題承諾的東西？具體落差是什麼？
+        2. 【集體性未滿足需求】被大量點讚的抱怨、追問、許願是什麼？（這是全部資料中最接近「現成影片題材」的訊號）列出並附上讚數。
+        3. 【爭論點】回覆串裡觀眾意見分歧的地方在哪？各方立場是什麼？（分歧＝高互動潛力的切入角度）
+        4. 【觀眾的語言 vs 創作者的語言】觀眾描述問題時的用詞，和影片標題的用詞有什麼落差？觀眾的講法才是未來的搜尋詞，把它們列出來。
+        5. 【意料之外的使用情境】留言中透露的、創作者顯然沒設想到的使用場景或族群是什麼？
+
+        禁止：情緒比例統計、「觀眾希望更深入」這類籠統結論、沒有留言原文支撐的判斷。找不到就直說「未觀察到」。
+
+        請用繁體中文回答。
+        """
+
+        try:
+            with tracing.span("intent.layer3"):
+                resp3 = model.generate_content(layer3_prompt)
+            results['layer3'] = resp3.text
+        except Exception as e:
+            results['layer3'] = f"❌ 第三層分析失敗: {str(e)}"
+    else:
+        results['layer3'] = "⚠️ 未抓取到留言資料，無法進行第三層分析。可能原因：影片關閉留言功能，或 API 配額不足。"
+
+    # ── 第四步：洞察引擎（三層對撞）──
+    synthesis_prompt = f"""
+    你是內容策略洞察總監。以下是針對同一批關鍵字的三份分析——需求端（搜尋詞異常）、供給端（排名供需錯位）、反應端（觀眾落差）：
+
+    【需求端分析】
+    {results.get('layer1', '（無）')}
+
+    【供給端分析】
+    {results.get('layer2', '（無）')}
+
+    【反應端分析】
+    {results.get('layer3', '（無）')}
+
+    把三份分析互相對撞，輸出 5-7 條洞察。每條格式固定：
+
+    ### 💡 洞察 N：（一句話，說出一個非顯而易見的判斷）
+    - **來自哪個反差**：哪兩個（或以上）資料源的訊號相減得出這個判斷
+    - **行動意義**：具體做什麼題目、用什麼關鍵字、切什麼角度
+
+    收錄門檻：這條判斷必須是「不對撞資料就想不到」的。三個資料源都指向同一方向的機會，排在最前面。
+
+    禁止：把單一層的結論換句話說、常識性建議（如「做出差異化」「提供價值」「了解你的觀眾」）。寧可只輸出 3 條真洞察，也不要湊滿 7 條。
+
+    請用繁體中文回答。
+    """
+
+    try:
+        with tracing.span("intent.synthesis"):
+            resp4 = model.generate_content(synthesis_prompt)
+        results['synthesis'] = resp4.text
+    except Exception as e:
+        results['synthesis'] = f"❌ 洞察引擎失敗: {str(e)}"
+
+    return results
+
+_PHRASE_SPLIT_RE = re.compile(r"[\s|｜,，、。.!！?？:：;；\-–—/\\【】\[\]（）()「」『』《》<>#＃\"'“”~～…]+")
+
+def _compact(text):
+    """比對用的正規化：NFKC、小寫、簡轉繁、去空白"""
+    return re.sub(r"\s+", "", _to_traditional(unicodedata.normalize("NFKC", text).lower()))
+
+def _term_market(term):
+    return "en" if re.fullmatch(r"[\x00-\x7f]+", term) else "zh"
+
+def phrase_candidates(texts, min_docs=2, max_len=20):
+    """從標題／留言切出反覆出現的片語（以標點、空白切段），回傳 {片語: 出現在幾份文字}"""
+    counter = Counter()
+    for text in texts:
+        parts = _PHRASE_SPLIT_RE.split(unicodedata.normalize("NFKC", text).lower())
+        counter.update({p for p in parts if 2 <= len(p) <= max_len and not p.isdigit()})
+    return {p: c for p, c in counter.items() if c >= min_docs}
+
+def score_keyword_candidates(zh_keywords, en_keywords, deep_zh, deep_en, probes_zh, probes_en,
+                             tag_counter, titles, video_comments):
+    """本地計算每個候選關鍵字的跨來源證據與需求強度，回傳依 score 排序的 DataFrame。
+    候選＝自動完成、探針、競品 Tags、標題與留言中反覆出現的片語，先合併近似變體；
+    訊號＝Google 相關性分數、自動完成／探針出現次數、Tags 次數、標題提及次數、留言提及次數"""
+    pd = lazy_import("pandas")
+    np = lazy_import("numpy")
+    comments = [c['text'] for _, c in clean_comments(video_comments)]
+
+    entries = suggestion_entries(deep_zh, probes_zh, "zh") + suggestion_entries(deep_en, probes_en, "en")
+    entries += [{'term': t, 'score': 0, 'source': 'tags', 'market': _term_market(t)} for t in (tag_counter or {})]
+    entries += [{'term': p, 'score': 0, 'source': 'title', 'market': _term_market(p)} for p in phrase_candidates(titles or [])]
+    entries += [{'term': p, 'score': 0, 'source': 'comment', 'market': _term_market(p)}
+                for p in phrase_candidates(comments, min_docs=3, max_len=12)]
+    clusters = cluster_terms(entries)
+    seeds = {_compact(k) for k in list(zh_keywords) + list(en_keywords)}
+    clusters = [c for c in clusters if _compact(c['term']) not in seeds]
+    columns = ['keyword', 'market', 'relevance', 'suggest', 'tags', 'titles', 'comments', 'variants', 'sources']
+    if not clusters:
+        return pd.DataFrame(columns=columns + ['score', 'demand'])
+
+    # 標題／留言各自串成一個字串，用 str.count 算提及次數（每個詞只掃一次 C 層級的字串搜尋）
+    title_blob = "\x00".join(_compact(t) for t in titles or [])
+    comment_blob = "\x00".join(_compact(t) for t in comments)
+    compact_tags = Counter()
+    for tag, count in (tag_counter or {}).items():
+        compact_tags[_compact(tag)] += count
+
+    rows = []
+    for c in clusters:
+        forms = {_compact(t) for t in [c['term']] + c['variants']}
+        forms.discard("")
+        counts = c['source_counts']
+        tags = sum(compact_tags.get(f, 0) for f in forms)
+        title_hits = sum(title_blob.count(f) for f in forms)
+        comment_hits = sum(comment_blob.count(f) for f in forms)
+        # 來源以「實際有證據」為準，而不是候選詞從哪裡被發現
+        hits = {'autocomplete': counts.get('autocomplete', 0), 'probe': counts.get('probe', 0),
+                'tags': tags, 'title': title_hits, 'comment': comment_hits}
+        rows.append({
+            'keyword': c['term'],
+            'market': c['market'],
+            'relevance': c['score'],
+            'suggest': hits['autocomplete'] + hits['probe'],
+            'tags': tags,
+            'titles': title_hits,
+            'comments': comment_hits,
+            'variants': len(c['variants']),
+            'sources': [name for name, hit in hits.items() if hit],
+        })
+    df = pd.DataFrame(rows, columns=columns)
+
+    # 各訊號取 log 後除以最大值（0～1），加權加總；出現在越多種來源加分越多
+    signals = df[list(DEMAND_WEIGHTS)].astype(float)
+    scaled = np.log1p(signals) / np.log1p(signals.max()).replace(0, np.nan)
+    weights = pd.Series(DEMAND_WEIGHTS)
+    n_sources = (signals > 0).sum(axis=1)
+    composite = scaled.fillna(0).mul(weights).sum(axis=1) / weights.sum()
+    composite += DEMAND_CROSS_SOURCE_BONUS * (n_sources - 1).clip(lower=0) / (len(DEMAND_WEIGHTS) - 1)
+    df['score'] = (composite.clip(upper=1.0) * 100).round(1)
+    df['demand'] = pd.cut(df['score'], bins=[-np.inf, 15, 30, 45, 60, np.inf], labels=[1, 2, 3, 4, 5]).astype(int)
+    return df.sort_values(['score', 'keyword'], ascending=[False, True]).reset_index(drop=True)
+
+def label_keyword_intents(api_key, model_version, keywords):
+    """只請 LLM 給意圖標籤與一句說明（分批並行），回傳 {keyword: {intent, note}}；失敗的批次不影響其他批次"""
+    model = gemini_model(api_key, model_version)
+
+    def label(batch):
+        listing = "\n".join(f"- {kw}" for kw in batch)
+        prompt = f"""
+你是 YouTube 關鍵字研究專家。為以下每個搜尋關鍵字標註：
+- intent：{' / '.join(KEYWORD_INTENTS)} 擇一
+- note：一句話說明這個詞代表的需求或適合的使用時機（繁體中文）
+
+{listing}
+
+每個關鍵字輸出一筆，keyword 欄位原樣照抄。
+"""
+        with tracing.span("keyword_table.label", keywords=len(batch)):
+            response = model.generate_content(
+                prompt,
+                generation_config={"response_mime_type": "application/json", "response_schema": KEYWORD_LABEL_SCHEMA},
+            )
+        return parse_json_response(response.text)
+
+    batches = [keywords[i:i + KEYWORD_LABEL_BATCH] for i in range(0, len(keywords), KEYWORD_LABEL_BATCH)]
+    labels = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        for future in concurrent.futures.as_completed([executor.submit(tracing.bind(label), b) for b in batches]):
+            try:
+                rows = future.result()
+            except Exception:
+                continue
+            for r in rows if isinstance(rows, list) else []:
+                if isinstance(r, dict) and r.get('keyword'):
+                    labels[str(r['keyword']).strip()] = r
+    return labels
+
+@tracing.traced("keyword_table")
+def generate_keyword_master_table(api_key, model_version, zh_keywords, en_keywords,
+                                   deep_zh, deep_en, probes_zh, probes_en,
+                                   tag_counter, titles, video_comments):
+    """整併五種 YouTube 原生來源，生成結構化關鍵字總表（list of dict）。
+    來源、證據與需求強度在本地計算（可重現），LLM 只標註意圖與說明"""
+    scored = score_keyword_candidates(
+        zh_keywords, en_keywords, deep_zh, deep_en, probes_zh, probes_en, tag_counter, titles, video_comments
+    ).head(KEYWORD_TABLE_SIZE)
+    if scored.empty:
+        return []
+    labels = label_keyword_intents(api_key, model_version, scored['keyword'].tolist())
+
+    table = []
+    for r in scored.itertuples():
+        label = labels.get(r.keyword, {})
+        intent = label.get('intent') if label.get('intent') in KEYWORD_INTENTS else '其他'
+        evidence = [f"相關性 {r.relevance}" if r.relevance else "", f"建議詞 ×{r.suggest}" if r.suggest else "",
+                    f"Tags ×{r.tags}" if r.tags else "", f"標題 ×{r.titles}" if r.titles else "",
+                    f"留言 ×{r.comments}" if r.comments else ""]
+        table.append({
+            'keyword': r.keyword,
+            'market': r.market,
+            'intent': intent,
+            'sources': ', '.join(r.sources),
+            'demand': int(r.demand),
+            'score': float(r.score),
+            'evidence': "｜".join(e for e in evidence if e),
+            'note': label.get('note', ''),
+        })
+    return table
+
+@tracing.traced("strategy.brief")
+def condense_keyword_analyses(api_key, keyword, analyses, model_version):
+    """map：把同一關鍵字底下的多支競品分析濃縮成一份精簡 brief（單支影片時不呼叫 AI，直接用欄位摘要）"""
+    if len(analyses) == 1:
+        a = analyses[0]
+        return f"代表影片：{a['title']}（觀看 {a['view_count']:,}）\n{format_analysis_for_prompt(a)}"
+
+    model = gemini_model(api_key, model_version)
+
+    videos_text = ""
+    for idx, a in enumerate(analyses, 1):
+        videos_text += f"\n[{idx}] {a['title']}（觀看 {a['view_count']:,}）\n{format_analysis_for_prompt(a)}\n"
+
+    prompt = f"""
+    以下是搜尋「{keyword}」時 {len(analyses)} 支競品影片的內容分析：
+    {videos_text}
+
+    請濃縮成一份 300 字以內的競品 brief，只保留後續策略規劃需要的資訊：
+    - 共同主題與主流切角
+    - 被多支影片重複提到的論點（標註支數）與只有單支影片提到的論點
+    - 常見的內容結構
+    - 所有影片都沒講到的缺口
+    - 最有獨特價值的 1-2 支影片（標題＋觀看數＋獨特之處）
+
+    條列即可，不要開場白。請用繁體中文回答。
+    """
+    try:
+        response = model.generate_content(prompt)
+        return response.text
+    except Exception:
+        # 濃縮失敗時退回逐支欄位摘要，不讓單一關鍵字卡住整份策略
+        return "\n".join(format_analysis_for_prompt(a) for a in analyses)
+
+def build_keyword_briefs(api_key, all_analyses, model_version, max_workers=4):
+    """並行濃縮每個 (市場, 關鍵字) 的競品分析，回傳 [{market, keyword, video_count, total_views, brief}]"""
+    groups = {}
+    for a in all_analyses:
+        if a.get('success'):
+            groups.setdefault((a.get('market', 'zh'), a.get('source_keyword', '')), []).append(a)
+
+    briefs = []
+    if not groups:
+        return briefs
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_group = {
+            executor.submit(tracing.bind(condense_keyword_analyses), api_key, keyword, analyses, model_version): (market, keyword)
+            for (market, keyword), analyses in groups.items()
+        }
+        for future in concurrent.futures.as_completed(future_to_group):
+            market, keyword = future_to_group[future]
+            analyses = groups[(market, keyword)]
+            try:
+                brief = future.result()
+            except Exception as e:
+                brief = f"濃縮失敗: {str(e)}"
+            briefs.append({
+                'market': market,
+                'keyword': keyword,
+                'video_count': len(analyses),
+                'total_views': sum(a['view_count'] for a in analyses),
+                'brief': brief,
+            })
+    # 依總觀看數排序，prompt 裡流量大的關鍵字排前面
+    briefs.sort(key=lambda b: (-b['total_views'], b['market'], b['keyword']))
+    return briefs
+
+@tracing.traced("strategy.module")
+def generate_strategy_module(api_key, module_key, all_analyses, keywords_info, user_goal, model_version, has_english=False, briefs=None):
+    """生成單一策略模組的報告；傳入 briefs 時改用關鍵字濃縮版（map-reduce 的 reduce 端）"""
+    model = gemini_model(api_key, model_version)
+    
+    module = STRATEGY_MODULES[module_key]
+    
+    # 整理影片分析內容
+    zh_analyses = [a for a in all_analyses if a.get('market') == 'zh']
+    en_analyses = [a for a in all_analyses if a.get('market') == 'en']
+    
+    combined_context = ""
+    
+    if briefs is not None:
+        for market, header in (('zh', "### 🇹🇼 繁體中文市場競品（按關鍵字濃縮）"), ('en', "### 🇺🇸 英文市場競品（按關鍵字濃縮）")):
+            market_briefs = [b for b in briefs if b['market'] == market]
+            if market_briefs:
+                combined_context += f"\n{header}\n\n"
+                for b in market_briefs:
+                    combined_context += f"""
+**關鍵字「{b['keyword']}」**（{b['video_count']} 支影片，總觀看 {b['total_views']:,}）
+
+{b['brief']}
+
+---
+"""
+    elif zh_analyses:
+        combined_context += "### 🇹🇼 繁體中文市場競品\n\n"
+        for idx, analysis in enumerate(zh_analyses, 1):
+            combined_context += f"""
+**[中文 {idx}] {analysis['title']}**
+- 來源關鍵字：{analysis.get('source_keyword', 'N/A')}
+- 觀看數：{analysis['view_count']:,}
+- 網址：{analysis['url']}
+
+{format_analysis_for_prompt(analysis)}
+
+---
+"""
+    
+    if briefs is None and en_analyses:
+        combined_context += "\n### 🇺🇸 英文市場競品\n\n"
+        for idx, analysis in enumerate(en_analyses, 1):
+            combined_context += f"""
+**[英文 {idx}] {analysis['title']}**
+- 來源關鍵字：{analysis.get('source_keyword', 'N/A')}
+- 觀看數：{analysis['view_count']:,}
+- 網址：{analysis['url']}
+
+{format_analysis_for_prompt(analysis)}
+
+---
+"""
+
+    # 針對搬運策略的特殊處理
+    localization_context = ""
+    if module_key == "localization":
+        if not en_analyses:
+            return f"# {module['name']}\n\n⚠️ 未啟用英文市場搜尋，無法生成搬運策略。請在側邊欄啟用「英文市場比對」功能後重新執行。"
+        localization_context = """
+特別注意：請重點分析英文市場的影片，找出值得本地化到繁體中文市場的內容。
+"""
+
+    prompt = f"""
+    你是一位頂尖的 YouTube 內容策略顧問。
+    
+    研究關鍵字：{', '.join(keywords_info.get('zh', []))}
+    {'對應英文關鍵字：' + ', '.join(keywords_info.get('en', [])) if keywords_info.get('en') else ''}
+    
+    以下是競品影片的詳細分析：
+    
+    {combined_context}
+    
+    【使用者的創作目標】
+    {user_goal}
+    
+    {localization_context}
+    
+    請根據以上競品分析，專注於以下策略方向提出建議：
+    
+    {module['prompt']}
+    
+    請用繁體中文回答，內容要具體可執行，格式清晰專業。
+    """
+    
+    try:
+        response = model.generate_content(prompt)
+        return f"# {module['name']}\n\n{response.text}"
+    except Exception as e:
+        return f"# {module['name']}\n\n❌ 生成失敗: {str(e)}"
+
+def batch_generate_strategies(api_key, selected_modules, all_analyses, keywords_info, user_goal, model_version, has_english=False, map_reduce=False):
+    """並行生成多個策略模組；map_reduce=True 時先並行濃縮各關鍵字 brief，所有模組共用同一份"""
+    results = {}
+    briefs = build_keyword_briefs(api_key, all_analyses, model_version) if map_reduce else None
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(selected_modules)) as executor:
+        future_to_module = {
+            executor.submit(
+                tracing.bind(generate_strategy_module), 
+                api_key, module_key, all_analyses, keywords_info, user_goal, model_version, has_english, briefs
+            ): module_key 
+            for module_key in selected_modules
+        }
+        
+        for future in concurrent.futures.as_completed(future_to_module):
+            module_key = future_to_module[future]
+            try:
+                result = future.result()
+                results[module_key] = result
+            except Exception as e:
+                results[module_key] = f"# {STRATEGY_MODULES[module_key]['name']}\n\n❌ 執行錯誤: {str(e)}"
+    
+    return results
+
+# ==========================================
+# 4. 輔助函式
+# ==========================================
+
+def iter_all_analyses_md(video_analyses):
+    """逐段產生全部影片分析的 Markdown（串流寫檔用，不在記憶體組出整份報告）"""
+    zh_analyses = [a for a in video_analyses if a.get('market') == 'zh']
+    en_analyses = [a for a in video_analyses if a.get('market') == 'en']
+
+    yield "# YouTube 競品影片分析報告\n\n"
+    yield f"生成時間：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+    yield f"共分析 {len(video_analyses)} 支影片（中文 {len(zh_analyses)} 支，英文 {len(en_analyses)} 支）\n\n"
+    yield "---\n\n"
+
+    for heading, analyses in (("## 🇹🇼 繁體中文市場\n\n", zh_analyses), ("## 🇺🇸 英文市場\n\n", en_analyses)):
+        if not analyses:
+            continue
+        yield heading
+        for idx, analysis in enumerate(analyses, 1):
+            status = "✅ 成功" if analysis['success'] else "❌ 失敗"
+            yield (
+                f"### {idx}. {analysis['title']}\n\n"
+                f"- **狀態**: {status}\n"
+                f"- **來源關鍵字**: {analysis.get('source_keyword', 'N/A')}\n"
+                f"- **網址**: {analysis['url']}\n"
+                f"- **觀看數**: {analysis['view_count']:,}\n\n"
+                f"#### 分析內容\n\n{analysis_markdown(analysis)}\n\n"
+                "---\n\n"
+            )
+
+def generate_all_analyses_md(video_analyses):
+    """將所有影片分析整合成一份 Markdown"""
+    return "".join(iter_all_analyses_md(video_analyses))
+
+INTENT_LAYER_SECTIONS = [
+    ('synthesis', "💡 洞察引擎（三層對撞）"),
+    ('layer1', "需求端：搜尋詞異常"),
+    ('layer2', "供給端：供需錯位"),
+    ('layer3', "反應端：觀眾落差"),
+]
+
+def iter_intent_layers_md(three_layers):
+    """逐段產生三層意圖分析（含洞察引擎）的 Markdown 內文"""
+    for idx, (key, heading) in enumerate(INTENT_LAYER_SECTIONS):
+        if idx:
+            yield "\n\n---\n\n"
+        yield f"## {heading}\n\n"
+        yield three_layers.get(key, '')
+    yield "\n\n"
+
+def intent_layers_md(three_layers):
+    """三層意圖分析（含洞察引擎）的 Markdown 內文"""
+    return "".join(iter_intent_layers_md(three_layers))
+
+def _report_header(title, zh_keywords, en_keywords):
+    content = f"# {title}\n\n"
+    content += f"生成時間：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+    content += f"研究關鍵字（中文）：{', '.join(zh_keywords)}\n"
+    if en_keywords:
+        content += f"研究關鍵字（英文）：{', '.join(en_keywords)}\n"
+    content += "\n---\n\n"
+    return content
+
+def generate_intent_report_md(zh_keywords, en_keywords, three_layers):
+    """三層意圖分析報告（單獨下載用）"""
+    return _report_header("三層意圖分析報告", zh_keywords, en_keywords) + intent_layers_md(three_layers)
+
+def iter_full_report_md(zh_keywords, en_keywords, three_layers, intent_analysis, video_analyses, strategy_results):
+    """逐段產生完整報告：意圖分析 + 所有影片分析 + 全部策略報告"""
+    yield _report_header("YouTube 戰略內容分析完整報告", zh_keywords, en_keywords)
+
+    yield "# PART 1: 意圖分析（三層對撞 → 洞察）\n\n"
+    if three_layers:
+        yield from iter_intent_layers_md(three_layers)
+    elif intent_analysis:
+        yield intent_analysis + "\n\n"
+    yield "---\n\n"
+
+    yield "# PART 2: 競品影片分析\n\n"
+    yield from iter_all_analyses_md(video_analyses)
+    yield "\n---\n\n"
+
+    yield "# PART 3: 策略報告\n\n"
+    for module_content in strategy_results.values():
+        yield module_content
+        yield "\n\n---\n\n"
+
+def generate_full_report_md(zh_keywords, en_keywords, three_layers, intent_analysis, video_analyses, strategy_results):
+    """完整報告：意圖分析 + 所有影片分析 + 全部策略報告"""
+    return "".join(iter_full_report_md(
+        zh_keywords, en_keywords, three_layers, intent_analysis, video_analyses, strategy_results
+    ))
+
+def group_videos_by_keyword(videos, top_n=None):
+    """依 source_keyword 分組，回傳 {keyword: [videos]}（每組依 rank 排序；給 top_n 只留前 N 名）"""
+    store = videos if isinstance(videos, VideoStore) else VideoStore(videos)
+    return store.group_by_keyword(top_n=top_n)
+
+# ==========================================
+# 5. 階段排程（DAG）
+# ==========================================
+
+def _topological_order(stages):
+    """依相依關係排序階段；有未知的相依或循環時丟 ValueError"""
+    order = []
+    state = {}
+
+    def visit(name, trail):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            raise ValueError(f"階段相依出現循環：{' → '.join(trail + [name])}")
+        if name not in stages:
+            raise ValueError(f"未知的相依階段：{name}（被 {trail[-1]} 需要）")
+        state[name] = "visiting"
+        for dep in stages[name].get('deps', []):
+            visit(dep, trail + [name])
+        state[name] = "done"
+        order.append(name)
+
+    for name in stages:
+        visit(name, [])
+    return order
+
+def critical_path(stages, timings):
+    """從各階段實際耗時算出關鍵路徑（決定整體牆鐘時間的那條相依鏈），回傳 (階段名稱列表, 總秒數)"""
+    finish = {}
+    previous = {}
+    for name in _topological_order(stages):
+        deps = stages[name].get('deps', [])
+        best = max(deps, key=lambda d: finish[d], default=None)
+        finish[name] = timings[name].get('seconds', 0) + (finish[best] if best else 0)
+        previous[name] = best
+    if not finish:
+        return [], 0
+    end = max(finish, key=finish.get)
+    path = []
+    node = end
+    while node:
+        path.append(node)
+        node = previous[node]
+    return path[::-1], finish[end]
+
+def run_stage_graph(stages, max_workers=4, on_update=None, cancel_event=None):
+    """依相依關係並行執行各階段：每個階段的 deps 全部完成就立刻開始，互不相依的階段自動重疊。
+
+    stages = {name: {'fn': callable, 'deps': [...], 'label': '顯示名稱'}}，fn 以各 dep 的結果作為同名關鍵字參數呼叫。
+    on_update(timings) 在呼叫端的 thread 裡於每次狀態變化時呼叫（可直接更新 UI）。
+    某階段失敗時，依賴它的階段標記為 skipped，其餘階段照常執行。
+    cancel_event 被設定時不再啟動新階段，丟出 PipelineCancelled（執行中的階段會在背景自行結束）。
+    回傳 {'results', 'timings', 'critical_path', 'critical_seconds', 'wall_seconds'}"""
+    order = _topological_order(stages)
+    results = {}
+    timings = {
+        name: {'label': stages[name].get('label', name), 'status': 'pending', 'start': None, 'seconds': 0, 'error': ''}
+        for name in order
+    }
+    started = time.perf_counter()
+
+    def notify():
+        if on_update:
+            on_update(timings)
+
+    def run_stage(name):
+        kwargs = {dep: results[dep] for dep in stages[name].get('deps', [])}
+        with tracing.span(f"stage:{name}"):
+            return stages[name]['fn'](**kwargs)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    running = {}
+    try:
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                for name in running.values():
+                    timings[name]['status'] = 'failed'
+                    timings[name]['error'] = '已取消'
+                notify()
+                raise PipelineCancelled("流程已取消")
+            for name in order:
+                info = timings[name]
+                if info['status'] != 'pending':
+                    continue
+                dep_status = [timings[d]['status'] for d in stages[name].get('deps', [])]
+                if any(status in ('failed', 'skipped') for status in dep_status):
+                    info['status'] = 'skipped'
+                elif all(status == 'done' for status in dep_status):
+                    info['status'] = 'running'
+                    info['start'] = time.perf_counter() - started
+                    running[executor.submit(tracing.bind(run_stage), name)] = name
+            notify()
+            if not running:
+                break
+            # 定時醒來檢查取消旗標
+            done, _ = concurrent.futures.wait(running, timeout=0.5, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                info = timings[name]
+                info['seconds'] = time.perf_counter() - started - info['start']
+                try:
+                    results[name] = future.result()
+                    info['status'] = 'done'
+                except Exception as e:
+                    info['status'] = 'failed'
+                    info['error'] = str(e)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    path, critical_seconds = critical_path(stages, timings)
+    return {
+        'results': results,
+        'timings': timings,
+        'critical_path': path,
+        'critical_seconds': critical_seconds,
+        'wall_seconds': time.perf_counter() - started,
+    }
+
+STAGE_STATUS_ICONS = {'pending': "⬜", 'running': "🔄", 'done': "✅", 'failed': "❌", 'skipped': "⏭️"}
+
+def stage_timings_md(timings, critical=None):
+    """階段狀態／耗時表（Markdown），critical 中的階段會標上 🔥"""
+    lines = ["| 階段 | 狀態 | 開始 (s) | 耗時 (s) |", "|---|---|---|---|"]
+    for name, t in timings.items():
+        label = f"🔥 {t['label']}" if critical and name in critical else t['label']
+        start = f"{t['start']:.1f}" if t['start'] is not None else "-"
+        seconds = f"{t['seconds']:.1f}" if t['status'] in ('done', 'failed') else "-"
+        status = STAGE_STATUS_ICONS.get(t['status'], t['status'])
+        if t['error']:
+            status += f" {t['error'][:60]}"
+        lines.append(f"| {label} | {status} | {start} | {seconds} |")
+    return "\n".join(lines)
+
+def search_pipeline_stages(gemini_api_key, youtube_api_key, zh_keywords, en_keywords, model_version,
+                           max_results_per_keyword=5, comment_top_n=5,
+                           deep_suggestions_zh=None, deep_suggestions_en=None,
+                           probe_suggestions_zh=None, probe_suggestions_en=None, on_error=None):
+    """STEP 1「批次搜尋與三層意圖分析」的階段圖：
+    搜尋、長尾展開、探針三條線互不相依會同時跑；頻道訂閱數與留言只等搜尋結果；意圖分析等全部完成。
+    已有的長尾展開／探針結果會沿用，只補缺的關鍵字。各階段不碰 session_state，結果由呼叫端寫回"""
+    def expand(existing, keywords, lang):
+        merged = dict(existing or {})
+        for kw in keywords:
+            if kw not in merged:
+                merged[kw] = get_youtube_suggestions_deep(kw, lang=lang, depth=2)
+        return merged
+
+    def probe(existing, keywords, lang, market):
+        merged = dict(existing or {})
+        for kw in keywords:
+            if kw not in merged:
+                merged[kw] = probe_youtube_suggestions(kw, lang=lang, market=market)
+        return merged
+
+    def channel_stats(search_zh, search_en):
+        videos = search_zh + search_en
+        stats = fetch_channel_stats(youtube_api_key, VideoStore(videos).channel_ids())
+        for v in videos:
+            v['subscriber_count'] = stats.get(v.get('channel_id', ''), 0)
+        return stats
+
+    def comments(search_zh, search_en):
+        return batch_fetch_comments(
+            youtube_api_key, group_videos_by_keyword(search_zh + search_en),
+            top_n=comment_top_n, max_per_video=50
+        )
+
+    def intent(search_zh, search_en, channel_stats, deep_zh, deep_en, probe_zh, probe_en, comments):
+        if not (search_zh or search_en):
+            return {}
+        return analyze_intent_three_layers(
+            gemini_api_key, zh_keywords, en_keywords, search_zh, search_en,
+            deep_zh, deep_en, comments, model_version,
+            probe_suggestions_zh=probe_zh, probe_suggestions_en=probe_en
+        )
+
+    return {
+        'search_zh': {
+            'label': "🇹🇼 中文搜尋",
+            'fn': lambda: search_multiple_keywords(youtube_api_key, zh_keywords, max_results_per_keyword, lang="zh", on_error=on_error) if zh_keywords else [],
+        },
+        'search_en': {
+            'label': "🇺🇸 英文搜尋",
+            'fn': lambda: search_multiple_keywords(youtube_api_key, en_keywords, max_results_per_keyword, lang="en", on_error=on_error) if en_keywords else [],
+        },
+        'deep_zh': {'label': "🇹🇼 長尾展開", 'fn': lambda: expand(deep_suggestions_zh, zh_keywords, "zh-TW")},
+        'deep_en': {'label': "🇺🇸 長尾展開", 'fn': lambda: expand(deep_suggestions_en, en_keywords, "en")},
+        'probe_zh': {'label': "🇹🇼 修飾詞探針", 'fn': lambda: probe(probe_suggestions_zh, zh_keywords, "zh-TW", "zh")},
+        'probe_en': {'label': "🇺🇸 修飾詞探針", 'fn': lambda: probe(probe_suggestions_en, en_keywords, "en", "en")},
+        'channel_stats': {'label': "頻道訂閱數", 'fn': channel_stats, 'deps': ['search_zh', 'search_en']},
+        'comments': {'label': "熱門留言", 'fn': comments, 'deps': ['search_zh', 'search_en']},
+        'intent': {
+            'label': "三層意圖分析＋洞察",
+            'fn': intent,
+            'deps': ['search_zh', 'search_en', 'channel_stats', 'deep_zh', 'deep_en', 'probe_zh', 'probe_en', 'comments'],
+        },
+    }
+
+def combine_intent_layers(three_layers):
+    """舊版相容的合併意圖分析文字（layer1～3 串接）"""
+    return "".join(
+        three_layers[k] + "\n\n---\n\n" for k in ['layer1', 'layer2', 'layer3'] if k in three_layers
+    )
+
+# ==========================================
+# 6. 無介面完整流程
+# ==========================================
+
+def run_research(gemini_api_key, youtube_api_key, zh_keywords, en_keywords=None,
+                 model_version="gemini-2.5-flash", max_results_per_keyword=5,
+                 comment_top_n=5, extract_top_n=3, strategy_modules=None,
+                 user_goal=DEFAULT_USER_GOAL, build_keyword_table=True,
+                 max_concurrent_ai=3, progress=None, run_id=None, resume=False):
+    """不經 Streamlit 跑完整研究流程：搜尋 → 頻道訂閱數 → 長尾展開 → 探針 → 留言 → 三層意圖分析
+    → 關鍵字總表 → 影片分析（每個關鍵字前 extract_top_n 名）→ 策略模組。
+    回傳與 app.py session_state 同名的產出；progress(stage) 用來回報目前階段。
+    給 run_id 時每個階段完成後寫入 checkpoint；resume=True 時沿用該 run_id 已完成的階段"""
+    en_keywords = en_keywords or []
+    strategy_modules = list(STRATEGY_MODULES) if strategy_modules is None else strategy_modules
+    report = progress or (lambda stage: None)
+    run = {'zh_keywords': list(zh_keywords), 'en_keywords': list(en_keywords)}
+
+    restored = checkpoints.load_run(run_id) if run_id and resume else None
+    completed = set(restored['completed_stages']) if restored else set()
+
+    def checkpoint(stage):
+        if run_id:
+            checkpoints.save_checkpoint(run_id, stage, run, zh_keywords, en_keywords)
+
+    if 'search' in completed:
+        for name in checkpoints.STAGE_ARTIFACTS['search']:
+            run[name] = restored.get(name, {})
+    else:
+        report("search")
+        graph = run_stage_graph(search_pipeline_stages(
+            gemini_api_key, youtube_api_key, zh_keywords, en_keywords, model_version,
+            max_results_per_keyword=max_results_per_keyword, comment_top_n=comment_top_n
+        ))
+        results = graph['results']
+        run['search_results'] = {'zh': results.get('search_zh', []), 'en': results.get('search_en', [])}
+        run['deep_suggestions_zh'] = results.get('deep_zh', {})
+        run['deep_suggestions_en'] = results.get('deep_en', {})
+        run['probe_suggestions_zh'] = results.get('probe_zh', {})
+        run['probe_suggestions_en'] = results.get('probe_en', {})
+        run['video_comments'] = results.get('comments', {})
+        run['intent_three_layers'] = results.get('intent') or {}
+        run['intent_analysis'] = combine_intent_layers(run['intent_three_layers'])
+        run['stage_timings'] = graph['timings']
+        checkpoint('search')
+    all_videos = run['search_results'].get('zh', []) + run['search_results'].get('en', [])
+
+    run['keyword_table'] = []
+    if 'keyword_table' in completed:
+        run['keyword_table'] = restored.get('keyword_table', [])
+    elif build_keyword_table:
+        report("keyword_table")
+        try:
+            run['keyword_table'] = generate_keyword_master_table(
+                gemini_api_key, model_version, zh_keywords, en_keywords,
+                run['deep_suggestions_zh'], run['deep_suggestions_en'],
+                run['probe_suggestions_zh'], run['probe_suggestions_en'],
+                collect_video_tags(all_videos), [v['title'] for v in all_videos], run['video_comments']
+            )
+            checkpoint('keyword_table')
+        except Exception:
+            pass
+
+    if 'extract' in completed:
+        run['video_analyses'] = restored.get('video_analyses', {'zh': [], 'en': []})
+    else:
+        report("extract")
+        selected = [v for videos in group_videos_by_keyword(all_videos, top_n=extract_top_n).values() for v in videos]
+        analyses = batch_extract_videos(gemini_api_key, selected, max_workers=max_concurrent_ai) if selected else []
+        run['video_analyses'] = {
+            'zh': [a for a in analyses if a.get('market') == 'zh'],
+            'en': [a for a in analyses if a.get('market') == 'en'],
+        }
+        checkpoint('extract')
+    analyses = run['video_analyses']['zh'] + run['video_analyses']['en']
+
+    run['strategy_results'] = {}
+    run['user_goal'] = user_goal
+    has_english = bool(run['video_analyses']['en'])
+    modules = [m for m in strategy_modules if m != "localization" or has_english]
+    if 'strategy' in completed:
+        run['strategy_results'] = restored.get('strategy_results', {})
+    elif analyses and modules:
+        report("strategy")
+        run['strategy_results'] = batch_generate_strategies(
+            gemini_api_key, modules, analyses, {'zh': list(zh_keywords), 'en': list(en_keywords)},
+            user_goal, model_version, has_english, map_reduce=len(analyses) > MAP_REDUCE_THRESHOLD
+        )
+        checkpoint('strategy')
+
+    report("done")
+    return run
@@ -0,0 +1,127 @@
+"""報告匯出：Markdown 逐段串流寫檔，以及整次執行的完整資料包（zip）。
+
+資料包內容（與 app.py 的 session_state／run_research 產出同名的 run dict）：
+    manifest.json             關鍵字、生成時間、各檔筆數
+    videos.jsonl              搜尋到的影片（每行一支，帶 market）
+    comments.jsonl            熱門留言（每行一支影片）
+    suggestions.json          長尾展開與修飾詞探針
+    keyword_table.parquet     關鍵字總表（沒有 pyarrow 時改存 keyword_table.jsonl）
+    analyses.jsonl            影片分析（含結構化欄位）
+    intent/<layer>.md         洞察引擎與三層意圖分析
+    strategies/<module>.md    各策略模組
+    report.md                 完整報告
+
+每個檔案直接串流寫進 zip，影片分析幾百份時也不會先在記憶體組出整份報告。
+"""
+import io
+import json
+import os
+import zipfile
+from datetime import datetime
+
+import engine
+import tracing
+from checkpoints import STAGE_ARTIFACTS
+
+# 打包時從 session_state／run dict 取用的產出
+BUNDLE_ARTIFACTS = ['run_id', 'zh_keywords', 'en_keywords'] + [
+    name for names in STAGE_ARTIFACTS.values() for name in names
+]
+
+
+def write_markdown(target, pieces):
+    """把 Markdown 片段（iter_*_md 的產出）逐段寫進 target（路徑或文字檔物件），回傳寫入的字元數"""
+    if isinstance(target, (str, os.PathLike)):
+        tmp_path = f"{target}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            written = write_markdown(f, pieces)
+        os.replace(tmp_path, target)
+        return written
+    written = 0
+    for piece in pieces:
+        written += target.write(piece)
+    return written
+
+
+def _zip_text(zf, name, pieces):
+    with io.TextIOWrapper(zf.open(name, "w"), encoding="utf-8") as f:
+        for piece in pieces:
+            f.write(piece)
+
+
+def _jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+
+def _zip_keyword_table(zf, rows):
+    """關鍵字總表存成 Parquet（表很小，先寫進記憶體再放進 zip）；沒有 parquet 引擎時改存 JSONL"""
+    pd = engine.lazy_import("pandas")
+    buffer = io.BytesIO()
+    try:
+        pd.DataFrame(rows).to_parquet(buffer, index=False)
+    except ImportError:
+        _zip_text(zf, "keyword_table.jsonl", _jsonl_lines(rows))
+        return "keyword_table.jsonl"
+    zf.writestr("keyword_table.parquet", buffer.getvalue())
+    return "keyword_table.parquet"
+
+
+def write_run_bundle(target, run):
+    """把一次執行的產出打包成 zip 寫進 target（路徑或可寫的二進位檔物件），回傳 manifest"""
+    if isinstance(target, (str, os.PathLike)):
+        tmp_path = f"{target}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            manifest = write_run_bundle(f, run)
+        os.replace(tmp_path, target)
+        return manifest
+
+    search_results = run.get('search_results') or {}
+    video_analyses = run.get('video_analyses') or {}
+    videos = search_results.get('zh', []) + search_results.get('en', [])
+    analyses = video_analyses.get('zh', []) + video_analyses.get('en', [])
+    comments = run.get('video_comments') or {}
+    three_layers = run.get('intent_three_layers') or {}
+    strategy_results = run.get('strategy_results') or {}
+    manifest = {
+        'generated': datetime.now().isoformat(timespec="seconds"),
+        'run_id': run.get('run_id'),
+        'zh_keywords': run.get('zh_keywords', []),
+        'en_keywords': run.get('en_keywords', []),
+        'counts': {
+            'videos': len(videos),
+            'comments': sum(len(c.get('comments', [])) for c in comments.values()),
+            'keywords': len(run.get('keyword_table') or []),
+            'analyses': len(analyses),
+            'strategies': len(strategy_results),
+        },
+        'files': [],
+    }
+
+    with tracing.span("export.bundle", videos=len(videos), analyses=len(analyses)), \
+            zipfile.ZipFile(target, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        def add(name, pieces):
+            _zip_text(zf, name, pieces)
+            manifest['files'].append(name)
+
+        add("videos.jsonl", _jsonl_lines(videos))
+        add("comments.jsonl", _jsonl_lines({'video_id': vid, **data} for vid, data in comments.items()))
+        add("suggestions.json", [json.dumps({
+            name: run.get(name) or {}
+            for name in ('deep_suggestions_zh', 'deep_suggestions_en', 'probe_suggestions_zh', 'probe_suggestions_en')
+        }, ensure_ascii=False)])
+        if run.get('keyword_table'):
+            manifest['files'].append(_zip_keyword_table(zf, run['keyword_table']))
+        if analyses:
+            add("analyses.jsonl", _jsonl_lines(analyses))
+        for key, heading in engine.INTENT_LAYER_SECTIONS:
+            if three_layers.get(key):
+                add(f"intent/{key}.md", [f"# {heading}\n\n", three_layers[key], "\n"])
+        for key, content in strategy_results.items():
+            add(f"strategies/{key}.md", [content, "\n"])
+        add("report.md", engine.iter_full_report_md(
+            manifest['zh_keywords'], manifest['en_keywords'], three_layers,
+            run.get('intent_analysis', ''), analyses, strategy_results,
+        ))
+        zf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+    return manifest
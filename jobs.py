@@ -0,0 +1,156 @@
+"""背景工作管理：長時間的流程在 worker thread 執行，不會因 Streamlit rerun（點按鈕、切 tab）而中斷。
+
+介面每次 rerun 只讀取工作狀態（進度、訊息、結果），不直接執行流程；結果由介面在完成後寫回 session_state。
+每個工作都在自己的 trace 裡執行，結束後 job['trace'] 是 tracing.Trace.to_dict() 的結果。
+"""
+import concurrent.futures
+import threading
+import time
+import uuid
+
+import tracing
+
+
+class JobContext:
+    """交給工作函式的控制物件：回報進度、檢查是否被取消"""
+
+    def __init__(self, manager, job_id):
+        self._manager = manager
+        self.job_id = job_id
+        self.cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def update(self, progress=None, message=None, detail=None):
+        """更新進度（0～1）、狀態訊息與任意細節（例如各階段耗時）"""
+        changes = {}
+        if progress is not None:
+            changes['progress'] = max(0.0, min(1.0, progress))
+        if message is not None:
+            changes['message'] = message
+        if detail is not None:
+            changes['detail'] = detail
+        self._manager._update(self.job_id, **changes)
+
+
+class JobManager:
+    """process 內共用的背景工作管理器，工作以 session_id 分開存放。
+
+    fn 以 fn(ctx, *args, **kwargs) 呼叫，ctx 為 JobContext。工作在取消後丟出任何例外都視為「已取消」。
+    """
+
+    def __init__(self, max_workers=4, keep_seconds=3600):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._contexts = {}
+        self._futures = {}
+        self.keep_seconds = keep_seconds
+
+    def submit(self, session_id, kind, fn, *args, **kwargs):
+        """送出背景工作，回傳 job_id；同一 session 同一種類的舊工作會先被取消"""
+        for job in self.jobs_for(session_id, kind):
+            if job['status'] in ('queued', 'running'):
+                self.cancel(job['id'])
+        self._prune()
+
+        job_id = uuid.uuid4().hex[:12]
+        ctx = JobContext(self, job_id)
+        with self._lock:
+            self._jobs[job_id] = {
+                'id': job_id,
+                'session_id': session_id,
+                'kind': kind,
+                'status': 'queued',
+                'progress': 0.0,
+                'message': '',
+                'detail': None,
+                'result': None,
+                'error': '',
+                'created': time.time(),
+                'started': None,
+                'finished': None,
+                'trace': None,
+            }
+            self._contexts[job_id] = ctx
+            self._futures[job_id] = self._executor.submit(self._run, job_id, ctx, fn, args, kwargs)
+        return job_id
+
+    def _run(self, job_id, ctx, fn, args, kwargs):
+        if ctx.cancelled:
+            self._update(job_id, status='cancelled', finished=time.time())
+            return
+        self._update(job_id, status='running', started=time.time())
+        with tracing.start_trace(self.get(job_id)['kind']) as trace:
+            try:
+                result = fn(ctx, *args, **kwargs)
+            except Exception as e:
+                error = e
+            else:
+                error = None
+        changes = {'finished': time.time(), 'trace': trace.to_dict()}
+        if error is not None:
+            if ctx.cancelled:
+                self._update(job_id, status='cancelled', **changes)
+            else:
+                self._update(job_id, status='failed', error=str(error), **changes)
+            return
+        status = 'cancelled' if ctx.cancelled else 'done'
+        self._update(job_id, status=status, result=result, progress=1.0, **changes)
+
+    def _update(self, job_id, **changes):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(changes)
+
+    def get(self, job_id):
+        """工作狀態快照（dict），不存在時回傳 None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def jobs_for(self, session_id, kind=None):
+        """某個 session 的所有工作快照，新的在前"""
+        with self._lock:
+            jobs = [
+                dict(j) for j in self._jobs.values()
+                if j['session_id'] == session_id and (kind is None or j['kind'] == kind)
+            ]
+        return sorted(jobs, key=lambda j: -j['created'])
+
+    def active(self, session_id):
+        """某個 session 尚未結束的工作"""
+        return [j for j in self.jobs_for(session_id) if j['status'] in ('queued', 'running')]
+
+    def cancel(self, job_id):
+        """取消工作：還沒開始的直接取消，執行中的設定取消旗標（由工作函式配合中止）"""
+        with self._lock:
+            ctx = self._contexts.get(job_id)
+            future = self._futures.get(job_id)
+        if ctx is None:
+            return False
+        ctx.cancel_event.set()
+        if future is not None and future.cancel():
+            self._update(job_id, status='cancelled', finished=time.time())
+        return True
+
+    def discard(self, job_id):
+        """介面已取用結果後移除工作紀錄"""
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._contexts.pop(job_id, None)
+            self._futures.pop(job_id, None)
+
+    def _prune(self):
+        """清掉結束太久、沒人取用的工作，避免長時間執行的 server 記憶體持續成長"""
+        cutoff = time.time() - self.keep_seconds
+        with self._lock:
+            stale = [
+                job_id for job_id, j in self._jobs.items()
+                if j['finished'] and j['finished'] < cutoff
+            ]
+        for job_id in stale:
+            self.discard(job_id)
+
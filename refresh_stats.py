@@ -0,0 +1,50 @@
+"""影片統計快照的增量更新器（供 cron 定時執行，例如每 6 小時一次）。
+
+只重新抓「最近 30 天內出現在搜尋結果、且最新快照已過期」的影片，每 50 支一次 videos.list(part=statistics)，
+寫進 snapshots.py 的快照庫；第二層分析就能用快照差值算出近期的真實日均觀看與加速度。
+
+用法：
+    python refresh_stats.py                      # 快照超過 24 小時的影片
+    python refresh_stats.py --stale-hours 6 --track-days 14
+
+API 金鑰從環境變數 YOUTUBE_API_KEY 讀取（或用 --youtube-key 指定）。
+"""
+import argparse
+import os
+import sys
+import time
+
+import engine
+import snapshots
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="增量更新追蹤中影片的統計快照")
+    parser.add_argument("--stale-hours", type=float, default=24, help="最新快照超過幾小時才重新抓")
+    parser.add_argument("--track-days", type=float, default=snapshots.TRACK_DAYS, help="最近幾天內出現在搜尋結果的影片才追蹤")
+    parser.add_argument("--workers", type=int, default=4, help="同時送出的 videos.list 請求數")
+    parser.add_argument("--youtube-key", default=os.environ.get("YOUTUBE_API_KEY", ""))
+    args = parser.parse_args(argv)
+
+    if not args.youtube_key:
+        parser.error("請設定 YOUTUBE_API_KEY（環境變數或參數）")
+    store = snapshots.store()
+    if store is None:
+        parser.error("快照庫已停用（YT_SNAPSHOT_DB=off）")
+
+    started = time.time()
+    ids = store.stale_video_ids(stale_hours=args.stale_hours, track_days=args.track_days)
+    result = engine.refresh_video_stats(args.youtube_key, ids, max_workers=args.workers)
+    print(f"更新 {result['refreshed']}/{result['requested']} 支影片的統計"
+          f"（{(len(ids) + 49) // 50} 次 videos.list，{time.time() - started:.1f}s）"
+          + (f"，{result['missing']} 支未回傳（可能已下架或設為私人）" if result['missing'] else ""))
+    if result['failed']:
+        print(f"❌ {result['failed']} 支影片所在的批次請求失敗（{len(result['errors'])} 次），下次執行會再重抓：", file=sys.stderr)
+        for error in dict.fromkeys(result['errors']):
+            print(f"  {error}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+"""HTTP 錄製／重播：把一次真實執行的 suggestqueries、YouTube Data API、Gemini 流量存成 cassette，之後可在離線環境重播。
+
+用途是讓效能改動可以在沒有網路的機器上重複量測，結果不受外部 API 波動影響。
+
+    replay.activate("cassettes/demo", mode="record")          # 真的打 API，同時錄下來
+    replay.activate("cassettes/demo", mode="replay", latency_scale=1.0)  # 離線重播，延遲照錄製時的耗時
+
+也可以用環境變數啟用（batch_runner、bench 腳本的子 process 會自動套用）：
+    YT_CASSETTE=cassettes/demo YT_CASSETTE_MODE=replay YT_REPLAY_LATENCY=0.05
+
+cassette 是一個目錄，每個 process 寫自己的 <pid>.jsonl（多 process 同時錄製不會互相覆寫），重播時全部讀回。
+每筆紀錄以「請求內容」的 hash 當 key；同一個請求錄到多次時依序重播，用完後重複最後一筆。
+API 金鑰（URL 的 key 參數）不會寫進 cassette，也不參與比對。
+
+Gemini 的 prompt 會帶入影片上架天數等「跟現在時間有關」的數字，所以 cassette 啟用期間 now() 固定為錄製開始的時間
+（記在 cassette 目錄的 clock.json），隔天、隔月重播組出的 prompt 仍與錄製時相同。
+prompt 裡的快照歷史（趨勢、觀看速度）也一樣：錄製時 engine 把快照庫複製進 cassette（snapshots.sqlite），重播時讀那份。
+"""
+import base64
+import hashlib
+import importlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
+
+MODES = ("record", "replay")
+
+# 不寫入 cassette、不參與比對的 URL 參數
+_SECRET_PARAMS = {"key", "api_key"}
+
+
+class CassetteMiss(Exception):
+    """重播模式下找不到對應的錄製紀錄"""
+
+
+def _strip_secrets(url, params=None):
+    """移除 URL 與參數裡的金鑰，回傳 (url, 排序後的參數 list)"""
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in _SECRET_PARAMS]
+    query += [(k, str(v)) for k, v in (params or {}).items() if k not in _SECRET_PARAMS]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, "", "")), sorted(query)
+
+
+def _request_key(kind, payload):
+    raw = json.dumps([kind, payload], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """一卷錄製檔：record 模式寫入、replay 模式讀取"""
+
+    def __init__(self, path, mode="replay", latency=None, latency_scale=1.0):
+        if mode not in MODES:
+            raise ValueError(f"mode 必須是 {MODES} 之一")
+        self.path = path
+        self.mode = mode
+        self.latency = latency  # 固定延遲秒數；None 時照錄製耗時 × latency_scale
+        self.latency_scale = latency_scale
+        self._lock = threading.Lock()
+        self._entries = {}  # key → [紀錄, ...]
+        self._cursor = {}  # key → 下一次重播的位置
+        self.stats = {'recorded': 0, 'replayed': 0, 'misses': 0}
+        if mode == "replay":
+            self._load()
+        else:
+            os.makedirs(path, exist_ok=True)
+        self.clock = self._load_clock()
+
+    def _load(self):
+        try:
+            names = sorted(n for n in os.listdir(self.path) if n.endswith(".jsonl"))
+        except OSError:
+            raise CassetteMiss(f"找不到 cassette 目錄：{self.path}")
+        for name in names:
+            with open(os.path.join(self.path, name), encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries.setdefault(entry['key'], []).append(entry)
+
+    def _load_clock(self):
+        """錄製開始的時間（epoch 秒）：錄製時由第一個 process 寫入 clock.json，其餘 process 與重播時讀回"""
+        clock_path = os.path.join(self.path, "clock.json")
+        if self.mode == "record":
+            tmp_path = f"{clock_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({'recorded_at': time.time()}, f)
+            try:
+                # link 是原子操作且不覆寫：多個 process 同時錄製時只有第一個的時間生效
+                os.link(tmp_path, clock_path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+        try:
+            with open(clock_path, encoding="utf-8") as f:
+                return json.load(f)['recorded_at']
+        except (OSError, ValueError, KeyError):
+            # 沒有 clock.json 的舊 cassette：用最早一筆紀錄的時間
+            recorded = [e['recorded_at'] for entries in self._entries.values() for e in entries if 'recorded_at' in e]
+            return min(recorded) if recorded else time.time()
+
+    # ---------- 錄製與取回 ----------
+
+    def record(self, kind, payload, response, elapsed):
+        entry = {
+            'key': _request_key(kind, payload),
+            'kind': kind,
+            'request': payload,
+            'response': response,
+            'elapsed': round(elapsed, 4),
+            'recorded_at': time.time(),
+        }
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            with open(os.path.join(self.path, f"{os.getpid()}.jsonl"), "a", encoding="utf-8") as f:
+                f.write(line)
+            self.stats['recorded'] += 1
+
+    def lookup(self, kind, payload):
+        """取回下一筆符合的紀錄並模擬延遲，回傳錄製時的 response"""
+        key = _request_key(kind, payload)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.stats['misses'] += 1
+                raise CassetteMiss(f"cassette 沒有這個 {kind} 請求：{json.dumps(payload, ensure_ascii=False, default=str)[:200]}")
+            index = self._cursor.get(key, 0)
+            self._cursor[key] = index + 1
+            entry = entries[min(index, len(entries) - 1)]
+            self.stats['replayed'] += 1
+        delay = self.latency if self.latency is not None else entry.get('elapsed', 0) * self.latency_scale
+        if delay > 0:
+            time.sleep(delay)
+        return entry['response']
+
+    # ---------- requests（suggestqueries） ----------
+
+    def http_get(self, url, params=None, timeout=None):
+        """取代 requests.get：錄製時真的送出，重播時回傳錄下的內容"""
+        clean_url, query = _strip_secrets(url, params)
+        payload = {'method': 'GET', 'url': clean_url, 'query': query}
+        if self.mode == "replay":
+            return ReplayResponse(self.lookup("http", payload))
+
+        started = time.perf_counter()
+        response = importlib.import_module("requests").get(url, params=params, timeout=timeout)
+        self.record("http", payload, {
+            'status': response.status_code,
+            'headers': {'content-type': response.headers.get('content-type', '')},
+            'body_b64': base64.b64encode(response.content).decode("ascii"),
+        }, time.perf_counter() - started)
+        return response
+
+    # ---------- googleapiclient（build(..., http=...)） ----------
+
+    def youtube_http(self):
+        """給 googleapiclient discovery.build 的 http 物件"""
+        inner = None
+        if self.mode == "record":
+            inner = importlib.import_module("googleapiclient.http").build_http()
+        return CassetteHttp(self, inner)
+
+    # ---------- Gemini ----------
+
+    def wrap_model(self, model, model_version):
+        """包住 GenerativeModel；重播模式下 model 可以是 None（不需要安裝 google-generativeai）"""
+        return CassetteModel(self, model, model_version)
+
+
+class ReplayResponse:
+    """重播用的 requests.Response 替身（只實作 engine 用到的部分）"""
+
+    def __init__(self, recorded):
+        self.status_code = recorded['status']
+        self.headers = recorded.get('headers', {})
+        self.content = base64.b64decode(recorded['body_b64'])
+        self.encoding = None
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+
+class CassetteHttp:
+    """httplib2.Http 介面的錄製／重播層（googleapiclient 只呼叫 request()）"""
+
+    def __init__(self, cassette, inner=None):
+        self.cassette = cassette
+        self.inner = inner
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        clean_url, query = _strip_secrets(uri)
+        payload = {'method': method, 'url': clean_url, 'query': query, 'body': body}
+        httplib2 = importlib.import_module("httplib2")
+        if self.cassette.mode == "replay":
+            recorded = self.cassette.lookup("youtube", payload)
+            info = dict(recorded.get('headers', {}), status=str(recorded['status']))
+            return httplib2.Response(info), base64.b64decode(recorded['body_b64'])
+
+        started = time.perf_counter()
+        resp, content = self.inner.request(uri, method=method, body=body, headers=headers, **kwargs)
+        self.cassette.record("youtube", payload, {
+            'status': resp.status,
+            'headers': {'content-type': resp.get('content-type', '')},
+            'body_b64': base64.b64encode(content or b"").decode("ascii"),
+        }, time.perf_counter() - started)
+        return resp, content
+
+
+class CassetteModel:
+    """GenerativeModel 的錄製／重播層：以 (模型, prompt, generation_config) 比對"""
+
+    def __init__(self, cassette, model, model_version):
+        self.cassette = cassette
+        self.model = model
+        self.model_name = model_version
+
+    def generate_content(self, contents, generation_config=None, **kwargs):
+        payload = {'model': self.model_name, 'contents': contents, 'generation_config': generation_config}
+        if self.cassette.mode == "replay":
+            recorded = self.cassette.lookup("gemini", payload)
+            if 'error' in recorded:
+                raise RuntimeError(recorded['error'])
+            return SimpleNamespace(
+                text=recorded['text'],
+                usage_metadata=SimpleNamespace(**recorded.get('usage', {})),
+            )
+
+        started = time.perf_counter()
+        try:
+            response = self.model.generate_content(contents, generation_config=generation_config, **kwargs)
+            text = response.text
+        except Exception as e:
+            self.cassette.record("gemini", payload, {'error': str(e)}, time.perf_counter() - started)
+            raise
+        usage = getattr(response, "usage_metadata", None)
+        self.cassette.record("gemini", payload, {
+            'text': text,
+            'usage': {
+                name: getattr(usage, name, 0)
+                for name in ('prompt_token_count', 'candidates_token_count', 'total_token_count')
+            },
+        }, time.perf_counter() - started)
+        return response
+
+
+_active = None
+
+
+def activate(path, mode="replay", latency=None, latency_scale=1.0):
+    """啟用 cassette（process 全域）；之後 engine 的所有外部呼叫都會經過它"""
+    global _active
+    _active = Cassette(path, mode=mode, latency=latency, latency_scale=latency_scale)
+    return _active
+
+
+def deactivate():
+    global _active
+    _active = None
+
+
+def current():
+    """目前啟用的 cassette；沒有啟用時為 None"""
+    return _active
+
+
+def now():
+    """目前時間（datetime）；啟用 cassette 時固定為錄製開始的時間，prompt 裡與時間有關的數字重播時才對得上"""
+    cassette = _active
+    return datetime.fromtimestamp(cassette.clock) if cassette is not None else datetime.now()
+
+
+def activate_from_env():
+    """依 YT_CASSETTE / YT_CASSETTE_MODE / YT_REPLAY_LATENCY 啟用 cassette（未設定時不動作）"""
+    path = os.environ.get("YT_CASSETTE")
+    if not path:
+        return None
+    latency = os.environ.get("YT_REPLAY_LATENCY")
+    return activate(
+        path,
+        mode=os.environ.get("YT_CASSETTE_MODE", "replay"),
+        latency=float(latency) if latency else None,
+        latency_scale=float(os.environ.get("YT_REPLAY_LATENCY_SCALE", "1.0")),
+    )
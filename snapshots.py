@@ -0,0 +1,382 @@
+"""時間序列快照：每次真的向 YouTube 取回的資料都附時間戳追加寫入 SQLite，只增不改。
+
+- 自動完成（含 Google 相關性分數）：之後不必再連網就能比較哪些詞是新冒出來的、哪些分數在上升
+- 影片統計（觀看、按讚、留言數）：用相鄰快照的差值算出近期的真實日均觀看與加速度，而不是上架以來的平均
+
+    snapshots.record_suggestions("咖啡 推薦", "zh-TW", [("咖啡 推薦 2024", 1250), ...])
+    snapshots.trending(["咖啡"], min_gap_days=1)   # {'rising': [...], 'new': [...], 'falling': [...], ...}
+    snapshots.record_video_stats(videos)           # search_youtube_api 的結果
+    snapshots.video_velocity(["dQw4w9WgXcQ"])      # {video_id: {views_per_day, acceleration, ...}}
+
+資料庫預設在 .cache/snapshots.sqlite（YT_SNAPSHOT_DB 可改路徑，設為 off 則停用）。
+重播 cassette 或對本機替身服務做基準測試時不要寫入，以免把假資料混進歷史。
+錄製 cassette 時會用 pin() 把快照庫複製進 cassette，錄製與重播都只讀那份複本裡錄製開始前的快照。
+"""
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "snapshots.sqlite")
+
+# 比較時，基準快照至少要比最新快照早這麼多天（同一天重跑幾次不算趨勢）
+DEFAULT_MIN_GAP_DAYS = 1.0
+# 分數變化至少這麼多才算上升／下降（Google 相關性分數大約落在 500～1300）
+DEFAULT_MIN_DELTA = 50
+
+# 影片統計：速度取最近約 7 天的觀看增量；兩筆快照至少相隔半天才拿來相減（太近的差值雜訊太大）
+VELOCITY_WINDOW_DAYS = 7.0
+VELOCITY_MIN_GAP_DAYS = 0.5
+# 最近一次出現在搜尋結果後，持續追蹤（由 refresher 重新抓統計）的天數
+TRACK_DAYS = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS suggestion_snapshots (
+    id INTEGER PRIMARY KEY,
+    query TEXT NOT NULL,
+    lang TEXT NOT NULL,
+    client TEXT NOT NULL,
+    fetched REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_suggestion_snapshots_query ON suggestion_snapshots (query, lang, client, fetched);
+CREATE TABLE IF NOT EXISTS suggestion_terms (
+    snapshot_id INTEGER NOT NULL REFERENCES suggestion_snapshots (id),
+    position INTEGER NOT NULL,
+    term TEXT NOT NULL,
+    score INTEGER,
+    PRIMARY KEY (snapshot_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS video_stats (
+    video_id TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    source TEXT NOT NULL,
+    view_count INTEGER NOT NULL,
+    like_count INTEGER NOT NULL,
+    comment_count INTEGER NOT NULL,
+    PRIMARY KEY (video_id, fetched)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_video_stats_source ON video_stats (source, fetched);
+"""
+
+
+def _closest_before(points, target, latest):
+    """points 中時間 ≤ latest - VELOCITY_MIN_GAP_DAYS、且最接近 target 的一筆；沒有則為 None"""
+    limit = latest - VELOCITY_MIN_GAP_DAYS * 86400
+    candidates = [p for p in points if p[0] <= limit]
+    return min(candidates, key=lambda p: abs(p[0] - target)) if candidates else None
+
+
+class SnapshotStore:
+    """SQLite 快照庫；每個 thread 各用一條連線（WAL 模式，讀寫可以同時進行）"""
+
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript(_SCHEMA)
+                    self._initialized = True
+        return conn
+
+    def record_suggestions(self, query, lang, scored, client="chrome", fetched=None):
+        """追加一筆快照；scored 為 [(term, score)]，沒有分數的 client 傳 [(term, None)]。回傳快照 id"""
+        conn = self._connect()
+        with conn:
+            cur = conn.execute(
+                "INSERT INTO suggestion_snapshots (query, lang, client, fetched) VALUES (?, ?, ?, ?)",
+                (query, lang, client, fetched if fetched is not None else time.time()),
+            )
+            snapshot_id = cur.lastrowid
+            conn.executemany(
+                "INSERT INTO suggestion_terms (snapshot_id, position, term, score) VALUES (?, ?, ?, ?)",
+                [(snapshot_id, i, term, score) for i, (term, score) in enumerate(scored)],
+            )
+        return snapshot_id
+
+    def history(self, query, lang=None):
+        """某個查詢的所有快照 [{id, lang, client, fetched, terms}]，由舊到新"""
+        sql = "SELECT s.id, s.lang, s.client, s.fetched, COUNT(t.term) FROM suggestion_snapshots s " \
+              "LEFT JOIN suggestion_terms t ON t.snapshot_id = s.id WHERE s.query = ?"
+        params = [query]
+        if lang is not None:
+            sql += " AND s.lang = ?"
+            params.append(lang)
+        sql += " GROUP BY s.id ORDER BY s.fetched"
+        return [
+            {'id': i, 'lang': lg, 'client': c, 'fetched': f, 'terms': n}
+            for i, lg, c, f, n in self._connect().execute(sql, params)
+        ]
+
+    def _snapshot_pairs(self, seeds, lang, min_gap_days, as_of):
+        """每個 (查詢, 語言, client) 找出最新快照與「至少早 min_gap_days 天」的最近一筆基準快照"""
+        conditions, params = [], []
+        for seed in seeds:
+            # 種子本身、種子開頭或結尾的查詢（長尾展開與修飾詞探針）
+            conditions.append("(query = ? OR query LIKE ? ESCAPE '\\' OR query LIKE ? ESCAPE '\\')")
+            escaped = seed.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params += [seed, f"{escaped} %", f"% {escaped}"]
+        if not conditions:
+            return {}
+        sql = f"SELECT id, query, lang, client, fetched FROM suggestion_snapshots WHERE ({' OR '.join(conditions)})"
+        if lang is not None:
+            sql += " AND lang = ?"
+            params.append(lang)
+        if as_of is not None:
+            sql += " AND fetched <= ?"
+            params.append(as_of)
+        sql += " ORDER BY fetched DESC"
+
+        pairs = {}
+        gap = min_gap_days * 86400
+        for snapshot_id, query, lg, client, fetched in self._connect().execute(sql, params):
+            entry = pairs.setdefault((query, lg, client), {'latest': (snapshot_id, fetched), 'baseline': None})
+            if entry['baseline'] is None and entry['latest'][1] - fetched >= gap:
+                entry['baseline'] = (snapshot_id, fetched)
+        return {key: p for key, p in pairs.items() if p['baseline'] is not None}
+
+    def _terms(self, snapshot_ids):
+        terms = {}
+        ids = list(snapshot_ids)
+        # SQLite 單一語句的參數數量有上限，分批查
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = self._connect().execute(
+                f"SELECT snapshot_id, position, term, score FROM suggestion_terms "
+                f"WHERE snapshot_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for snapshot_id, position, term, score in rows:
+                terms.setdefault(snapshot_id, {})[term] = (position, score)
+        return terms
+
+    def trending(self, seeds, lang=None, min_gap_days=DEFAULT_MIN_GAP_DAYS, min_delta=DEFAULT_MIN_DELTA,
+                 as_of=None, limit=30):
+        """比較與種子相關的每個查詢「最新快照 vs 基準快照」，回傳
+        {rising, new, falling: [{term, query, score, previous_score, delta, position, previous_position}],
+         queries_compared, baseline_age_days}。同一個詞出現在多個查詢時只留變化最大的一筆"""
+        pairs = self._snapshot_pairs(seeds, lang, min_gap_days, as_of)
+        result = {'rising': [], 'new': [], 'falling': [], 'queries_compared': len(pairs), 'baseline_age_days': None}
+        if not pairs:
+            return result
+        terms = self._terms({sid for p in pairs.values() for sid, _ in (p['latest'], p['baseline'])})
+
+        best = {}
+        for (query, _, _), p in pairs.items():
+            latest = terms.get(p['latest'][0], {})
+            baseline = terms.get(p['baseline'][0], {})
+            for term, (position, score) in latest.items():
+                previous = baseline.get(term)
+                if previous is None:
+                    kind, delta = 'new', score or 0
+                else:
+                    prev_position, prev_score = previous
+                    # 沒有分數（firefox client）時用名次變化代替：每上升一名算 min_delta
+                    if score is None or prev_score is None:
+                        delta = (prev_position - position) * min_delta
+                    else:
+                        delta = score - prev_score
+                    if abs(delta) < min_delta:
+                        continue
+                    kind = 'rising' if delta > 0 else 'falling'
+                row = {
+                    'term': term, 'query': query, 'score': score,
+                    'previous_score': previous[1] if previous else None, 'delta': delta,
+                    'position': position + 1, 'previous_position': previous[0] + 1 if previous else None,
+                }
+                current = best.get((kind, term))
+                if current is None or abs(delta) > abs(current['delta']):
+                    best[(kind, term)] = row
+
+        for (kind, _), row in best.items():
+            result[kind].append(row)
+        result['rising'].sort(key=lambda r: -r['delta'])
+        result['falling'].sort(key=lambda r: r['delta'])
+        result['new'].sort(key=lambda r: (-(r['score'] or 0), r['position']))
+        for kind in ('rising', 'new', 'falling'):
+            result[kind] = result[kind][:limit]
+        ages = [(p['latest'][1] - p['baseline'][1]) / 86400 for p in pairs.values()]
+        result['baseline_age_days'] = round(min(ages), 1)
+        return result
+
+    def record_video_stats(self, videos, source="search", fetched=None):
+        """追加影片統計快照；videos 為含 id／view_count／like_count／comment_count 的 dict。回傳寫入筆數"""
+        fetched = fetched if fetched is not None else time.time()
+        rows = [
+            (v['id'], fetched, source, int(v.get('view_count') or 0), int(v.get('like_count') or 0),
+             int(v.get('comment_count') or 0))
+            for v in videos if v.get('id')
+        ]
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO video_stats (video_id, fetched, source, view_count, like_count, comment_count) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def stale_video_ids(self, stale_hours=24, track_days=TRACK_DAYS, now=None):
+        """需要重新抓統計的影片：最近 track_days 天內出現在搜尋結果、且最新快照已超過 stale_hours 小時"""
+        now = now if now is not None else time.time()
+        rows = self._connect().execute(
+            "SELECT video_id, MAX(fetched) FROM video_stats WHERE video_id IN "
+            "(SELECT DISTINCT video_id FROM video_stats WHERE source = 'search' AND fetched >= ?) "
+            "GROUP BY video_id HAVING MAX(fetched) <= ? ORDER BY MAX(fetched)",
+            (now - track_days * 86400, now - stale_hours * 3600),
+        )
+        return [video_id for video_id, _ in rows]
+
+    def video_velocity(self, video_ids, window_days=VELOCITY_WINDOW_DAYS, as_of=None):
+        """由快照差值算近期速度，回傳 {video_id: {views_per_day, previous_views_per_day, acceleration, span_days, snapshots}}。
+        views_per_day＝最新快照與約 window_days 天前快照之間的日均觀看增量；
+        acceleration＝這段速度與再前一段速度的差，除以兩段中點的間隔天數（觀看/天²，負值＝正在衰退）。
+        快照不足兩筆（或相隔不到半天）的影片不會出現在結果裡"""
+        ids = list(dict.fromkeys(video_ids))
+        points = {}
+        horizon = 3 * window_days * 86400
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            sql = (f"SELECT video_id, fetched, view_count FROM video_stats WHERE video_id IN ({','.join('?' * len(chunk))})"
+                   + (" AND fetched <= ?" if as_of is not None else "") + " ORDER BY video_id, fetched")
+            for video_id, fetched, views in self._connect().execute(sql, chunk + ([as_of] if as_of is not None else [])):
+                points.setdefault(video_id, []).append((fetched, views))
+
+        velocity = {}
+        for video_id, series in points.items():
+            latest = series[-1]
+            series = [p for p in series if p[0] >= latest[0] - horizon]
+            base = _closest_before(series, latest[0] - window_days * 86400, latest[0])
+            if base is None:
+                continue
+            span = (latest[0] - base[0]) / 86400
+            entry = {
+                'views_per_day': round((latest[1] - base[1]) / span, 1),
+                'previous_views_per_day': None,
+                'acceleration': None,
+                'span_days': round(span, 1),
+                'snapshots': len(series),
+            }
+            prior = _closest_before(series, base[0] - (latest[0] - base[0]), base[0])
+            if prior is not None:
+                prior_span = (base[0] - prior[0]) / 86400
+                previous = (base[1] - prior[1]) / prior_span
+                entry['previous_views_per_day'] = round(previous, 1)
+                entry['acceleration'] = round((entry['views_per_day'] - previous) / ((span + prior_span) / 2), 2)
+            velocity[video_id] = entry
+        return velocity
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def configure(path=DEFAULT_DB_PATH):
+    """指定快照庫路徑；傳 None 停用（之後 record／trending 都不做事）"""
+    global _store
+    with _store_lock:
+        _store = SnapshotStore(path) if path else False
+
+
+def store():
+    """目前的快照庫（第一次呼叫時依 YT_SNAPSHOT_DB 建立）；停用時為 None"""
+    if _store is None:
+        path = os.environ.get("YT_SNAPSHOT_DB", DEFAULT_DB_PATH)
+        configure(None if path.lower() == "off" else path)
+    return _store or None
+
+
+def pin(path):
+    """把目前快照庫複製成 path 並回傳這份複本的 SnapshotStore（錄製 cassette 時固定重播要讀的歷史）。
+    path 已存在時直接沿用，不覆寫（多個 process 同時錄製只有第一份生效）；快照庫停用或複製失敗時回傳 None"""
+    if not os.path.exists(path):
+        s = store()
+        if s is None:
+            return None
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            target = sqlite3.connect(tmp_path)
+            try:
+                s._connect().backup(target)
+            finally:
+                target.close()
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        except sqlite3.Error:
+            return None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return pinned(path)
+
+
+_pinned = {}
+
+
+def pinned(path):
+    """已固定的快照庫複本（重播時讀 cassette 裡的那份）；不存在時為 None"""
+    if not os.path.exists(path):
+        return None
+    with _store_lock:
+        if path not in _pinned:
+            _pinned[path] = SnapshotStore(path)
+        return _pinned[path]
+
+
+def record_suggestions(query, lang, scored, client="chrome"):
+    """寫入一筆快照；停用或寫入失敗都不影響呼叫端"""
+    s = store()
+    if s is None or not scored:
+        return None
+    try:
+        return s.record_suggestions(query, lang, scored, client=client)
+    except sqlite3.Error:
+        return None
+
+
+def empty_trends():
+    """沒有可比較的快照時 trending 的結果"""
+    return {'rising': [], 'new': [], 'falling': [], 'queries_compared': 0, 'baseline_age_days': None}
+
+
+def trending(seeds, source=None, **kwargs):
+    """store().trending 的捷徑（source 指定改讀別的快照庫，例如 pinned 的複本）；停用或讀取失敗時回傳空結果"""
+    s = source or store()
+    if s is None:
+        return empty_trends()
+    try:
+        return s.trending(seeds, **kwargs)
+    except sqlite3.Error:
+        return empty_trends()
+
+
+def record_video_stats(videos, source="search"):
+    """寫入影片統計快照；停用或寫入失敗都不影響呼叫端"""
+    s = store()
+    if s is None or not videos:
+        return 0
+    try:
+        return s.record_video_stats(videos, source=source)
+    except sqlite3.Error:
+        return 0
+
+
+def video_velocity(video_ids, source=None, **kwargs):
+    """store().video_velocity 的捷徑（source 同 trending）；停用或讀取失敗時回傳 {}"""
+    s = source or store()
+    if s is None or not video_ids:
+        return {}
+    try:
+        return s.video_velocity(video_ids, **kwargs)
+    except sqlite3.Error:
+        return {}
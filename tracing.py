@@ -0,0 +1,218 @@
+"""執行追蹤：記錄每個外部呼叫與流程階段的 span（耗時、重試、傳輸量、Gemini token 數），找出一次執行的時間花在哪裡。
+
+    with tracing.start_trace("search") as trace:
+        ...                                    # 期間 engine 的呼叫都會記成 span
+    tracing.to_chrome_trace(trace.to_dict())   # 可用 chrome://tracing 或 ui.perfetto.dev 開啟
+
+目前的 trace 與上層 span 放在 contextvars；送進 thread pool 的函式要先經過 bind() 才會帶著走。
+沒有啟用 trace 時 span() 不做任何事。
+"""
+import contextlib
+import contextvars
+import functools
+import itertools
+import threading
+import time
+from urllib.parse import urlsplit
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+_current_span = contextvars.ContextVar("span", default=None)
+
+
+class Trace:
+    """一次執行的所有 span（thread-safe）"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.duration = None
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.spans = []
+
+    def _next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def _add(self, record):
+        with self._lock:
+            self.spans.append(record)
+
+    def elapsed(self):
+        return time.perf_counter() - self._t0
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s['start'])
+        return {'name': self.name, 'started': self.started, 'duration': self.duration, 'spans': spans}
+
+
+def to_chrome_trace(trace_dict):
+    """把 Trace.to_dict() 轉成 Chrome Trace Event 格式（complete event），每個 thread 一條軌道"""
+    events = []
+    for s in trace_dict['spans']:
+        events.append({
+            'name': s['name'],
+            'cat': s['name'].split('.')[0].split(':')[0],
+            'ph': "X",
+            'ts': round(s['start'] * 1e6),
+            'dur': round(s['duration'] * 1e6),
+            'pid': 1,
+            'tid': s['thread'],
+            'args': s['attrs'],
+        })
+    return {
+        'traceEvents': events,
+        'displayTimeUnit': "ms",
+        'otherData': {'name': trace_dict['name'], 'started': trace_dict['started']},
+    }
+
+
+def summarize(trace_dict):
+    """依 span 名稱彙總：次數、總耗時、最長耗時、傳輸量、token 數、錯誤數"""
+    summary = {}
+    for s in trace_dict['spans']:
+        entry = summary.setdefault(s['name'], {
+            'count': 0, 'total_s': 0.0, 'max_s': 0.0, 'bytes': 0, 'tokens': 0, 'retries': 0, 'errors': 0,
+        })
+        attrs = s['attrs']
+        entry['count'] += 1
+        entry['total_s'] += s['duration']
+        entry['max_s'] = max(entry['max_s'], s['duration'])
+        entry['bytes'] += attrs.get('bytes', 0)
+        entry['tokens'] += attrs.get('total_tokens', 0)
+        entry['retries'] += attrs.get('retries', 0)
+        entry['errors'] += 1 if attrs.get('error') else 0
+    return summary
+
+
+@contextlib.contextmanager
+def start_trace(name):
+    """在目前的 context 啟用一個新的 trace，離開時結束"""
+    trace = Trace(name)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    try:
+        yield trace
+    finally:
+        trace.duration = trace.elapsed()
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+
+
+def current():
+    """目前 context 的 trace；沒有啟用時為 None"""
+    return _current_trace.get()
+
+
+class span:
+    """記錄一段操作的 context manager；attrs 可在過程中用 set() 補上（例如回應大小、token 數）"""
+
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self._trace = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self._trace = _current_trace.get()
+        if self._trace is not None:
+            self.id = self._trace._next_id()
+            self.parent = _current_span.get()
+            self._token = _current_span.set(self.id)
+            self._start = self._trace.elapsed()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._trace is None:
+            return False
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.attrs['error'] = str(exc)[:300]
+        self._trace._add({
+            'id': self.id,
+            'parent': self.parent,
+            'name': self.name,
+            'start': round(self._start, 4),
+            'duration': round(self._trace.elapsed() - self._start, 4),
+            'thread': threading.current_thread().name,
+            'attrs': self.attrs,
+        })
+        return False
+
+
+def traced(name):
+    """把整個函式記成一個 span 的 decorator"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind(fn):
+    """讓 fn 在送出當下的 context 執行（thread pool 的 worker 才看得到目前的 trace 與上層 span）"""
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+class TracedHttp:
+    """httplib2.Http 介面的包裝：每個 YouTube Data API 請求記成一個 span（youtube.<資源>.list）。
+    googleapiclient 的 num_retries 重試會再呼叫一次 request()，同一 thread 對同一 URI 的連續失敗次數記為 retries"""
+
+    _RETRYABLE = {429, 500, 502, 503, 504}
+
+    def __init__(self, inner):
+        self.inner = inner
+        self._local = threading.local()
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        resource = urlsplit(uri).path.rstrip("/").rsplit("/", 1)[-1]
+        action = "list" if method == "GET" else method.lower()
+        failures = getattr(self._local, "failures", None)
+        if failures is None:
+            failures = self._local.failures = {}
+        attempt = failures.get(uri, 0)
+        with span(f"youtube.{resource}.{action}", retries=attempt) as s:
+            resp, content = self.inner.request(uri, method=method, body=body, headers=headers, **kwargs)
+            s.set(status=resp.status, bytes=len(content or b""))
+        if resp.status in self._RETRYABLE:
+            failures[uri] = attempt + 1
+        else:
+            failures.pop(uri, None)
+        return resp, content
+
+    def __getattr__(self, name):
+        # googleapiclient 偶爾會讀 http 物件的其他屬性（timeout、credentials 等）
+        return getattr(self.inner, name)
+
+
+class TracedModel:
+    """GenerativeModel 的包裝：每次 generate_content 記成一個 span，含 prompt／回應長度與 usage_metadata 的 token 數"""
+
+    def __init__(self, model, model_name):
+        self.model = model
+        self.model_name = model_name
+
+    def generate_content(self, contents, *args, **kwargs):
+        prompt_chars = len(contents) if isinstance(contents, str) else sum(len(str(c)) for c in contents)
+        with span("gemini.generate_content", model=self.model_name, prompt_chars=prompt_chars) as s:
+            response = self.model.generate_content(contents, *args, **kwargs)
+            usage = getattr(response, "usage_metadata", None)
+            s.set(
+                prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+                output_tokens=getattr(usage, "candidates_token_count", 0) or 0,
+                total_tokens=getattr(usage, "total_token_count", 0) or 0,
+            )
+            try:
+                s.set(bytes=len(response.text.encode("utf-8")))
+            except Exception:
+                pass
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
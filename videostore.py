@@ -0,0 +1,103 @@
+"""搜尋結果的欄位式影片索引：一次建好 source_keyword／market／channel_id 索引與依 rank 排序的位置，各階段直接查詢，不再逐關鍵字重掃整份影片 list。
+
+    store = VideoStore(zh_videos + en_videos)
+    store.by_keyword("咖啡", market="zh", top_n=3)   # 依排名的前 3 支
+    store.group_by_keyword(market="en")             # {keyword: [videos]}
+    store.column("view_count")                      # array('q')，可直接給 numpy／pandas
+
+影片本身仍是原本的 dict（只存參照，不複製，checkpoint／JSON 輸出照舊）；
+索引只存列位置（array('I')），數值欄位存成 array('q')，幾千支影片時額外記憶體只有每支幾十 bytes。
+"""
+from array import array
+
+INT_COLUMNS = ('rank', 'view_count', 'like_count', 'comment_count', 'subscriber_count')
+_MISSING_RANK = 99
+
+
+class VideoStore:
+    """影片 list 的唯讀索引；建好後不要再增刪影片（要更新就重建一個）"""
+
+    __slots__ = ('rows', '_columns', '_by_keyword', '_by_market', '_by_channel')
+
+    def __init__(self, videos=()):
+        self.rows = list(videos)
+        self._columns = {}
+        by_keyword, by_market, by_channel = {}, {}, {}
+        for pos, v in enumerate(self.rows):
+            market = v.get('market', 'zh')
+            by_keyword.setdefault((market, v.get('source_keyword', '')), []).append(pos)
+            by_market.setdefault(market, []).append(pos)
+            channel = v.get('channel_id', '')
+            if channel:
+                by_channel.setdefault(channel, []).append(pos)
+
+        ranks = self.column('rank')
+        # 各關鍵字桶內依 rank 排序（同名次保留原順序），查詢前 N 名不必再排序
+        self._by_keyword = {
+            key: array('I', sorted(positions, key=lambda p: (ranks[p], p)))
+            for key, positions in by_keyword.items()
+        }
+        self._by_market = {m: array('I', positions) for m, positions in by_market.items()}
+        self._by_channel = {c: array('I', positions) for c, positions in by_channel.items()}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def _take(self, positions, top_n=None):
+        if top_n is not None:
+            positions = positions[:top_n]
+        return [self.rows[p] for p in positions]
+
+    def column(self, name):
+        """數值欄位（INT_COLUMNS）的 array('q')，第一次取用時建立；缺值為 0（rank 為 99）"""
+        if name not in self._columns:
+            if name not in INT_COLUMNS:
+                raise KeyError(f"不支援的數值欄位：{name}")
+            default = _MISSING_RANK if name == 'rank' else 0
+            values = array('q')
+            for v in self.rows:
+                try:
+                    values.append(int(v.get(name) or default))
+                except (TypeError, ValueError):
+                    values.append(default)
+            self._columns[name] = values
+        return self._columns[name]
+
+    def markets(self):
+        return list(self._by_market)
+
+    def keywords(self, market=None):
+        """出現過的關鍵字（依第一次出現的順序）；給 market 時只列該市場"""
+        seen = {}
+        for m, keyword in self._by_keyword:
+            if market is None or m == market:
+                seen.setdefault(keyword, None)
+        return list(seen)
+
+    def by_keyword(self, keyword, market=None, top_n=None):
+        """某關鍵字的影片（依 rank 排序）；不給 market 時合併各市場"""
+        if market is not None:
+            return self._take(self._by_keyword.get((market, keyword), ()), top_n)
+        positions = [p for m in self._by_market for p in self._by_keyword.get((m, keyword), ())]
+        if len(self._by_market) > 1:
+            ranks = self.column('rank')
+            positions.sort(key=lambda p: (ranks[p], p))
+        return self._take(positions, top_n)
+
+    def by_market(self, market):
+        return self._take(self._by_market.get(market, ()))
+
+    def by_channel(self, channel_id):
+        return self._take(self._by_channel.get(channel_id, ()))
+
+    def channel_ids(self):
+        return list(self._by_channel)
+
+    def group_by_keyword(self, market=None, top_n=None):
+        """{keyword: [videos]}，每組依 rank 排序；不給 market 時同名關鍵字跨市場合併"""
+        if market is not None:
+            return {kw: self._take(positions, top_n) for (m, kw), positions in self._by_keyword.items() if m == market}
+        return {kw: self.by_keyword(kw, top_n=top_n) for kw in self.keywords()}